@@ -0,0 +1,453 @@
+"""Run many steps of a process on a network at once, with NumPy.
+
+The functions in :mod:`dallinger.processes` take one step at a time through
+the models, which makes long runs slow. A :class:`ProcessEngine` loads the
+nodes, vectors and infos of a network into arrays once, draws the random
+choices for a whole batch of steps at a time, works out what every step
+transmits and then writes the transmissions, infos, transformations and
+failures back to the database in bulk.
+
+The engine assumes that agents replicate the infos they receive as soon as
+they are sent them, as :class:`~dallinger.nodes.ReplicatorAgent` does, and
+that nothing else changes the network while the engine is in use.
+"""
+
+import six
+from sqlalchemy.orm import object_session
+
+from .models import Info
+from .models import Node
+from .models import Transformation
+from .models import Transmission
+from .models import Vector
+from .models import _drop_cache
+from .models import _fail_node_contents
+from .models import _fail_rows
+from .models import _insert_rows
+from .models import _reserve_ids
+from .models import timenow
+from .nodes import Agent
+from .nodes import ReplicatorAgent
+from . import processes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _last_write(writes, slots, at=None):
+    """For every slot in slots, the last step before at that wrote to it.
+
+    writes[t] is the slot written to at step t, and at defaults to the step
+    of each slot, that is range(len(slots)). Returns -1 for slots that had
+    not been written to earlier in the batch.
+    """
+    steps = len(writes)
+    if at is None:
+        at = numpy.arange(len(slots))
+    written = numpy.sort(writes * steps + numpy.arange(steps))
+    found = numpy.searchsorted(written, slots * steps + at) - 1
+    previous = written[numpy.maximum(found, 0)]
+    return numpy.where((found >= 0) & (previous // steps == slots),
+                       previous % steps, -1)
+
+
+def _roots(parent):
+    """Follow parent links from every step back to the first in its chain."""
+    root = numpy.where(parent >= 0, parent, numpy.arange(len(parent)))
+    while True:
+        jumped = root[root]
+        if (jumped == root).all():
+            return root
+        root = jumped
+
+
+def _expand(counts):
+    """Index rows when step t produces counts[t] rows.
+
+    Returns the step of every row, the index of every row within its step and
+    the index of the first row of every step.
+    """
+    starts = numpy.cumsum(counts) - counts
+    step = numpy.repeat(numpy.arange(len(counts)), counts)
+    return step, numpy.arange(counts.sum()) - starts[step], starts
+
+
+class ProcessEngine(object):
+    """Run processes on a network in batches of steps.
+
+    ``seed`` seeds the NumPy random number generator, so runs can be
+    repeated. The network is loaded the first time a process is run, after
+    a first step through the models if the network has no transmissions
+    yet, and the engine then keeps track of the changes it makes itself.
+    """
+
+    def __init__(self, network, seed=None):
+        """Create an engine for network."""
+        if numpy is None:
+            raise ImportError("The process engine needs NumPy to be installed.")
+
+        self.network = network
+        self.random = numpy.random.RandomState(seed)
+        self.loaded = False
+
+    def _load(self):
+        """Load the nodes, vectors and infos of the network into arrays."""
+        session = object_session(self.network)
+        session.flush()
+
+        nodes = sorted(self.network.nodes(),
+                       key=lambda n: (n.creation_time, n.id))
+        slots = dict((node.id, slot) for slot, node in enumerate(nodes))
+        self.node_ids = numpy.array([n.id for n in nodes], dtype=numpy.int64)
+        self.node_types = [n.type for n in nodes]
+        self.agents = numpy.array(
+            [s for s, n in enumerate(nodes) if isinstance(n, Agent)],
+            dtype=numpy.int64)
+        is_agent = numpy.zeros(len(nodes), dtype=bool)
+        is_agent[self.agents] = True
+
+        vectors = Vector.query\
+            .with_entities(Vector.id, Vector.origin_id, Vector.destination_id)\
+            .filter_by(network_id=self.network.id, failed=False)\
+            .order_by(Vector.id)\
+            .all()
+        vector_ids = numpy.array([v[0] for v in vectors], dtype=numpy.int64)
+        origins = numpy.array([slots[v[1]] for v in vectors],
+                              dtype=numpy.int64)
+        destinations = numpy.array([slots[v[2]] for v in vectors],
+                                   dtype=numpy.int64)
+
+        # Vectors in and out of every slot, in compressed sparse row form.
+        size = len(nodes)
+        outgoing = numpy.argsort(origins, kind="mergesort")
+        incoming = numpy.argsort(destinations, kind="mergesort")
+        self.out_degree = numpy.bincount(origins, minlength=size)
+        self.in_degree = numpy.bincount(destinations, minlength=size)
+        self.out_start = numpy.cumsum(self.out_degree) - self.out_degree
+        self.in_start = numpy.cumsum(self.in_degree) - self.in_degree
+        self.out_slots = destinations[outgoing]
+        self.in_slots = origins[incoming]
+        in_position = numpy.empty(len(vectors), dtype=numpy.int64)
+        in_position[incoming] = numpy.arange(len(vectors)) - \
+            self.in_start[destinations[incoming]]
+
+        # The vectors from every slot to agents, which processes choose from.
+        to_agents = outgoing[is_agent[destinations[outgoing]]]
+        self.agent_degree = numpy.bincount(origins[to_agents], minlength=size)
+        self.agent_start = numpy.cumsum(self.agent_degree) - self.agent_degree
+        self.agent_slots = destinations[to_agents]
+        self.agent_vectors = vector_ids[to_agents]
+        self.agent_in_position = in_position[to_agents]
+
+        infos = Info.query\
+            .with_entities(Info.id, Info.origin_id, Info.contents, Info.type)\
+            .filter_by(network_id=self.network.id, failed=False)\
+            .order_by(Info.creation_time, Info.id)\
+            .all()
+        self.infos = [[] for _ in nodes]
+        for id, origin_id, contents, info_type in infos:
+            if origin_id in slots:
+                self.infos[slots[origin_id]].append((id, contents, info_type))
+
+        latest = self.network.latest_transmission_recipient()
+        self.latest = None if latest is None else slots.get(latest.id)
+        self.loaded = True
+
+    def _prepare(self, process, started):
+        """Take the first step through the models if need be, then load.
+
+        Returns the number of steps taken.
+        """
+        if self.loaded:
+            return 0
+
+        replicate = six.get_unbound_function(ReplicatorAgent.update)
+        for agent in self.network.nodes(type=Agent):
+            if six.get_unbound_function(type(agent).update) is not replicate:
+                raise TypeError(
+                    "{} does not replicate the infos it receives, so cannot "
+                    "be run by the process engine.".format(agent))
+
+        taken = 0
+        if not started():
+            process(self.network)
+            for agent in self.network.nodes(type=Agent):
+                agent.receive()
+            taken = 1
+        self._load()
+        return taken
+
+    def _choose(self, slots, draws=None):
+        """Pick a random agent that each of slots has a vector to.
+
+        draws are uniform random numbers to pick with, one per slot, and are
+        drawn if not given. Returns the index of each chosen vector in the
+        agent vector arrays.
+        """
+        degree = self.agent_degree[slots]
+        if (degree == 0).any():
+            raise ValueError(
+                "Node {} is not connected to any agents.".format(
+                    self.node_ids[slots[degree == 0][0]]))
+        if draws is None:
+            draws = self.random.random_sample(len(slots))
+        return self.agent_start[slots] + (draws * degree).astype(numpy.int64)
+
+    def _random_agents(self, steps):
+        if not len(self.agents):
+            raise ValueError("{} has no agents.".format(self.network))
+        return self.agents[self.random.randint(len(self.agents), size=steps)]
+
+    def _infos_of(self, slots):
+        for slot in set(slots.tolist()):
+            if not self.infos[slot]:
+                raise ValueError("Node {} has no infos to transmit.".format(
+                    self.node_ids[slot]))
+
+    def _times(self, steps):
+        """A distinct time for each step, one microsecond apart."""
+        start = numpy.datetime64(timenow(), "us")
+        return (start + numpy.arange(steps)).astype(object)
+
+    def _write(self, infos, transmissions, transformations, vectors=(),
+               nodes=()):
+        """Insert the rows built by a batch of steps."""
+        session = object_session(self.network)
+        for cls, rows in ((Node, nodes), (Vector, vectors), (Info, infos),
+                          (Transmission, transmissions),
+                          (Transformation, transformations)):
+            _insert_rows(session, cls, list(rows))
+        _drop_cache(self.network, self.network.id)
+
+    def _rows(self, steps, times, node_ids, info_ids, info_in, contents,
+              types, vector_ids, origins):
+        """Rows for infos replicated at node_ids after being sent to them.
+
+        Every argument but steps and times has an entry for every info.
+        """
+        network_id = self.network.id
+        when = times[steps].tolist()
+        columns = (info_ids.tolist(), info_in.tolist(), node_ids.tolist(),
+                   origins.tolist(), vector_ids.tolist(), when, contents,
+                   types)
+        infos, transmissions, transformations = [], [], []
+        for id, id_in, node_id, origin_id, vector_id, time, content, info_type \
+                in zip(*columns):
+            infos.append({
+                "id": id, "creation_time": time, "failed": False,
+                "type": info_type, "origin_id": node_id, "network_id": network_id,
+                "contents": content,
+            })
+            transmissions.append({
+                "creation_time": time, "failed": False, "status": "received",
+                "receive_time": time, "vector_id": vector_id, "info_id": id_in,
+                "origin_id": origin_id, "destination_id": node_id,
+                "network_id": network_id,
+            })
+            transformations.append({
+                "creation_time": time, "failed": False, "type": "replication",
+                "info_in_id": id_in, "info_out_id": id, "node_id": node_id,
+                "network_id": network_id,
+            })
+        return infos, transmissions, transformations
+
+    def moran_cultural(self, steps):
+        """Run steps steps of :func:`~dallinger.processes.moran_cultural`."""
+        steps -= self._prepare(processes.moran_cultural,
+                               self.network.has_transmissions)
+        if steps <= 0:
+            return
+
+        replacers = self._random_agents(steps)
+        chosen = self._choose(replacers)
+        replaced = self.agent_slots[chosen]
+
+        # A replacer sends the info it was last sent in the batch, or else
+        # its latest info from before the batch, which it must then have.
+        parent = _last_write(replaced, replacers)
+        self._infos_of(replacers[parent < 0])
+        origin = replacers[_roots(parent)]
+        latest = [self.infos[slot][-1] for slot in origin.tolist()]
+
+        session = object_session(self.network)
+        info_ids = numpy.array(_reserve_ids(session, Info, steps),
+                               dtype=numpy.int64)
+        before = numpy.array([self.infos[slot][-1][0] if self.infos[slot]
+                              else -1 for slot in replacers.tolist()],
+                             dtype=numpy.int64)
+        info_in = numpy.where(parent >= 0, info_ids[parent], before)
+
+        times = self._times(steps)
+        infos, transmissions, transformations = self._rows(
+            numpy.arange(steps), times, self.node_ids[replaced], info_ids,
+            info_in, [i[1] for i in latest], [i[2] for i in latest],
+            self.agent_vectors[chosen], self.node_ids[replacers])
+        self._write(infos, transmissions, transformations)
+
+        for slot, id, info in zip(replaced.tolist(), info_ids.tolist(),
+                                  latest):
+            self.infos[slot].append((id, info[1], info[2]))
+        self.latest = int(replaced[-1])
+
+    def moran_sexual(self, steps):
+        """Run steps steps of :func:`~dallinger.processes.moran_sexual`.
+
+        Rather than a new agent being added before every step, the engine
+        creates the offspring itself, with the class of its parent. The
+        replaced agents are failed when the batch is written.
+        """
+        steps -= self._prepare(processes.moran_sexual,
+                               self.network.has_transmissions)
+        if steps <= 0:
+            return
+
+        replacers = self._random_agents(steps)
+        chosen = self._choose(replacers)
+        replaced = self.agent_slots[chosen]
+        session = object_session(self.network)
+
+        # The offspring of step t takes the place of the replaced agent, with
+        # the same vectors, so the slots stay connected as before the batch.
+        births = numpy.array(_reserve_ids(session, Node, steps),
+                             dtype=numpy.int64)
+
+        def occupants(slots, at=None):
+            previous = _last_write(replaced, slots, at)
+            return numpy.where(previous >= 0, births[previous],
+                               self.node_ids[slots])
+
+        parent = _last_write(replaced, replacers)
+        ancestors = replacers[_roots(parent)]
+        parents = occupants(replacers)
+        dead = occupants(replaced)
+        times = self._times(steps)
+
+        nodes = [{
+            "id": id, "creation_time": time, "failed": False,
+            "type": node_type, "network_id": self.network.id,
+        } for id, time, node_type in zip(
+            births.tolist(), times.tolist(),
+            [self.node_types[slot] for slot in ancestors.tolist()])]
+
+        # Copy the vectors in to and out of the replaced agents.
+        vectors = []
+        for direction in ("in", "out"):
+            step, index, starts = _expand(
+                getattr(self, direction + "_degree")[replaced])
+            others = getattr(self, direction + "_slots")[
+                getattr(self, direction + "_start")[replaced][step] + index]
+            other_ids = occupants(others, step).tolist()
+            ids = numpy.array(_reserve_ids(session, Vector, len(step)),
+                              dtype=numpy.int64)
+            if direction == "in":
+                # The replacer sends along its copy of the vector to the
+                # replaced agent.
+                sent_along = ids[starts + self.agent_in_position[chosen]]
+                pairs = zip(other_ids, births[step].tolist())
+            else:
+                pairs = zip(births[step].tolist(), other_ids)
+            vectors.extend({
+                "id": id, "creation_time": time, "failed": False,
+                "origin_id": origin_id, "destination_id": destination_id,
+                "network_id": self.network.id,
+            } for id, time, (origin_id, destination_id) in zip(
+                ids.tolist(), times[step].tolist(), pairs))
+
+        # The offspring replicates every info of its parent, which are
+        # copies of the infos of the agent that its line started from.
+        counts = numpy.array([len(self.infos[slot])
+                              for slot in ancestors.tolist()])
+        step, index, info_starts = _expand(counts)
+        info_ids = numpy.array(_reserve_ids(session, Info, len(step)),
+                               dtype=numpy.int64)
+        copied = [self.infos[slot][i] for slot, i in
+                  zip(ancestors[step].tolist(), index.tolist())]
+        before = numpy.array(
+            [infos[i][0] if i < len(infos) else -1 for infos, i in zip(
+                [self.infos[slot] for slot in replacers[step].tolist()],
+                index.tolist())],
+            dtype=numpy.int64)
+        info_in = before
+        inherited = parent[step] >= 0
+        info_in[inherited] = info_ids[
+            info_starts[parent[step][inherited]] + index[inherited]]
+
+        infos, transmissions, transformations = self._rows(
+            step, times, births[step], info_ids, info_in,
+            [i[1] for i in copied], [i[2] for i in copied],
+            sent_along[step], parents[step])
+        self._write(infos, transmissions, transformations,
+                    vectors=vectors, nodes=nodes)
+
+        dead = dead.tolist()
+        time_of_death = timenow()
+        _fail_rows(session, Node, Node.id.in_(dead), time_of_death)
+        _fail_node_contents(session, dead, time_of_death)
+
+        for t, slot in enumerate(replaced.tolist()):
+            first = info_starts[t]
+            self.node_ids[slot] = births[t]
+            self.node_types[slot] = nodes[t]["type"]
+            self.infos[slot] = [
+                (id, info[1], info[2]) for id, info in zip(
+                    info_ids[first:first + counts[t]].tolist(),
+                    copied[first:first + counts[t]])]
+        self.latest = int(replaced[-1])
+
+    def random_walk(self, steps):
+        """Run steps steps of :func:`~dallinger.processes.random_walk`.
+
+        The walk itself has to be taken one step at a time, as each step
+        starts where the last one ended, but the steps are chosen without
+        going through the models and are written to the database together.
+        """
+        steps -= self._prepare(
+            processes.random_walk,
+            lambda: self.network.latest_transmission_recipient() is not None)
+        if steps <= 0:
+            return
+
+        draws = self.random.random_sample(steps)
+        chosen = numpy.empty(steps, dtype=numpy.int64)
+        senders = numpy.empty(steps, dtype=numpy.int64)
+        current = self.latest
+        for t in range(steps):
+            senders[t] = current
+            chosen[t] = self._choose(numpy.array([current]),
+                                     draws[t:t + 1])[0]
+            current = self.agent_slots[chosen[t]]
+        receivers = self.agent_slots[chosen]
+
+        # Every sender transmits all of its infos, and new infos are
+        # referred to by negative numbers until they have ids.
+        infos = dict((slot, list(self.infos[slot])) for slot in
+                     set(senders.tolist()) | set(receivers.tolist()))
+        sent = []
+        for t, sender, receiver in zip(range(steps), senders.tolist(),
+                                       receivers.tolist()):
+            for info in list(infos[sender]):
+                sent.append((t, info))
+                infos[receiver].append((-len(sent), info[1], info[2]))
+
+        session = object_session(self.network)
+        info_ids = numpy.array(_reserve_ids(session, Info, len(sent)),
+                               dtype=numpy.int64)
+
+        def real(id):
+            return int(info_ids[-id - 1]) if id < 0 else id
+
+        step = numpy.array([t for t, _ in sent], dtype=numpy.int64)
+        rows = self._rows(
+            step, self._times(steps), self.node_ids[receivers[step]],
+            info_ids, numpy.array([real(info[0]) for _, info in sent],
+                                  dtype=numpy.int64),
+            [info[1] for _, info in sent], [info[2] for _, info in sent],
+            self.agent_vectors[chosen[step]], self.node_ids[senders[step]])
+        self._write(*rows)
+
+        for slot, slot_infos in infos.items():
+            self.infos[slot] = [(real(id), contents, info_type)
+                                for id, contents, info_type in slot_infos]
+        self.latest = int(receivers[-1])
@@ -4,14 +4,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from cached_property import cached_property
-from collections import Counter
 from contextlib import contextmanager
 from functools import wraps
 import datetime
 import inspect
+import json
 from importlib import import_module
 import logging
-from operator import itemgetter
 import os
 import random
 import requests
@@ -21,7 +20,9 @@ import uuid
 
 from sqlalchemy import and_
 from sqlalchemy import create_engine
+from sqlalchemy import exists
 from sqlalchemy import func
+from sqlalchemy.sql.expression import false
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from dallinger import recruiters
@@ -33,7 +34,7 @@ from dallinger.data import is_registered
 from dallinger.data import load as data_load
 from dallinger.data import find_experiment_export
 from dallinger.data import ingest_zip
-from dallinger.db import init_db, db_url
+from dallinger.db import init_db, db_url, queue_message
 from dallinger.models import Network, Node, Info, Transformation, Participant
 from dallinger.heroku.tools import HerokuApp
 from dallinger.information import Gene, Meme, State
@@ -72,6 +73,9 @@ class Experiment(object):
     # you define a channel, you probably also want to override the send()
     # method, since this is where messages from Redis will be sent.
     channel = None
+    # Push every new transmission to its destination node's websocket channel,
+    # node_<id>, so participants need not poll for the infos they are sent.
+    push_transmissions = False
     exp_config = None
     replay_path = '/'
 
@@ -106,6 +110,13 @@ class Experiment(object):
         #: requested when the experiment first starts. Default is 1.
         self.initial_recruitment_size = 1
 
+        #: string, how :meth:`choose_network` picks among the networks a
+        #: participant can join. Can be "random" (the default),
+        #: "least_filled" (a network with the fewest nodes) or "round_robin"
+        #: (each network in turn, counted in Redis). Practice networks are
+        #: always assigned first, in order.
+        self.network_selection = "random"
+
         #: dictionary, the classes Dallinger can make in response
         #: to front-end requests. Experiments can add new classes to this
         #: dictionary.
@@ -182,9 +193,22 @@ class Experiment(object):
         param raw_message is a string with a channel prefix, for example:
 
             'shopping:{"type":"buy","color":"blue","quantity":"2"}'
+
+        Messages published in binary mode arrive JSON encoded too.
         """
         pass
 
+    def publish(self, channel, message, binary=False):
+        """Send a message to the websocket clients of a channel.
+
+        The message is JSON encoded, or packed with MessagePack if binary is
+        True, and published once the session commits.
+        """
+        if binary:
+            queue_message(channel, message, binary=True)
+        else:
+            queue_message(channel, json.dumps(message))
+
     def setup(self):
         """Create the networks if they don't already exist."""
         if not self.networks():
@@ -234,20 +258,19 @@ class Experiment(object):
         first complete networks with `role="practice"` before doing all other
         networks in a random order.
 
+        The networks are found with one indexed query each time rather than
+        cached, since other transactions fill networks and add participants'
+        nodes concurrently, and a cached list would hand out stale networks.
+
         """
         key = participant.id
-        networks_with_space = Network.query.filter_by(
-            full=False).order_by(Network.id).all()
-        networks_participated_in = [
-            node.network_id for node in
-            Node.query.with_entities(Node.network_id)
-                .filter_by(participant_id=participant.id).all()
-        ]
-
-        legal_networks = [
-            net for net in networks_with_space
-            if net.id not in networks_participated_in
-        ]
+        participated = exists().where(and_(
+            Node.network_id == Network.id,
+            Node.participant_id == participant.id))
+        legal_networks = Network.query\
+            .filter(Network.full == false(), ~participated)\
+            .order_by(Network.role != "practice", Network.id)\
+            .all()
 
         if not legal_networks:
             self.log("No networks available, returning None", key)
@@ -258,10 +281,8 @@ class Experiment(object):
                          (self.practice_repeats + self.experiment_repeats)),
                  key)
 
-        legal_practice_networks = [net for net in legal_networks
-                                   if net.role == "practice"]
-        if legal_practice_networks:
-            chosen_network = legal_practice_networks[0]
+        if legal_networks[0].role == "practice":
+            chosen_network = legal_networks[0]
             self.log("Practice networks available."
                      "Assigning participant to practice network {}."
                      .format(chosen_network.id), key)
@@ -273,7 +294,42 @@ class Experiment(object):
         return chosen_network
 
     def choose_network(self, networks, participant):
-        return random.choice(networks)
+        """Choose a network for a participant from a list of networks.
+
+        The networks are the non-practice networks the participant can join,
+        ordered by id. How the network is chosen depends on
+        :attr:`network_selection`.
+        """
+        if self.network_selection == "random":
+            return random.choice(networks)
+        elif self.network_selection == "least_filled":
+            return self._least_filled_network(networks)
+        elif self.network_selection == "round_robin":
+            return self._round_robin_network(networks)
+        raise ValueError("{} is not a valid network_selection"
+                         .format(self.network_selection))
+
+    def _least_filled_network(self, networks):
+        """One of the networks with the fewest not-failed nodes.
+
+        Ties are broken at random, so that concurrent participants are not
+        all sent to the same network.
+        """
+        sizes = dict(Node.query
+                     .with_entities(Node.network_id, func.count(Node.id))
+                     .filter(Node.network_id.in_([net.id for net in networks]),
+                             Node.failed == false())
+                     .group_by(Node.network_id)
+                     .all())
+        smallest = min(sizes.get(net.id, 0) for net in networks)
+        return random.choice([net for net in networks
+                              if sizes.get(net.id, 0) == smallest])
+
+    def _round_robin_network(self, networks):
+        """The next network in turn, using a counter shared through Redis."""
+        from dallinger.heroku.worker import conn
+        turn = conn.incr("dallinger:network_selection:round_robin")
+        return networks[(turn - 1) % len(networks)]
 
     def create_node(self, participant, network):
         """Create a node for a participant."""
@@ -355,10 +411,12 @@ class Experiment(object):
 
     def log_summary(self):
         """Log a summary of all the participants' status codes."""
-        participants = Participant.query\
-            .with_entities(Participant.status).all()
-        counts = Counter([p.status for p in participants])
-        sorted_counts = sorted(counts.items(), key=itemgetter(0))
+        counts = Participant.query\
+            .with_entities(Participant.status, func.count(Participant.id))\
+            .group_by(Participant.status)\
+            .all()
+        # Postgres sorts the status enum by declaration, not alphabetically
+        sorted_counts = sorted(tuple(count) for count in counts)
         self.log("Status summary: {}".format(str(sorted_counts)))
         return sorted_counts
 
@@ -8,12 +8,14 @@ from json import loads
 from operator import attrgetter
 import os
 import re
+import six
 import sys
 import user_agents
 
 from flask import (
     abort,
     Flask,
+    g,
     make_response,
     render_template,
     request,
@@ -27,6 +29,7 @@ from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy import exc
 from sqlalchemy import func
 from sqlalchemy.sql.expression import true
+from werkzeug.exceptions import HTTPException
 
 from dallinger import db
 from dallinger import experiment
@@ -41,7 +44,9 @@ from dallinger.heroku.messages import HITSummary
 
 from .replay import ReplayBackend
 from .worker_events import WorkerEvent
+from .utils import cached
 from .utils import nocache
+from .utils import response_cache
 
 # Initialize the Dallinger database.
 session = db.session
@@ -104,9 +109,34 @@ def _config():
     return config
 
 
+_experiment = None
+
+
 def Experiment(args):
-    klass = experiment.load()
-    return klass(args)
+    """The experiment of this process, bound to the session args.
+
+    The experiment class is loaded and instantiated on the first call only.
+    Later calls, from any request or job, reuse that instance and just bind
+    it to the given session, so experiments should not keep per-request
+    state on ``self``. Call :func:`reset_experiment` to discard it.
+    """
+    global _experiment
+    if _experiment is None:
+        klass = experiment.load()
+        _experiment = klass(args)
+        models.Transmission.push = _experiment.push_transmissions
+    else:
+        _experiment.session = args
+    return _experiment
+
+
+def reset_experiment():
+    """Discard the experiment instance, so the next request loads it anew."""
+    global _experiment
+    _experiment = None
+    models.Transmission.push = False
+    # Cached pages are rendered with the experiment
+    response_cache.clear()
 
 
 """Load the experiment's extra routes, if any."""
@@ -275,6 +305,9 @@ def handle_exp_error(exception):
 @app.teardown_request
 def shutdown_session(_=None):
     """Rollback and close session at end of a request."""
+    if g.get('batch'):
+        # The operations of a batch share the session of the batch request
+        return
     session.remove()
     db.logger.debug('Closing Dallinger DB session at flask request end')
 
@@ -590,6 +623,7 @@ def advertisement():
 
 
 @app.route('/summary', methods=['GET'])
+@cached
 def summary():
     """Summarize the participants' status codes."""
     exp = Experiment(session)
@@ -598,28 +632,26 @@ def summary():
         "summary": exp.log_summary(),
         "completed": exp.is_complete(),
     }
-    unfilled_nets = models.Network.query.filter(
-        models.Network.full != true()
-    ).with_entities(models.Network.id, models.Network.max_size).all()
+    node_counts = session.query(
+        models.Node.network_id,
+        func.count(models.Node.id).label('count'),
+    ).filter_by(failed=False).group_by(models.Node.network_id).subquery()
+    unfilled_nets, required_nodes, node_count = session.query(
+        func.count(models.Network.id),
+        func.coalesce(func.sum(models.Network.max_size), 0),
+        func.coalesce(func.sum(node_counts.c.count), 0),
+    ).outerjoin(
+        node_counts, node_counts.c.network_id == models.Network.id
+    ).filter(models.Network.full != true()).one()
     working = models.Participant.query.filter_by(
         status='working'
     ).with_entities(func.count(models.Participant.id)).scalar()
-    state['unfilled_networks'] = len(unfilled_nets)
-    nodes_remaining = 0
-    required_nodes = 0
+    state['unfilled_networks'] = unfilled_nets
     if state['unfilled_networks'] == 0:
         if working == 0 and state['completed'] is None:
             state['completed'] = True
-    else:
-        for net in unfilled_nets:
-            node_count = models.Node.query.filter_by(
-                network_id=net.id, failed=False,
-            ).with_entities(func.count(models.Node.id)).scalar()
-            net_size = net.max_size
-            required_nodes += net_size
-            nodes_remaining += net_size - node_count
-    state['nodes_remaining'] = nodes_remaining
-    state['required_nodes'] = required_nodes
+    state['nodes_remaining'] = int(required_nodes - node_count)
+    state['required_nodes'] = int(required_nodes)
 
     if state['completed'] is None:
         state['completed'] = False
@@ -631,8 +663,21 @@ def summary():
     )
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Report the serialization conflicts seen by this server process.
+
+    This is public, like /summary, as it holds no participant data.
+    """
+    return success_response(
+        pid=os.getpid(),
+        serialized=db.metrics.snapshot(),
+    )
+
+
 @app.route('/experiment_property/<prop>', methods=['GET'])
 @app.route('/experiment/<prop>', methods=['GET'])
+@cached
 def experiment_property(prop):
     """Get a property of the experiment by name."""
     exp = Experiment(session)
@@ -644,6 +689,7 @@ def experiment_property(prop):
 
 
 @app.route("/<page>", methods=["GET"])
+@cached
 def get_page(page):
     """Return the requested page."""
     try:
@@ -659,6 +705,7 @@ def get_page_from_directory(directory, page):
 
 
 @app.route("/consent")
+@cached
 def consent():
     """Return the consent form. Here for backwards-compatibility with 2.x."""
     config = _config()
@@ -732,12 +779,85 @@ def request_parameter(parameter, parameter_type=None, default=None,
             msg = "{} {} request, non-boolean {}: {}".format(
                 request.url, request.method, parameter, value)
             return error_response(error_type=msg)
+    elif parameter_type == "datetime":
+        # if its a datetime, parse it as the ISO format dates are sent in
+        for date_format in ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        msg = "{} {} request, non-datetime {}: {}".format(
+            request.url, request.method, parameter, value)
+        return error_response(error_type=msg)
     else:
         msg = "/{} {} request, unknown parameter type: {} for parameter {}"\
             .format(request.url, request.method, parameter_type, parameter)
         return error_response(error_type=msg)
 
 
+def request_parameter_list(parameter):
+    """Get all the values of a parameter that may be passed several times.
+
+    Both ``parameter`` and ``parameter[]`` are accepted, the latter being
+    how arrays are serialized by the javascript helpers.
+    """
+    return (request.values.getlist(parameter) +
+            request.values.getlist(parameter + "[]"))
+
+
+def request_page():
+    """Get the after_id, since and limit parameters of a request.
+
+    These ask for a page of the rows a GET route would return: those after
+    after_id, usually their id, that changed after since, up to limit of
+    them. Return a dict of the parameters that were passed, to be passed on
+    to the model, or an error Response if one of them is invalid.
+    """
+    page = {}
+    for parameter, parameter_type in [("after_id", "int"),
+                                      ("since", "datetime"),
+                                      ("limit", "int")]:
+        value = request_parameter(parameter=parameter,
+                                  parameter_type=parameter_type,
+                                  optional=True)
+        if type(value) == Response:
+            return value
+        if value is not None:
+            page[parameter] = value
+
+    if page.get("limit", 1) < 1:
+        msg = "{} {} request, non-positive limit: {}".format(
+            request.url, request.method, page["limit"])
+        return error_response(error_type=msg)
+    return page
+
+
+def page_cursor(page, rows):
+    """Get the cursor to send back with a page of rows.
+
+    next_after_id is the after_id that fetches the following page, or the
+    rows created after this request, as set on the models.Page of rows.
+    Nothing is sent back if no page was asked for.
+    """
+    if not page:
+        return {}
+    return {"next_after_id": rows.next_after_id}
+
+
+def request_properties():
+    """Get the properties passed in a request as a dict.
+
+    Only the properties that were given a value are included.
+    """
+    properties = {}
+    for p in range(5):
+        property_name = "property" + str(p + 1)
+        property = request_parameter(parameter=property_name, optional=True)
+        if property:
+            properties[property_name] = property
+    return properties
+
+
 def assign_properties(thing):
     """Assign properties to an object.
 
@@ -870,6 +990,7 @@ def get_participant(participant_id):
 
 
 @app.route("/network/<network_id>", methods=["GET"])
+@cached
 def get_network(network_id):
     """Get the network with the given id."""
     try:
@@ -952,7 +1073,8 @@ def node_neighbors(node_id):
     failed = request_parameter(parameter="failed",
                                parameter_type="bool",
                                optional=True)
-    for x in [node_type, connection]:
+    page = request_page()
+    for x in [node_type, connection, page]:
         if type(x) == Response:
             return x
 
@@ -974,7 +1096,12 @@ def node_neighbors(node_id):
             return error_response(error_type='node.neighbors', error_text=str(e))
 
     else:
-        nodes = node.neighbors(type=node_type, direction=connection)
+        try:
+            nodes = node.neighbors(type=node_type, direction=connection,
+                                   **page)
+        except ValueError as e:
+            return error_response(error_type='node.neighbors',
+                                  error_text=str(e))
         try:
             # ping the experiment
             exp.node_get_request(
@@ -984,7 +1111,8 @@ def node_neighbors(node_id):
         except Exception:
             return error_response(error_type="exp.node_get_request")
 
-    return success_response(nodes=[n.__json__() for n in nodes])
+    return success_response(nodes=[n.__json__() for n in nodes],
+                            **page_cursor(page, nodes))
 
 
 @app.route("/node/<participant_id>", methods=["POST"])
@@ -1035,14 +1163,15 @@ def node_vectors(node_id):
 
     You must specify the node id in the url.
     You can pass direction (incoming/outgoing/all) and failed
-    (True/False/all).
+    (True/False/all), and after_id, since and limit to get a page of them.
     """
     exp = Experiment(session)
     # get the parameters
     direction = request_parameter(parameter="direction", default="all")
     failed = request_parameter(parameter="failed",
                                parameter_type="bool", default=False)
-    for x in [direction, failed]:
+    page = request_page()
+    for x in [direction, failed, page]:
         if type(x) == Response:
             return x
 
@@ -1052,7 +1181,7 @@ def node_vectors(node_id):
         return error_response(error_type="/node/vectors, node does not exist")
 
     try:
-        vectors = node.vectors(direction=direction, failed=failed)
+        vectors = node.vectors(direction=direction, failed=failed, **page)
         exp.vector_get_request(node=node, vectors=vectors)
         session.commit()
     except Exception:
@@ -1061,7 +1190,8 @@ def node_vectors(node_id):
                               participant=node.participant)
 
     # return the data
-    return success_response(vectors=[v.__json__() for v in vectors])
+    return success_response(vectors=[v.__json__() for v in vectors],
+                            **page_cursor(page, vectors))
 
 
 @app.route("/node/<int:node_id>/connect/<int:other_node_id>",
@@ -1154,7 +1284,8 @@ def node_infos(node_id):
     """Get all the infos of a node.
 
     The node id must be specified in the url.
-    You can also pass info_type.
+    You can also pass info_type, and after_id, since and limit to get a
+    page of them.
     """
     exp = Experiment(session)
 
@@ -1162,8 +1293,10 @@ def node_infos(node_id):
     info_type = request_parameter(parameter="info_type",
                                   parameter_type="known_class",
                                   default=models.Info)
-    if type(info_type) == Response:
-        return info_type
+    page = request_page()
+    for x in [info_type, page]:
+        if type(x) == Response:
+            return x
 
     # check the node exists
     node = models.Node.query.get(node_id)
@@ -1172,7 +1305,7 @@ def node_infos(node_id):
 
     try:
         # execute the request:
-        infos = node.infos(type=info_type)
+        infos = node.infos(type=info_type, **page)
 
         # ping the experiment
         exp.info_get_request(
@@ -1185,7 +1318,8 @@ def node_infos(node_id):
                               status=403,
                               participant=node.participant)
 
-    return success_response(infos=[i.__json__() for i in infos])
+    return success_response(infos=[i.__json__() for i in infos],
+                            **page_cursor(page, infos))
 
 
 @app.route("/node/<int:node_id>/received_infos", methods=["GET"])
@@ -1193,7 +1327,8 @@ def node_received_infos(node_id):
     """Get all the infos a node has been sent and has received.
 
     You must specify the node id in the url.
-    You can also pass the info type.
+    You can also pass the info type, and after_id, since and limit to get a
+    page of them.
     """
     exp = Experiment(session)
 
@@ -1201,8 +1336,10 @@ def node_received_infos(node_id):
     info_type = request_parameter(parameter="info_type",
                                   parameter_type="known_class",
                                   default=models.Info)
-    if type(info_type) == Response:
-        return info_type
+    page = request_page()
+    for x in [info_type, page]:
+        if type(x) == Response:
+            return x
 
     # check the node exists
     node = models.Node.query.get(node_id)
@@ -1212,7 +1349,7 @@ def node_received_infos(node_id):
         )
 
     # execute the request:
-    infos = node.received_infos(type=info_type)
+    infos = node.received_infos(type=info_type, **page)
 
     try:
         # ping the experiment
@@ -1226,7 +1363,8 @@ def node_received_infos(node_id):
                               status=403,
                               participant=node.participant)
 
-    return success_response(infos=[i.__json__() for i in infos])
+    return success_response(infos=[i.__json__() for i in infos],
+                            **page_cursor(page, infos))
 
 
 @app.route("/tracking_event/<int:node_id>", methods=["POST"])
@@ -1307,14 +1445,15 @@ def node_transmissions(node_id):
 
     The node id must be specified in the url.
     You can also pass direction (to/from/all) or status (all/pending/received)
-    as arguments.
+    as arguments, and after_id, since and limit to get a page of them.
     """
     exp = Experiment(session)
 
     # get the parameters
     direction = request_parameter(parameter="direction", default="incoming")
     status = request_parameter(parameter="status", default="all")
-    for x in [direction, status]:
+    page = request_page()
+    for x in [direction, status, page]:
         if type(x) == Response:
             return x
 
@@ -1325,7 +1464,8 @@ def node_transmissions(node_id):
             error_type="/node/transmissions, node does not exist")
 
     # execute the request
-    transmissions = node.transmissions(direction=direction, status=status)
+    transmissions = node.transmissions(direction=direction, status=status,
+                                       **page)
 
     try:
         if direction in ["incoming", "all"] and status in ["pending", "all"]:
@@ -1341,7 +1481,8 @@ def node_transmissions(node_id):
             participant=node.participant)
 
     # return the data
-    return success_response(transmissions=[t.__json__() for t in transmissions])
+    return success_response(transmissions=[t.__json__() for t in transmissions],
+                            **page_cursor(page, transmissions))
 
 
 @app.route("/node/<int:node_id>/transmit", methods=["POST"])
@@ -1359,7 +1500,10 @@ def node_transmit(node_id):
     'Info' or 'Agent'). Passing an int will get that info/node, passing
     a class name will pass the class. Note that if the class you are specifying
     is a custom class it will need to be added to the dictionary of
-    known_classes in your experiment code.
+    known_classes in your experiment code. what and to_whom can also be
+    passed several times (or as arrays) to send many infos to many nodes.
+    The transmissions are created with node.transmit_many() unless the node
+    overrides transmit().
 
     You may also pass the values property1, property2, property3, property4
     and property5. If passed this will fill in the relevant values of the
@@ -1377,25 +1521,26 @@ def node_transmit(node_id):
     });
     """
     exp = Experiment(session)
-    what = request_parameter(parameter="what", optional=True)
-    to_whom = request_parameter(parameter="to_whom", optional=True)
+    whats = request_parameter_list(parameter="what")
+    to_whoms = request_parameter_list(parameter="to_whom")
 
     # check the node exists
     node = models.Node.query.get(node_id)
     if node is None:
         return error_response(error_type="/node/transmit, node does not exist")
+
     # create what
-    if what is not None:
+    for index, what in enumerate(whats):
         try:
             what = int(what)
-            what = models.Info.query.get(what)
-            if what is None:
+            whats[index] = models.Info.query.get(what)
+            if whats[index] is None:
                 return error_response(
                     error_type="/node/transmit POST, info does not exist",
                     participant=node.participant)
         except Exception:
             try:
-                what = exp.known_classes[what]
+                whats[index] = exp.known_classes[what]
             except KeyError:
                 msg = '/node/transmit POST, {} not in experiment.known_classes'
                 return error_response(
@@ -1403,28 +1548,37 @@ def node_transmit(node_id):
                     participant=node.participant)
 
     # create to_whom
-    if to_whom is not None:
+    for index, to_whom in enumerate(to_whoms):
         try:
             to_whom = int(to_whom)
-            to_whom = models.Node.query.get(to_whom)
-            if to_whom is None:
+            to_whoms[index] = models.Node.query.get(to_whom)
+            if to_whoms[index] is None:
                 return error_response(
                     error_type="/node/transmit POST, recipient Node does not exist",
                     participant=node.participant)
         except Exception:
             try:
-                to_whom = exp.known_classes[to_whom]
+                to_whoms[index] = exp.known_classes[to_whom]
             except KeyError:
                 msg = '/node/transmit POST, {} not in experiment.known_classes'
                 return error_response(
                     error_type=msg.format(to_whom),
                     participant=node.participant)
 
+    what = whats if len(whats) > 1 else (whats or [None])[0]
+    to_whom = to_whoms if len(to_whoms) > 1 else (to_whoms or [None])[0]
+
     # execute the request
     try:
-        transmissions = node.transmit(what=what, to_whom=to_whom)
-        for t in transmissions:
-            assign_properties(t)
+        transmit = six.get_unbound_function(type(node).transmit)
+        if transmit is six.get_unbound_function(models.Node.transmit):
+            transmissions = node.transmit_many(
+                what=what, to_whom=to_whom, properties=request_properties())
+        else:
+            # respect experiments that customise transmit()
+            transmissions = node.transmit(what=what, to_whom=to_whom)
+            for t in transmissions:
+                assign_properties(t)
         session.commit()
         # ping the experiment
         exp.transmission_post_request(
@@ -1541,6 +1695,137 @@ def transformation_post(node_id, info_in_id, info_out_id):
     return success_response(transformation=transformation.__json__())
 
 
+#: The endpoints of the routes that can be requested in a batch.
+BATCH_ROUTES = {
+    "connect",
+    "create_node",
+    "create_question",
+    "get_info",
+    "get_network",
+    "get_participant",
+    "info_post",
+    "node_infos",
+    "node_neighbors",
+    "node_received_infos",
+    "node_transmissions",
+    "node_transmit",
+    "node_vectors",
+    "transformation_get",
+    "transformation_post",
+}
+
+
+@app.route("/batch", methods=["POST"])
+@db.serialized
+def batch():
+    """Run several requests to the experiment's routes in one transaction.
+
+    ``operations`` must be a JSON list of requests, each an object with the
+    ``method`` ("GET" or "POST"), ``route`` and, optionally, ``data`` of a
+    request to one of the :data:`BATCH_ROUTES`. They are run in order, and
+    a route can refer to values in the responses of earlier operations as
+    fields like ``{0[node][id]}``, e.g. ``/node/{0[node][id]}/infos``,
+    where 0 is the index of the operation. Returns the
+    ``status_code`` and ``response`` of each operation as ``results``. If
+    an operation fails, the later ones are not run and the whole batch is
+    rolled back.
+    """
+    operations = request_parameter(parameter="operations")
+    if type(operations) == Response:
+        return operations
+    try:
+        operations = loads(operations)
+    except ValueError:
+        operations = None
+    if not isinstance(operations, list):
+        return error_response(error_type="/batch, operations is not a list")
+
+    adapter = app.create_url_adapter(request)
+    results = []
+    g.batch = True
+    try:
+        with db.single_transaction():
+            for operation in operations:
+                result = _batch_operation(
+                    adapter, operation, [r["response"] for r in results])
+                results.append(result)
+                if result["status_code"] != 200:
+                    session.rollback()
+                    return Response(
+                        dumps({"status": "error", "results": results}),
+                        status=400, mimetype='application/json')
+    finally:
+        g.batch = False
+
+    return success_response(results=results)
+
+
+#: A field of a batched route, such as {0[node][id]}.
+BATCH_FIELD = re.compile(r"{(\d+)((?:\[[^\[\]{}]+\])+)}")
+
+
+def _batch_route(route, responses):
+    """Fill in the fields of a batched route from the earlier responses.
+
+    A field is the index of a response followed by keys, and is replaced by
+    the value found by looking each key up in turn, where keys made of
+    digits index lists. Raises a ValueError if the route has braces that
+    are not part of a field, or if a field does not refer to a single
+    value, and a LookupError if a response or key does not exist.
+    """
+    if re.search(r"[{}]", BATCH_FIELD.sub("", route)):
+        raise ValueError("Invalid field in {}".format(route))
+
+    def value(match):
+        found = responses[int(match.group(1))]
+        for key in re.findall(r"\[([^\]]+)\]", match.group(2)):
+            if isinstance(found, list) and key.isdigit():
+                key = int(key)
+            elif not isinstance(found, dict):
+                raise ValueError("Cannot look up {} in {}".format(key, route))
+            found = found[key]
+        if isinstance(found, (dict, list)):
+            raise ValueError("{} refers to more than a value".format(route))
+        return six.text_type(found)
+
+    return BATCH_FIELD.sub(value, route)
+
+
+def _batch_operation(adapter, operation, responses):
+    """Run one operation of a batch, returning its status code and data."""
+    def failure(status_code, message):
+        return {"status_code": status_code,
+                "response": {"status": "error", "message": message}}
+
+    if not isinstance(operation, dict) or "route" not in operation:
+        return failure(400, "An operation needs a route")
+    method = operation.get("method", "GET").upper()
+    data = operation.get("data") or {}
+    try:
+        route = _batch_route(operation["route"], responses)
+        endpoint, args = adapter.match(route, method=method)
+    except (LookupError, TypeError, ValueError):
+        return failure(400, "Invalid route {}".format(operation["route"]))
+    except HTTPException as e:
+        return failure(e.code, "{} {}: {}".format(method, route, e.name))
+    if endpoint not in BATCH_ROUTES:
+        return failure(403, "{} cannot be batched".format(route))
+
+    if method == "GET":
+        request_data = {"query_string": data}
+    else:
+        request_data = {"data": data}
+    with app.test_request_context(route, method=method, **request_data):
+        try:
+            response = app.view_functions[endpoint](**args)
+        except Exception:
+            db.logger.exception("Error in batched {} {}".format(method, route))
+            return failure(500, "{} {} failed".format(method, route))
+
+    return {"status_code": response.status_code,
+            "response": loads(response.get_data(as_text=True))}
+
+
 @app.route("/notifications", methods=["POST", "GET"])
 @crossdomain(origin='*')
 def api_notifications():
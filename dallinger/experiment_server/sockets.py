@@ -3,19 +3,52 @@
 
 from __future__ import unicode_literals
 from .experiment_server import app
+from ..db import BINARY_MARKER
 from ..heroku.worker import conn
 from gevent.lock import Semaphore
+from gevent.queue import Full
+from gevent.queue import Queue
 from flask import request
 from flask_sockets import Sockets
 from redis import ConnectionError
+import base64
 import gevent
+import json
 import os
 import six
 import socket
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 sockets = Sockets(app)
 
+# Clients that have been idle for HEARTBEAT_DELAY seconds are pinged, so that
+# Heroku won't close their connection. Idle clients are looked for every
+# HEARTBEAT_TICK seconds and pinged HEARTBEAT_BATCH at a time.
 HEARTBEAT_DELAY = 30
+HEARTBEAT_TICK = 1
+HEARTBEAT_BATCH = 100
+# How many messages may wait to be sent to a websocket client, and what to do
+# with a client that falls this far behind: 'drop' or 'disconnect'.
+SEND_QUEUE_SIZE = 100
+# The longest a coalescing websocket client may ask for its messages to be
+# held back, in seconds.
+MAX_LAG_TOLERANCE_SECS = 1.0
+SLOW_CLIENT_POLICY = 'drop'
+SLOW_CLIENT_POLICIES = ('drop', 'disconnect')
+# How many messages per second a websocket client may publish on average, and
+# how many it may send in a burst. At most INBOUND_QUEUE_SIZE messages from a
+# client wait to be published before the server stops reading from it.
+INBOUND_RATE = 50
+INBOUND_BURST = 100
+INBOUND_QUEUE_SIZE = 100
+# How many seconds to wait before resubscribing when the connection to redis
+# is lost.
+REDIS_RETRY_DELAY = 1
 
 
 def log(msg, level='info'):
@@ -26,18 +59,17 @@ def log(msg, level='info'):
 
 
 class Channel(object):
-    """A channel relays messages from a redis pubsub to multiple clients.
-
-    Creating a channel spawns a greenlet which listens for messages from redis
-    on the specified channel name.
+    """A channel relays messages from redis to multiple clients.
 
-    When a message is received, it is relayed to all clients that have subscribed.
+    When a message is received, it is queued for all clients that have
+    subscribed, framed as text or binary as each client asked. Subscribers
+    without a send queue, such as experiments and bots, get text and handle
+    each message in its own greenlet.
     """
 
     def __init__(self, name):
         self.name = name
         self.clients = []
-        self.greenlet = None
 
     def subscribe(self, client):
         """Subscribe a client to the channel."""
@@ -50,72 +82,291 @@ class Channel(object):
             self.clients.remove(client)
             log('Unsubscribed client {} from channel {}'.format(client, self.name))
 
-    def listen(self):
-        """Relay messages from a redis pubsub to all subscribed clients.
+    def relay(self, data):
+        """Relay a message from redis to all subscribed clients.
 
-        This is run continuously in a separate greenlet.
+        A message that cannot be framed for some clients, or queued for a
+        client, is logged and skipped for them.
         """
-        pubsub = conn.pubsub()
-        name = self.name
-        if isinstance(name, six.text_type):
-            name = name.encode('utf-8')
+        frames = {}
+        for client in list(self.clients):
+            binary = bool(getattr(client, 'binary', False))
+            if binary not in frames:
+                frames[binary] = self.frame(data, binary)
+            if frames[binary] is None:
+                continue
+            try:
+                enqueue = getattr(client, 'enqueue', None)
+                if enqueue is None:
+                    gevent.spawn(client.send, frames[binary])
+                else:
+                    enqueue(frames[binary])
+            except Exception:
+                app.logger.exception('Could not relay a message on {} to {}'
+                                     .format(self.name, client))
+
+    def frame(self, data, binary):
+        """Frame a message from redis, or return None if it is malformed."""
         try:
-            pubsub.subscribe([name])
-        except ConnectionError:
-            app.logger.exception('Could not connect to redis.')
-        log('Listening on channel {}'.format(self.name))
-        for message in pubsub.listen():
-            data = message.get('data')
-            if message['type'] == 'message' and data != 'None':
-                channel = message['channel']
-                payload = '{}:{}'.format(
-                    channel.decode('utf-8'), data.decode('utf-8')
-                )
-                for client in self.clients:
-                    gevent.spawn(client.send, payload)
-            gevent.sleep(0.001)
-
-    def start(self):
-        """Start relaying messages."""
-        self.greenlet = gevent.spawn(self.listen)
+            if binary:
+                return binary_frame(self.name, data)
+            return text_frame(self.name, data)
+        except ValueError:
+            app.logger.exception(
+                'Could not frame a message on {}'.format(self.name))
 
-    def stop(self):
-        """Stop relaying messages."""
-        if self.greenlet:
-            self.greenlet.kill()
-            self.greenlet = None
+
+def _base64(value):
+    """Encode the bytes in a binary message as base64 text for JSON."""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError("{!r} cannot be converted to JSON".format(value))
+
+
+def _unpack(data):
+    """Unpack a MessagePack object, raising a ValueError if it is invalid.
+
+    msgpack raises various exceptions for invalid data, not all of them
+    subclasses of msgpack.UnpackException, so any exception is caught.
+    """
+    if msgpack is None:
+        raise ValueError("Binary messages need msgpack to be installed.")
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError("Invalid MessagePack data: {}".format(e))
+
+
+def text_frame(channel_name, data):
+    """Frame a message from redis as ``channel:data`` text.
+
+    Binary messages are converted to JSON, with their binary values as
+    base64 strings. Raises a ValueError for a message that cannot be.
+    """
+    if data.startswith(BINARY_MARKER):
+        try:
+            data = json.dumps(_unpack(data[1:]), default=_base64)
+        except TypeError as e:
+            raise ValueError(
+                "Binary message cannot be converted to JSON: {}".format(e))
+    else:
+        data = data.decode('utf-8')
+    return '{}:{}'.format(channel_name, data)
+
+
+def binary_frame(channel_name, data):
+    """Frame a message from redis as a MessagePack [channel, data] array.
+
+    Binary messages are framed without unpacking them, and text messages
+    are framed as a string.
+    """
+    if data.startswith(BINARY_MARKER):
+        return b'\x92' + msgpack.packb(channel_name) + data[1:]
+    return msgpack.packb([channel_name, data.decode('utf-8')])
+
+
+def split_frame(frame):
+    """Split a frame from a client into a channel name and redis message.
+
+    Binary frames are MessagePack [channel, data] arrays, whose data is
+    checked and then published as is, with ``BINARY_MARKER`` in front.
+    Raises a ValueError for a malformed frame.
+    """
+    if isinstance(frame, six.text_type) or frame[:1] != b'\x92':
+        if not isinstance(frame, six.text_type):
+            frame = frame.decode('utf-8')
+        channel_name, data = frame.split(':', 1)
+        return channel_name, data
+    if msgpack is None:
+        raise ValueError("Binary frames need msgpack to be installed.")
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(frame)
+    unpacker.read_array_header()
+    try:
+        channel_name = unpacker.unpack()
+    except Exception:
+        channel_name = None
+    if (not isinstance(channel_name, six.text_type) or
+            unpacker.tell() == len(frame)):
+        raise ValueError("A binary frame must be a [channel, data] array.")
+    data = bytes(frame[unpacker.tell():])
+    _unpack(data)
+    return channel_name, BINARY_MARKER + data
 
 
 class ChatBackend(object):
-    """Manages subscriptions of clients to multiple channels."""
+    """Manages subscriptions of clients to multiple channels.
+
+    All the channels share a single redis pubsub connection, which is read
+    by one greenlet for as long as any channel has subscribers. A channel
+    is closed when its last client unsubscribes. If the connection to redis
+    is lost, a new pubsub is subscribed to all the open channels.
+    """
 
     def __init__(self):
         self.channels = {}
+        self.pubsub = None
+        self.greenlet = None
 
     def subscribe(self, client, channel_name):
         """Register a new client to receive messages on a channel."""
         if channel_name not in self.channels:
-            self.channels[channel_name] = channel = Channel(channel_name)
-            channel.start()
+            self.channels[channel_name] = Channel(channel_name)
+            self.open(channel_name)
 
         self.channels[channel_name].subscribe(client)
 
     def unsubscribe(self, client):
         """Unsubscribe a client from all channels."""
-        for channel in self.channels.values():
+        for channel in list(self.channels.values()):
             channel.unsubscribe(client)
+            if not channel.clients:
+                self.close(channel.name)
+
+    def open(self, channel_name):
+        """Subscribe the shared pubsub to a channel and start listening."""
+        if self.pubsub is None:
+            self.pubsub = conn.pubsub()
+        try:
+            self.pubsub.subscribe([_encode(channel_name)])
+        except ConnectionError:
+            app.logger.exception('Could not connect to redis.')
+        log('Listening on channel {}'.format(channel_name))
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.listen)
+
+    def close(self, channel_name):
+        """Stop listening to a channel that has no clients left."""
+        self.channels.pop(channel_name, None)
+        if self.pubsub is None:
+            return
+        try:
+            self.pubsub.unsubscribe([_encode(channel_name)])
+        except ConnectionError:
+            app.logger.exception('Could not connect to redis.')
+        log('Stopped listening on channel {}'.format(channel_name))
+
+    def listen(self):
+        """Relay messages from the redis pubsub to the subscribed channels.
+
+        This is run in a separate greenlet, which ends when the pubsub is no
+        longer subscribed to any channel.
+        """
+        reconnect = False
+        while True:
+            try:
+                if reconnect:
+                    self.resubscribe()
+                for message in self.pubsub.listen():
+                    self.dispatch(message)
+                return
+            except ConnectionError:
+                app.logger.exception('Lost the connection to redis.')
+                gevent.sleep(REDIS_RETRY_DELAY)
+                reconnect = True
+
+    def resubscribe(self):
+        """Replace the pubsub with a new one subscribed to every channel."""
+        pubsub, self.pubsub = self.pubsub, conn.pubsub()
+        pubsub.close()
+        if self.channels:
+            self.pubsub.subscribe([_encode(name) for name in self.channels])
+        log('Resubscribed to {} channels'.format(len(self.channels)))
+
+    def dispatch(self, message):
+        """Relay a message from the pubsub to the channel it was sent on."""
+        try:
+            data = message.get('data')
+            if message['type'] == 'message' and data != 'None':
+                channel_name = message['channel'].decode('utf-8')
+                channel = self.channels.get(channel_name)
+                if channel is not None:
+                    channel.relay(data)
+        except Exception:
+            app.logger.exception(
+                'Could not relay a message from redis: {}'.format(message))
+
+    def stop(self):
+        """Stop relaying messages."""
+        if self.greenlet:
+            self.greenlet.kill()
+            self.greenlet = None
+
+
+def _encode(channel_name):
+    if isinstance(channel_name, six.text_type):
+        return channel_name.encode('utf-8')
+    return channel_name
 
 
 # There is one chat backend per process.
 chat_backend = ChatBackend()
 
 
+class TokenBucket(object):
+    """Rate limits events to ``rate`` per second, in bursts of ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self):
+        """Take a token and return how many seconds to wait before using it."""
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
 class Client(object):
-    """Represents a single websocket client."""
+    """Represents a single websocket client.
+
+    Messages relayed to the client wait in a bounded queue, which a single
+    writer greenlet sends to the websocket. When a slow client lets the
+    queue fill up, the ``drop`` policy discards the oldest queued message
+    and the ``disconnect`` policy closes the websocket.
+
+    A client that coalesces messages has each message held back for
+    ``lag_tolerance_secs``, at most ``MAX_LAG_TOLERANCE_SECS``, and then
+    sent in a single frame with the messages queued in the meantime. Every
+    text frame it gets is a JSON array of messages.
+
+    A binary client gets each message as a MessagePack [channel, data]
+    array, and coalesced messages as an array of them.
+
+    Messages from the client are rate limited by a token bucket of
+    ``INBOUND_RATE`` messages per second, and no more are read while
+    ``INBOUND_QUEUE_SIZE`` of them wait to be published.
+    """
 
-    def __init__(self, ws, lag_tolerance_secs=0.1):
+    def __init__(self, ws, lag_tolerance_secs=0.1, queue_size=None,
+                 slow_policy=None, coalesce=False, binary=False):
+        if binary and msgpack is None:
+            raise ImportError(
+                "Binary websocket framing needs msgpack to be installed.")
         self.ws = ws
+        if not 0 <= lag_tolerance_secs <= MAX_LAG_TOLERANCE_SECS:
+            lag_tolerance_secs = (
+                MAX_LAG_TOLERANCE_SECS if lag_tolerance_secs > 0 else 0)
         self.lag_tolerance_secs = lag_tolerance_secs
+        self.coalesce = coalesce
+        self.binary = binary
+        self.slow_policy = slow_policy or SLOW_CLIENT_POLICY
+        if self.slow_policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(
+                "{} is not a valid slow client policy".format(self.slow_policy))
+        self.queue = Queue(maxsize=queue_size or SEND_QUEUE_SIZE)
+        self.writer = None
+        self.closed = False
+        self.inbound = Queue(maxsize=INBOUND_QUEUE_SIZE)
+        self.bucket = TokenBucket(INBOUND_RATE, INBOUND_BURST)
+        self.last_active = time.time()
 
         # This lock is used to make sure that multiple greenlets
         # cannot send to the same socket concurrently.
@@ -123,47 +374,215 @@ class Client(object):
 
     def send(self, message):
         """Send a single message to the websocket."""
-        if isinstance(message, bytes):
+        if isinstance(message, bytes) and not self.binary:
             message = message.decode('utf8')
 
         with self.send_lock:
             try:
                 self.ws.send(message)
             except socket.error:
-                chat_backend.unsubscribe(self)
+                self.close()
+            else:
+                self.last_active = time.time()
             # log('Sent to {}: {}'.format(self, message), level='debug')
 
-    def heartbeat(self):
-        """Send a ping to the websocket periodically.
-
-        This is needed so that Heroku won't close the connection
-        from inactivity.
+    def enqueue(self, message):
+        """Queue a message for the writer greenlet to send."""
+        if self.closed:
+            return
+        if self.writer is None:
+            self.writer = gevent.spawn(self.drain)
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            if self.slow_policy == 'disconnect':
+                log('Disconnecting slow client {}'.format(self), 'warning')
+                self.close()
+                return
+            log('Dropping a message to slow client {}'.format(self), 'warning')
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+
+    def drain(self):
+        """Send queued messages to the websocket.
+
+        This is run in a separate greenlet until the client closes.
         """
-        while not self.ws.closed:
-            gevent.sleep(HEARTBEAT_DELAY)
-            gevent.spawn(self.send, 'ping')
+        while not self.closed:
+            message = self.queue.get()
+            if self.coalesce:
+                gevent.sleep(self.lag_tolerance_secs)
+                messages = [message]
+                while not self.queue.empty():
+                    messages.append(self.queue.get_nowait())
+                message = self.coalesced(messages)
+            self.send(message)
+
+    def coalesced(self, messages):
+        """Put several queued messages in one frame."""
+        if not self.binary:
+            return json.dumps([
+                m.decode('utf8') if isinstance(m, bytes) else m
+                for m in messages
+            ])
+        # Pings are sent as text, and not needed with other messages
+        frames = [m for m in messages if isinstance(m, bytes)]
+        if not frames:
+            return messages[0]
+        if len(frames) == 1:
+            return frames[0]
+        header = msgpack.Packer().pack_array_header(len(frames))
+        return header + b''.join(frames)
+
+    def close(self):
+        """Unsubscribe the client and stop its writer greenlet."""
+        if self.closed:
+            return
+        self.closed = True
+        chat_backend.unsubscribe(self)
+        heartbeat.remove(self)
+        if self.writer is not None:
+            if self.writer is not gevent.getcurrent():
+                self.writer.kill(block=False)
+            self.writer = None
+        if not self.ws.closed:
+            try:
+                self.ws.close()
+            except socket.error:
+                pass
 
     def subscribe(self, channel):
         """Start listening to messages on the specified channel."""
         chat_backend.subscribe(self, channel)
 
     def publish(self):
-        """Relay messages from client to redis."""
-        while not self.ws.closed:
-            # Sleep to prevent *constant* context-switches.
-            gevent.sleep(self.lag_tolerance_secs)
-            message = self.ws.receive()
-            if message is not None:
-                channel_name, data = message.split(':', 1)
-                conn.publish(channel_name, data)
+        """Relay messages from client to redis.
+
+        A client that sends faster than its rate limit is not read from
+        until it is back under the limit.
+        """
+        publisher = gevent.spawn(self.publish_inbound)
+        try:
+            while not self.ws.closed:
+                message = self.ws.receive()
+                if message is not None:
+                    self.last_active = time.time()
+                    self.inbound.put(message)
+                    delay = self.bucket.take()
+                    if delay:
+                        gevent.sleep(delay)
+        finally:
+            self.inbound.put(None)
+            publisher.join()
+
+    def publish_inbound(self):
+        """Publish the messages received from the client to redis.
+
+        The messages received while a publish is under way are sent to
+        redis together in one pipeline. This is run in a separate greenlet
+        until the client closes, and a batch that fails is logged and
+        dropped.
+        """
+        while True:
+            messages = [self.inbound.get()]
+            while not self.inbound.empty():
+                messages.append(self.inbound.get_nowait())
+            try:
+                self.publish_batch([m for m in messages if m is not None])
+            except ConnectionError:
+                app.logger.exception('Could not connect to redis.')
+            except Exception:
+                app.logger.exception(
+                    'Could not publish messages from client {}'.format(self))
+            if messages[-1] is None:
+                return
+
+    def publish_batch(self, messages):
+        """Publish messages received from the client in one pipeline."""
+        pipe = conn.pipeline(transaction=False)
+        for message in messages:
+            try:
+                channel_name, data = split_frame(message)
+            except ValueError:
+                log('Ignoring a malformed message from client {}'.format(
+                    self), 'warning')
+                continue
+            pipe.publish(channel_name, data)
+        pipe.execute()
+
+
+class Heartbeat(object):
+    """Pings the idle websocket clients of a process.
+
+    A single greenlet looks for clients that have neither sent nor received
+    anything for ``HEARTBEAT_DELAY`` seconds and queues a ping for them.
+    Clients whose websocket has closed are closed, which unsubscribes them.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self.greenlet = None
+
+    def add(self, client):
+        """Start pinging a client when it is idle."""
+        self.clients.add(client)
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.run)
+
+    def remove(self, client):
+        """Stop pinging a client."""
+        self.clients.discard(client)
+
+    def run(self):
+        """Ping idle clients for as long as there are any clients.
+
+        This is run in a separate greenlet.
+        """
+        while self.clients:
+            gevent.sleep(HEARTBEAT_TICK)
+            self.tick()
+
+    def tick(self):
+        """Ping the clients that are idle and close the dead ones."""
+        idle_since = time.time() - HEARTBEAT_DELAY
+        due = [c for c in self.clients if c.last_active <= idle_since or
+               c.ws.closed]
+        for start in range(0, len(due), HEARTBEAT_BATCH):
+            for client in due[start:start + HEARTBEAT_BATCH]:
+                if client.ws.closed:
+                    client.close()
+                else:
+                    client.last_active = time.time()
+                    client.enqueue('ping')
+            gevent.sleep(0)
+
+    def stop(self):
+        """Stop pinging clients."""
+        if self.greenlet:
+            self.greenlet.kill()
+            self.greenlet = None
+
+
+# There is one heartbeat per process.
+heartbeat = Heartbeat()
 
 
 @sockets.route('/chat')
 def chat(ws):
     """Relay chat messages to and from clients.
     """
-    lag_tolerance_secs = float(request.args.get('tolerance', 0.1))
-    client = Client(ws, lag_tolerance_secs=lag_tolerance_secs)
-    client.subscribe(request.args.get('channel'))
-    gevent.spawn(client.heartbeat)
-    client.publish()
+    try:
+        lag_tolerance_secs = float(request.args.get('tolerance', 0.1))
+    except ValueError:
+        lag_tolerance_secs = 0.1
+    coalesce = request.args.get('coalesce') in ('1', 'true')
+    binary = request.args.get('binary') in ('1', 'true')
+    client = Client(
+        ws, lag_tolerance_secs=lag_tolerance_secs, coalesce=coalesce,
+        binary=binary)
+    try:
+        client.subscribe(request.args.get('channel'))
+        heartbeat.add(client)
+        client.publish()
+    finally:
+        client.close()
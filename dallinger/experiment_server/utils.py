@@ -1,5 +1,11 @@
+from collections import OrderedDict
 from functools import update_wrapper
-from flask import make_response
+import time
+
+from flask import make_response, request, Response
+
+from dallinger.db import CACHE_GENERATION_KEY
+from dallinger.db import session
 
 
 def nocache(func):
@@ -10,3 +16,86 @@ def nocache(func):
         resp.cache_control.no_cache = True
         return resp
     return update_wrapper(new_func, func)
+
+
+class ResponseCache(object):
+    """A small cache of the responses of this process, by request path.
+
+    An entry is dropped once it is ttl seconds old, or once a commit from
+    any process has changed the database, as counted in redis under
+    :data:`dallinger.db.CACHE_GENERATION_KEY`. Beyond size entries, the
+    least recently used ones are dropped.
+    """
+
+    def __init__(self, ttl=5, size=1000):
+        self.ttl = ttl
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """Forget all the cached responses."""
+        self._entries = OrderedDict()
+
+    def get(self, key, generation):
+        """Get the entry cached for key, if it is still fresh."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry["generation"] != generation or entry["expires"] < time.time():
+            return None
+        self._entries[key] = entry
+        return entry
+
+    def set(self, key, generation, response):
+        """Cache a response for key and return its entry."""
+        entry = {
+            "data": response.get_data(),
+            "status": response.status_code,
+            "mimetype": response.mimetype,
+            "etag": response.get_etag()[0],
+            "generation": generation,
+            "expires": time.time() + self.ttl,
+        }
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return entry
+
+
+# There is one response cache per process.
+response_cache = ResponseCache()
+
+
+def cached(func):
+    """Cache the successful responses of the GET route wrapped.
+
+    Responses are served from :data:`response_cache` while they are fresh,
+    without calling the route. They carry an ETag, so clients that send it
+    back get a 304 Not Modified if the response has not changed. There is
+    no Last-Modified header, as when the data last changed is not known.
+    Requests made within a transaction that has changes of its own, such
+    as in a batch, bypass the cache.
+    """
+    def new_func(*args, **kwargs):
+        """Cache wrapper."""
+        from dallinger.heroku.worker import conn as redis
+
+        if session.info.get('changed'):
+            return func(*args, **kwargs)
+        key = request.full_path
+        generation = redis.get(CACHE_GENERATION_KEY)
+        entry = response_cache.get(key, generation)
+        if entry is None:
+            resp = make_response(func(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            resp.add_etag()
+            entry = response_cache.set(key, generation, resp)
+
+        resp = Response(entry["data"], status=entry["status"],
+                        mimetype=entry["mimetype"])
+        resp.set_etag(entry["etag"])
+        resp.cache_control.no_cache = True
+        return resp.make_conditional(request)
+    return update_wrapper(new_func, func)
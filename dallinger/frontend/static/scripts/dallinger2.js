@@ -1,4 +1,4 @@
-/*globals Spinner, Fingerprint2, ReconnectingWebSocket, reqwest, store */
+/*globals Spinner, Fingerprint2, MessagePack, ReconnectingWebSocket, reqwest, store */
 
 if (window.Dallinger !== undefined) {
   alert(
@@ -205,6 +205,15 @@ var dallinger = (function () {
     return ajax('post', route, data);
   };
 
+  // Run several requests in one round trip and one transaction. Each
+  // operation is {method: 'GET' or 'POST', route: '/node/1/infos', data: {}},
+  // and a route can use the responses of earlier operations, for example
+  // '/node/{0[node][id]}/received_infos'. The response has the status_code
+  // and response of each operation as results.
+  dlgr.batch = function (operations) {
+    return dlgr.post('/batch', {operations: JSON.stringify(operations)});
+  };
+
   dlgr.error = function (rejection) {
     // Render an error form for a rejected deferred returned by an ajax() call.
     var $form, hit_params;
@@ -323,18 +332,56 @@ var dallinger = (function () {
     return dlgr.get('/info/' + nodeId + '/' + infoId);
   };
 
-  dlgr.getInfos = function (nodeId) {
-    return dlgr.get('/node/' + nodeId + '/infos');
+  dlgr.getInfos = function (nodeId, data) {
+    return dlgr.get('/node/' + nodeId + '/infos', data);
   };
 
-  dlgr.getReceivedInfos = function (nodeId) {
-    return dlgr.get('/node/' + nodeId + '/received_infos');
+  dlgr.getReceivedInfos = function (nodeId, data) {
+    return dlgr.get('/node/' + nodeId + '/received_infos', data);
   };
 
   dlgr.getTransmissions = function (nodeId, data) {
     return dlgr.get('/node/' + nodeId + '/transmissions', data);
   };
 
+  dlgr.getVectors = function (nodeId, data) {
+    return dlgr.get('/node/' + nodeId + '/vectors', data);
+  };
+
+  dlgr.getNeighbors = function (nodeId, data) {
+    return dlgr.get('/node/' + nodeId + '/neighbors', data);
+  };
+
+  // Poll a node route ('infos', 'received_infos', 'transmissions' or
+  // 'vectors') for the rows created since the last poll of it with the same
+  // data. Every poll asks for the rows after the cursor the server sent back
+  // last, so rows left out by data.limit are fetched by the next poll. For
+  // 'received_infos' that cursor is a transmission id, so infos received
+  // late are polled too. Rows that change after they are created are not
+  // polled for: data.since can be passed as a best-effort filter for those.
+  // Poll 'vectors' to follow new neighbors.
+  var pollCursors = {};
+
+  dlgr.pollNode = function (nodeId, what, data) {
+    var deferred = $.Deferred(),
+      route = '/node/' + nodeId + '/' + what,
+      key;
+    data = $.extend({}, data);
+    key = route + '?' + $.param(data);
+    if (pollCursors[key] !== undefined) {
+      data.after_id = pollCursors[key];
+    } else if (data.after_id === undefined) {
+      data.after_id = 0;
+    }
+    dlgr.get(route, data).done(function (resp) {
+      pollCursors[key] = resp.next_after_id;
+      deferred.resolve(resp);
+    }).fail(function (err) {
+      deferred.reject(err);
+    });
+    return deferred;
+  };
+
   dlgr.submitQuestionnaire = function (name) {
     var formSerialized = $("form").serializeArray(),
       spinner = dlgr.BusyForm(),
@@ -355,23 +402,100 @@ var dallinger = (function () {
     xhr.always(function () { spinner.unfreeze(); });
   };
 
+  // Split a websocket frame into its "channel:data" messages. Pass coalesced
+  // for a text socket opened with coalesce=1, whose every frame is a JSON
+  // array of them. Binary frames, given as an ArrayBuffer, hold [channel,
+  // data] MessagePack arrays instead, or an array of those.
+  dlgr.unpackMessages = function (data, coalesced) {
+    if (typeof data !== 'string') {
+      var decoded = MessagePack.decode(new Uint8Array(data));
+      return Array.isArray(decoded[0]) ? decoded : [decoded];
+    }
+    return coalesced ? JSON.parse(data) : [data];
+  };
+
+  // Open a websocket on a channel and call callback(data) for each message
+  // on it. options.coalesce and options.tolerance are passed on to /chat.
+  // With options.binary, messages travel as MessagePack, which needs the
+  // MessagePack library (@msgpack/msgpack) to be loaded, and data is the
+  // unpacked message; otherwise it is the message's text. The socket's
+  // publish(data) sends data to the channel, JSON encoded or packed.
+  dlgr.openChannel = function (channel, callback, options) {
+    options = options || {};
+    var ws_scheme = (window.location.protocol === "https:") ? 'wss://' : 'ws://';
+    var url = ws_scheme + location.host + "/chat?channel=" + channel;
+    if (options.binary) { url += "&binary=1"; }
+    if (options.coalesce) { url += "&coalesce=1"; }
+    if (options.tolerance !== undefined) { url += "&tolerance=" + options.tolerance; }
+    var socket = new ReconnectingWebSocket(url);
+    var pending = Promise.resolve();
+    // Binary sockets only get text frames for pings, which are not coalesced
+    var coalesced = Boolean(options.coalesce && !options.binary);
+    var receive = function (frame) {
+      dlgr.unpackMessages(frame, coalesced).forEach(function (message) {
+        if (typeof message !== 'string') {
+          if (message[0] === channel) { callback(message[1]); }
+        } else if (message.indexOf(channel + ':') === 0) {
+          callback(message.substring(channel.length + 1));
+        }
+      });
+    };
+    socket.onmessage = function (msg) {
+      if (typeof msg.data === 'string') {
+        receive(msg.data);
+        return;
+      }
+      // Binary frames arrive as Blobs, which are read in order
+      var blob = msg.data;
+      pending = pending.then(function () {
+        return new Response(blob).arrayBuffer();
+      }).then(receive);
+    };
+    socket.publish = function (data) {
+      if (options.binary) {
+        socket.send(MessagePack.encode([channel, data]));
+      } else {
+        socket.send(channel + ':' + JSON.stringify(data));
+      }
+    };
+    return socket;
+  };
+
   dlgr.waitForQuorum = function () {
     var ws_scheme = (window.location.protocol === "https:") ? 'wss://' : 'ws://';
     var socket = new ReconnectingWebSocket(ws_scheme + location.host + "/chat?channel=quorum");
     var deferred = $.Deferred();
     socket.onmessage = function (msg) {
-      if (msg.data.indexOf('quorum:') !== 0) { return; }
-      var data = JSON.parse(msg.data.substring(7));
-      var n = data.n;
-      var quorum = data.q;
-      dlgr.updateProgressBar(n, quorum);
-      if (n === quorum) {
-        deferred.resolve();
-      }
+      dlgr.unpackMessages(msg.data).forEach(function (message) {
+        if (message.indexOf('quorum:') !== 0) { return; }
+        var data = JSON.parse(message.substring(7));
+        var n = data.n;
+        var quorum = data.q;
+        dlgr.updateProgressBar(n, quorum);
+        if (n === quorum) {
+          deferred.resolve();
+        }
+      });
     };
     return deferred;
   };
 
+  // Call callback(info, transmission) for every info transmitted to a node,
+  // as the server pushes them. The experiment must set push_transmissions.
+  dlgr.onTransmission = function (nodeId, callback) {
+    var ws_scheme = (window.location.protocol === "https:") ? 'wss://' : 'ws://';
+    var channel = 'node_' + nodeId;
+    var socket = new ReconnectingWebSocket(ws_scheme + location.host + "/chat?channel=" + channel);
+    socket.onmessage = function (msg) {
+      dlgr.unpackMessages(msg.data).forEach(function (message) {
+        if (message.indexOf(channel + ':') !== 0) { return; }
+        var data = JSON.parse(message.substring(channel.length + 1));
+        callback(data.info, data.transmission);
+      });
+    };
+    return socket;
+  };
+
   dlgr.updateProgressBar = function (value, total) {
     var percent = Math.round((value / total) * 100.0) + '%';
     $("#waiting-progress-bar").css("width", percent);
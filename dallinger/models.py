@@ -1,9 +1,16 @@
 """Define Dallinger's core models."""
 
+from collections import defaultdict
 from datetime import datetime
 import inspect
-
-from sqlalchemy import ForeignKey, or_, and_
+from json import dumps
+from operator import attrgetter
+import random
+import six
+
+from psycopg2.extras import execute_values, Json
+from sqlalchemy import ForeignKey, event, or_, and_
+from sqlalchemy import any_, cast, exists, func, literal, null, select
 from sqlalchemy import (
     Column,
     String,
@@ -12,13 +19,16 @@ from sqlalchemy import (
     Integer,
     Boolean,
     DateTime,
-    Float
+    Float,
+    Index
 )
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.sql.expression import false
-from sqlalchemy.orm import relationship, validates
+from sqlalchemy.dialects.postgresql import JSONB, array
+from sqlalchemy.sql.expression import false, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import class_mapper, relationship, validates, object_session
+from sqlalchemy.orm.util import identity_key
 
-from .db import Base
+from .db import Base, mark_changed, queue_message
 
 DATETIME_FMT = "%Y-%m-%dT%H:%M:%S.%f"
 
@@ -28,6 +38,239 @@ def timenow():
     return datetime.now()
 
 
+def _expire_in_session(session, cls, ids, attributes):
+    """Expire attributes of the objects with ids that the session has loaded.
+
+    Used after updating rows directly, so loaded objects don't go stale.
+    """
+    for id in ids:
+        obj = session.identity_map.get(identity_key(cls, id))
+        if obj is not None:
+            session.expire(obj, attributes)
+
+
+def _overriding_fail(cls):
+    """The polymorphic identities of subclasses of cls that override fail()."""
+    fail = six.get_unbound_function(cls.fail)
+    return [identity for identity, mapper
+            in class_mapper(cls).polymorphic_map.items()
+            if six.get_unbound_function(mapper.class_.fail) is not fail]
+
+
+def _fail_rows(session, cls, condition, time_of_death):
+    """Fail the not-failed rows of cls that match condition.
+
+    The rows are failed with a single UPDATE, without loading them. Rows
+    whose class overrides fail() are instead loaded and failed one by one,
+    so the override is still called. Returns the ids of the failed rows.
+    """
+    condition = and_(cls.failed == false(), condition)
+    failed_ids = []
+
+    overriding = _overriding_fail(cls)
+    if overriding:
+        for obj in cls.query.filter(condition, cls.type.in_(overriding)).all():
+            obj.fail()
+            failed_ids.append(obj.id)
+        session.flush()
+        condition = and_(condition, cls.type.notin_(overriding))
+
+    table = cls.__table__
+    rows = session.execute(
+        table.update()
+        .where(condition)
+        .values(failed=True, time_of_death=time_of_death)
+        .returning(table.c.id)
+    ).fetchall()
+    ids = [row.id for row in rows]
+    if ids:
+        mark_changed(session)
+    _expire_in_session(session, cls, ids, ["failed", "time_of_death"])
+
+    return failed_ids + ids
+
+
+def _fail_node_contents(session, node_ids, time_of_death):
+    """Fail everything that depends on the nodes with node_ids.
+
+    That is the vectors to or from the nodes, the infos made by them, the
+    transmissions to or from them and the transformations involving those
+    infos or made by them. Each table is updated with a single statement.
+    """
+    if not node_ids:
+        return
+
+    _fail_rows(session, Vector,
+               or_(Vector.origin_id.in_(node_ids),
+                   Vector.destination_id.in_(node_ids)),
+               time_of_death)
+    info_ids = _fail_rows(session, Info, Info.origin_id.in_(node_ids),
+                          time_of_death)
+    _fail_rows(session, Transmission,
+               or_(Transmission.origin_id.in_(node_ids),
+                   Transmission.destination_id.in_(node_ids)),
+               time_of_death)
+
+    transformations = [Transformation.node_id.in_(node_ids)]
+    if info_ids:
+        transformations.extend([Transformation.info_in_id.in_(info_ids),
+                                Transformation.info_out_id.in_(info_ids)])
+    _fail_rows(session, Transformation, or_(*transformations), time_of_death)
+
+
+def _reserve_ids(session, cls, count):
+    """Take count ids for new rows of cls from the table's sequence.
+
+    Returns the ids in ascending order, so rows can be inserted in bulk
+    while still referring to each other.
+    """
+    if not count:
+        return []
+    rows = session.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+             "FROM generate_series(1, :count)"),
+        {"table": cls.__table__.name, "count": count}).fetchall()
+    return sorted(row[0] for row in rows)
+
+
+def _insert_rows(session, cls, rows, batch_size=1000):
+    """Insert rows, given as dicts of column values, into the table of cls.
+
+    The rows are sent batch_size at a time with psycopg2's execute_values,
+    which avoids compiling a statement for every batch. Every row must have
+    the same columns.
+    """
+    if not rows:
+        return
+
+    table = cls.__table__
+    columns = list(rows[0])
+    json = [isinstance(table.c[column].type, JSONB) for column in columns]
+    values = [tuple(Json(row[column]) if is_json else row[column]
+                    for column, is_json in zip(columns, json))
+              for row in rows]
+
+    cursor = session.connection().connection.cursor()
+    execute_values(
+        cursor,
+        'INSERT INTO "{}" ({}) VALUES %s'.format(
+            table.name, ", ".join('"{}"'.format(c) for c in columns)),
+        values, page_size=batch_size)
+    mark_changed(session)
+
+
+def _lineage(start, descending, depth, failed):
+    """A recursive CTE that follows transformations from the infos in start.
+
+    start is a select of the id, parent_id, root_id, depth and path columns
+    of the infos to start from. If descending is True, transformations are
+    followed from their info_in to their info_out, otherwise the other way.
+    depth limits how many transformations are followed, and failed applies
+    to both the transformations followed and the infos reached. The path
+    of every row stops the walk from going round in circles.
+    """
+    if depth is not None and (not isinstance(depth, int) or depth < 1):
+        raise ValueError("{} is not a valid depth".format(depth))
+    if failed not in ["all", False, True]:
+        raise ValueError("{} is not a valid failed".format(failed))
+
+    transformation = Transformation.__table__
+    info = Info.__table__
+    if descending:
+        source = transformation.c.info_in_id
+        target = transformation.c.info_out_id
+    else:
+        source = transformation.c.info_out_id
+        target = transformation.c.info_in_id
+
+    lineage = start.cte("lineage", recursive=True)
+    conditions = [source == lineage.c.id,
+                  target == info.c.id,
+                  ~(target == any_(lineage.c.path))]
+    if failed != "all":
+        conditions.extend([transformation.c.failed == failed,
+                           info.c.failed == failed])
+    if depth is not None:
+        conditions.append(lineage.c.depth < depth)
+
+    return lineage.union_all(
+        select([target.label("id"),
+                source.label("parent_id"),
+                lineage.c.root_id,
+                (lineage.c.depth + 1).label("depth"),
+                func.array_append(lineage.c.path, target).label("path")])
+        .where(and_(*conditions)))
+
+
+def _lineage_start(ids):
+    """The columns of _lineage for infos with ids, at depth 0."""
+    return [ids.label("id"),
+            cast(null(), Integer).label("parent_id"),
+            ids.label("root_id"),
+            literal(0).label("depth"),
+            array([ids]).label("path")]
+
+
+class Page(list):
+    """A page of rows, with the after_id that fetches the next page."""
+
+    def __init__(self, rows, next_after_id):
+        super(Page, self).__init__(rows)
+        self.next_after_id = next_after_id
+
+
+def _page(query, cls, after_id=None, since=None, limit=None, changed=None,
+          cursor=None):
+    """Get the rows of query, or just the page of them after a cursor.
+
+    Without after_id, since or limit every row is returned in the query's
+    own order. Otherwise rows are ordered by their cursor, by default the
+    id of cls, and only those with a cursor greater than after_id, and
+    changed after since, are returned as a :class:`Page`, up to limit of
+    them. changed is the list of columns compared to since, by default the
+    creation_time of cls. A row whose cursor is a column of another table
+    joined in the query is returned once per page, however many of its
+    cursors the page covers.
+
+    since is only a best-effort filter: the times it is compared with are
+    taken from the clock of whichever server wrote the row, before the row
+    was committed, so rows can commit with a time earlier than a since a
+    client already polled with. Clients that must not miss rows should
+    page with after_id.
+    """
+    if after_id is None and since is None and limit is None:
+        return query.all()
+
+    if after_id is not None and not isinstance(after_id, six.integer_types):
+        raise TypeError("{} is not a valid after_id".format(after_id))
+    if since is not None and not isinstance(since, datetime):
+        raise TypeError("{} is not a valid since".format(since))
+    if limit is not None and (not isinstance(limit, six.integer_types) or
+                              limit < 1):
+        raise ValueError("{} is not a valid limit".format(limit))
+
+    if cursor is None:
+        cursor = cls.id
+    if after_id is not None:
+        query = query.filter(cursor > after_id)
+    if since is not None:
+        if changed is None:
+            changed = [cls.creation_time]
+        query = query.filter(or_(*[column > since for column in changed]))
+    query = query.order_by(None).order_by(cursor)
+    if limit is not None:
+        query = query.limit(limit)
+
+    rows = []
+    seen = set()
+    next_after_id = after_id
+    for row, next_after_id in query.add_columns(cursor):
+        if row.id not in seen:
+            seen.add(row.id)
+            rows.append(row)
+    return Page(rows, next_after_id)
+
+
 class SharedMixin(object):
     """Create shared columns."""
 
@@ -362,6 +605,11 @@ class Network(Base, SharedMixin):
         'polymorphic_identity': 'network'
     }
 
+    __table_args__ = (
+        # Used to find the networks a participant can join.
+        Index('ix_network_full_role_id', 'full', 'role', 'id'),
+    )
+
     #: How big the network can get, this number is used by the full()
     #: method to decide whether the network is full
     max_size = Column(Integer, nullable=False, default=1e6)
@@ -453,9 +701,28 @@ class Network(Base, SharedMixin):
         """How many nodes in a network.
 
         type specifies the class of node, failed
-        can be True/False/all.
+        can be True/False/all. The nodes are counted by the database
+        rather than loaded.
         """
-        return len(self.nodes(type=type, failed=failed))
+        if type is None:
+            type = Node
+
+        if not issubclass(type, Node):
+            raise TypeError("{} is not a valid node type.".format(type))
+
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid node failed".format(failed))
+
+        if failed == "all":
+            return type\
+                .query\
+                .filter_by(network_id=self.id)\
+                .count()
+        else:
+            return type\
+                .query\
+                .filter_by(failed=failed, network_id=self.id)\
+                .count()
 
     def infos(self, type=None, failed=False):
         """
@@ -540,16 +807,75 @@ class Network(Base, SharedMixin):
                 .filter_by(network_id=self.id, failed=failed)\
                 .all()
 
+    def lineage_forest(self, depth=None, failed=False):
+        """Get the lineages of all the infos in the network.
+
+        Every info that was not transformed from another info is the root of
+        a tree. Return a list of (id, parent_id, root_id, depth) rows, one
+        for each info in each tree and each way of reaching it from the
+        root, ordered by root_id, depth and id. Roots have a parent_id of
+        None and a depth of 0. ``depth`` limits how many transformations
+        from the roots to follow and ``failed`` can be False (the default),
+        True or "all", and applies to the infos and the transformations.
+        The whole forest is fetched with a single recursive query.
+        """
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid failed".format(failed))
+
+        info = Info.__table__
+        transformation = Transformation.__table__
+        roots = [info.c.network_id == self.id]
+        parents = [transformation.c.info_out_id == info.c.id]
+        if failed != "all":
+            roots.append(info.c.failed == failed)
+            parents.append(transformation.c.failed == failed)
+        roots.append(~exists().where(and_(*parents)))
+
+        lineage = _lineage(
+            select(_lineage_start(info.c.id)).where(and_(*roots)),
+            True, depth, failed)
+        return Info.query.session\
+            .query(lineage.c.id, lineage.c.parent_id, lineage.c.root_id,
+                   lineage.c.depth)\
+            .distinct()\
+            .order_by(lineage.c.root_id, lineage.c.depth, lineage.c.id,
+                      lineage.c.parent_id)\
+            .all()
+
+    def has_transmissions(self, status="all", failed=False):
+        """Whether the network has any transmissions.
+
+        status { "all", "received", "pending" }
+        failed { False, True, "all" }
+        This runs an EXISTS query, so is much cheaper than checking the
+        result of transmissions().
+        """
+        if status not in ["all", "pending", "received"]:
+            raise ValueError(
+                "You cannot get transmission of status {}.".format(status) +
+                "Status can only be pending, received or all"
+            )
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid failed".format(failed))
+
+        query = Transmission.query.filter_by(network_id=self.id)
+        if status != "all":
+            query = query.filter_by(status=status)
+        if failed != "all":
+            query = query.filter_by(failed=failed)
+        return query.session.query(query.exists()).scalar()
+
     def latest_transmission_recipient(self):
         """Get the node that most recently received a transmission."""
-        from operator import attrgetter
-
-        ts = Transmission.query\
+        # Received transmissions always have a receive_time, so a plain
+        # descending order can be read backwards from the index on
+        # (network_id, status, failed, receive_time) without sorting.
+        t = Transmission.query\
             .filter_by(status="received", network_id=self.id, failed=False)\
-            .all()
+            .order_by(Transmission.receive_time.desc())\
+            .first()
 
-        if ts:
-            t = max(ts, key=attrgetter('receive_time'))
+        if t is not None:
             return t.destination
         else:
             return None
@@ -573,6 +899,73 @@ class Network(Base, SharedMixin):
                 .filter_by(network_id=self.id, failed=failed)\
                 .all()
 
+    def sample_by_outdegree(self, k, exclude=()):
+        """Pick k distinct nodes with probability proportional to out-degree.
+
+        As :func:`~dallinger.models.NetworkCache.sample_by_outdegree`, which
+        is used if the cache of the network is loaded. Otherwise the
+        out-degrees are counted by the database in a single query and only
+        the picked nodes are loaded.
+        """
+        session = object_session(self)
+        if (session is None or self.id is None or
+                _loaded_cache(self, self.id) is not None):
+            return self.cache().sample_by_outdegree(k, exclude=exclude)
+
+        session.flush()
+        excluded = set(node.id for node in exclude)
+        if excluded:
+            connected = Vector.query\
+                .with_entities(Vector.origin_id, Vector.destination_id)\
+                .filter(Vector.failed == false(),
+                        or_(Vector.origin_id.in_(excluded),
+                            Vector.destination_id.in_(excluded)))\
+                .all()
+            for origin_id, destination_id in connected:
+                excluded.update([origin_id, destination_id])
+
+        outdegrees = Vector.query\
+            .with_entities(Vector.origin_id, func.count(Vector.id))\
+            .filter_by(network_id=self.id, failed=False)\
+            .group_by(Vector.origin_id)\
+            .order_by(Vector.origin_id)\
+            .all()
+        outdegrees = [(node_id, count) for node_id, count in outdegrees
+                      if node_id not in excluded]
+        tree = FenwickTree(count for _, count in outdegrees)
+
+        picked = []
+        for _ in range(k):
+            total = tree.total()
+            if total <= 0:
+                raise ValueError(
+                    "Cannot pick {} nodes from network {} by out-degree."
+                    .format(k, self.id))
+            position = tree.find(random.random() * total)
+            picked.append(outdegrees[position][0])
+            tree[position] = 0
+
+        nodes = {node.id: node for node in
+                 Node.query.filter(Node.id.in_(picked)).all()}
+        return [nodes[node_id] for node_id in picked]
+
+    def cache(self):
+        """Get the :class:`~dallinger.models.NetworkCache` of the network.
+
+        The cache is loaded from the database the first time it is asked for
+        in a transaction and is then kept up to date as nodes and vectors are
+        created and failed. It is discarded when the transaction is committed
+        or rolled back.
+        """
+        session = object_session(self)
+        if session is None or self.id is None:
+            return NetworkCache(self)
+
+        caches = session.info.setdefault('network_caches', {})
+        if self.id not in caches:
+            caches[self.id] = NetworkCache(self)
+        return caches[self.id]
+
     """ ###################################
     Methods that make Networks do things
     ################################### """
@@ -590,12 +983,23 @@ class Network(Base, SharedMixin):
             self.failed = True
             self.time_of_death = timenow()
 
-            for n in self.nodes():
-                n.fail()
+            session = object_session(self)
+            if session is None:
+                # Without a session the nodes can only be failed one by one
+                for n in self.nodes():
+                    n.fail()
+                return
+
+            session.flush()
+            node_ids = _fail_rows(session, Node, Node.network_id == self.id,
+                                  self.time_of_death)
+            _fail_node_contents(session, node_ids, self.time_of_death)
+            _drop_cache(self, self.id)
+            self.calculate_full()
 
     def calculate_full(self):
         """Set whether the network is full."""
-        self.full = len(self.nodes()) >= (self.max_size or 0)
+        self.full = self.size() >= (self.max_size or 0)
 
     def print_verbose(self):
         """Print a verbose representation of a network."""
@@ -620,6 +1024,275 @@ class Network(Base, SharedMixin):
             print(t)
 
 
+def _loaded_cache(obj, network_id):
+    """The cache of a network if it has been loaded in obj's session."""
+    session = object_session(obj)
+    if session is None:
+        return None
+    return session.info.get('network_caches', {}).get(network_id)
+
+
+def _drop_cache(obj, network_id):
+    """Discard the cache of a network loaded in obj's session."""
+    session = object_session(obj)
+    if session is not None:
+        session.info.get('network_caches', {}).pop(network_id, None)
+
+
+class FenwickTree(object):
+    """A binary indexed tree over a growable list of non-negative weights.
+
+    Changing or appending a weight and finding where a running total of the
+    weights is reached both take O(log n) time, so indices can be sampled
+    with probability proportional to their weight without scanning them all.
+    """
+
+    def __init__(self, weights=()):
+        # Built bottom up, passing each partial sum on to its parent, in
+        # O(n) time.
+        self._weights = list(weights)
+        self._tree = [0] + self._weights
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._weights)
+
+    def __getitem__(self, index):
+        return self._weights[index]
+
+    def __setitem__(self, index, weight):
+        self.add(index, weight - self._weights[index])
+
+    def append(self, weight):
+        """Add a weight at the end of the list and return its index."""
+        i = len(self._tree)
+        total = weight
+        j = i - 1
+        stop = i - (i & -i)
+        while j > stop:
+            total += self._tree[j]
+            j -= j & -j
+        self._tree.append(total)
+        self._weights.append(weight)
+        return i - 1
+
+    def add(self, index, delta):
+        """Add delta to the weight at index."""
+        self._weights[index] += delta
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        """The sum of all the weights."""
+        total = 0
+        i = len(self._weights)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """The index at which the running total of the weights exceeds value.
+
+        value must be at least 0 and less than the total of the weights.
+        """
+        position = 0
+        step = 1 << (len(self._weights).bit_length() - 1) if self._weights else 0
+        while step:
+            if (position + step <= len(self._weights) and
+                    self._tree[position + step] <= value):
+                position += step
+                value -= self._tree[position]
+            step >>= 1
+        return min(position, len(self._weights) - 1)
+
+
+class NetworkCache(object):
+    """An in-memory view of the nodes and vectors of a network.
+
+    Holds the not-failed nodes of a network in order of creation, along with
+    the not-failed vectors between them, so that network topologies can
+    inspect the network without querying the database repeatedly. Use
+    :func:`~dallinger.models.Network.cache` to get the cache of a network.
+
+    The cache is updated when nodes or vectors are created or failed through
+    the models. Changes made to the database by other means are not seen
+    until the next transaction.
+    """
+
+    def __init__(self, network):
+        """Load the nodes and vectors of the network."""
+        self.network_id = network.id
+        self._nodes = []
+        self._members = set()
+        self._outgoing = defaultdict(set)
+        self._incoming = defaultdict(set)
+
+        # Every node ever added has a position in the out-degree tree.
+        # Nodes that have not been flushed yet are indexed by id later.
+        self._outdegrees = FenwickTree()
+        self._indexed = []
+        self._positions = {}
+        self._unindexed = []
+
+        vectors = Vector.query\
+            .with_entities(Vector.origin_id, Vector.destination_id)\
+            .filter_by(network_id=self.network_id, failed=False)\
+            .all()
+        for origin_id, destination_id in vectors:
+            self._outgoing[origin_id].add(destination_id)
+            self._incoming[destination_id].add(origin_id)
+
+        nodes = sorted(network.nodes(), key=attrgetter('creation_time', 'id'))
+        for node in nodes:
+            self.add_node(node)
+
+    def _position(self, node_id):
+        """The position of a node in the out-degree tree, or None."""
+        if node_id not in self._positions and self._unindexed:
+            unindexed = []
+            for position in self._unindexed:
+                node = self._indexed[position]
+                if node.id is None:
+                    unindexed.append(position)
+                else:
+                    self._positions[node.id] = position
+            self._unindexed = unindexed
+        return self._positions.get(node_id)
+
+    def _add_outdegree(self, node_id, delta):
+        position = self._position(node_id)
+        if position is not None:
+            self._outdegrees.add(position, delta)
+
+    def nodes(self, type=None):
+        """The not-failed nodes of the network, oldest first.
+
+        If specified, type filters the nodes by class.
+        """
+        if type is None:
+            return list(self._nodes)
+        return [n for n in self._nodes if isinstance(n, type)]
+
+    def size(self, type=None):
+        """The number of not-failed nodes in the network."""
+        if type is None:
+            return len(self._nodes)
+        return len(self.nodes(type=type))
+
+    def outdegree(self, node):
+        """The number of not-failed vectors leaving node."""
+        return len(self._outgoing.get(node.id, ()))
+
+    def indegree(self, node):
+        """The number of not-failed vectors arriving at node."""
+        return len(self._incoming.get(node.id, ()))
+
+    def is_connected(self, node, whom, direction="to"):
+        """Whether node is connected to whom, as Node.is_connected()."""
+        destinations = self._outgoing.get(node.id, set())
+        origins = self._incoming.get(node.id, set())
+        if direction == "to":
+            return whom.id in destinations
+        elif direction == "from":
+            return whom.id in origins
+        elif direction == "either":
+            return whom.id in destinations or whom.id in origins
+        elif direction == "both":
+            return whom.id in destinations and whom.id in origins
+        raise ValueError("{} is not a valid direction for is_connected"
+                         .format(direction))
+
+    def sample_by_outdegree(self, k, exclude=()):
+        """Pick k distinct nodes with probability proportional to out-degree.
+
+        Nodes in exclude, and nodes connected in either direction to a node
+        in exclude, are never picked. Each pick takes O(log n) time. Raises
+        a ValueError if fewer than k nodes can be picked.
+        """
+        removed = {}
+
+        def remove(node_id):
+            position = self._position(node_id)
+            if position is not None and position not in removed:
+                removed[position] = self._outdegrees[position]
+                self._outdegrees[position] = 0
+
+        for node in exclude:
+            remove(node.id)
+            for node_id in self._outgoing.get(node.id, ()):
+                remove(node_id)
+            for node_id in self._incoming.get(node.id, ()):
+                remove(node_id)
+
+        chosen = []
+        try:
+            for _ in range(k):
+                total = self._outdegrees.total()
+                if total <= 0:
+                    raise ValueError(
+                        "Cannot pick {} nodes from network {} by out-degree."
+                        .format(k, self.network_id))
+                position = self._outdegrees.find(random.random() * total)
+                chosen.append(self._indexed[position])
+                removed[position] = self._outdegrees[position]
+                self._outdegrees[position] = 0
+        finally:
+            for position, weight in removed.items():
+                self._outdegrees[position] = weight
+
+        return chosen
+
+    def add_node(self, node):
+        """Record the creation of a node."""
+        if node in self._members:
+            return
+
+        self._nodes.append(node)
+        self._members.add(node)
+        position = self._outdegrees.append(len(self._outgoing.get(node.id, ())))
+        self._indexed.append(node)
+        if node.id is None:
+            self._unindexed.append(position)
+        else:
+            self._positions[node.id] = position
+
+    def remove_node(self, node):
+        """Record the failure of a node and of its vectors."""
+        if node in self._members:
+            self._members.remove(node)
+            self._nodes.remove(node)
+        position = self._position(node.id)
+        if position is not None:
+            self._outdegrees[position] = 0
+        for destination_id in self._outgoing.pop(node.id, ()):
+            self._incoming[destination_id].discard(node.id)
+        for origin_id in self._incoming.pop(node.id, ()):
+            self._outgoing[origin_id].discard(node.id)
+            self._add_outdegree(origin_id, -1)
+
+    def add_vector(self, vector):
+        """Record the creation of a vector."""
+        destinations = self._outgoing[vector.origin_id]
+        if vector.destination_id not in destinations:
+            destinations.add(vector.destination_id)
+            self._incoming[vector.destination_id].add(vector.origin_id)
+            self._add_outdegree(vector.origin_id, 1)
+
+    def remove_vector(self, vector):
+        """Record the failure of a vector."""
+        destinations = self._outgoing.get(vector.origin_id, set())
+        if vector.destination_id in destinations:
+            destinations.discard(vector.destination_id)
+            self._incoming[vector.destination_id].discard(vector.origin_id)
+            self._add_outdegree(vector.origin_id, -1)
+
+
 class Node(Base, SharedMixin):
     """A point in a network."""
 
@@ -664,6 +1337,10 @@ class Node(Base, SharedMixin):
         self.network_id = network.id
         network.calculate_full()
 
+        cache = _loaded_cache(network, network.id)
+        if cache is not None:
+            cache.add_node(self)
+
         if participant is not None:
             self.participant = participant
             self.participant_id = participant.id
@@ -693,11 +1370,15 @@ class Node(Base, SharedMixin):
     Methods that get things about a node
     ################################### """
 
-    def vectors(self, direction="all", failed=False):
+    def vectors(self, direction="all", failed=False, after_id=None,
+                since=None, limit=None):
         """Get vectors that connect at this node.
 
         Direction can be "incoming", "outgoing" or "all" (default).
-        Failed can be True, False or all
+        Failed can be True, False or all.
+        after_id, since and limit fetch a page of the vectors, see
+        :func:`~dallinger.models.Node.infos`, except that ``since`` keeps
+        vectors that were either created or failed after then.
         """
         # check direction
         if direction not in ["all", "incoming", "outgoing"]:
@@ -709,47 +1390,33 @@ class Node(Base, SharedMixin):
             raise ValueError("{} is not a valid vector failed".format(failed))
 
         # get the vectors
-        if failed == "all":
-            if direction == "all":
-                return Vector.query\
-                    .filter(or_(Vector.destination_id == self.id,
-                                Vector.origin_id == self.id))\
-                    .all()
-
-            if direction == "incoming":
-                return Vector.query\
-                    .filter_by(destination_id=self.id)\
-                    .all()
-
-            if direction == "outgoing":
-                return Vector.query\
-                    .filter_by(origin_id=self.id)\
-                    .all()
-        else:
-            if direction == "all":
-                return Vector.query\
-                    .filter(and_(Vector.failed == failed,
-                            or_(Vector.destination_id == self.id,
-                                Vector.origin_id == self.id)))\
-                    .all()
-
-            if direction == "incoming":
-                return Vector.query\
-                    .filter_by(destination_id=self.id, failed=failed)\
-                    .all()
-
-            if direction == "outgoing":
-                return Vector.query\
-                    .filter_by(origin_id=self.id, failed=failed)\
-                    .all()
-
-    def neighbors(self, type=None, direction="to", failed=None):
+        if direction == "all":
+            query = Vector.query\
+                .filter(or_(Vector.destination_id == self.id,
+                            Vector.origin_id == self.id))
+        elif direction == "incoming":
+            query = Vector.query.filter_by(destination_id=self.id)
+        elif direction == "outgoing":
+            query = Vector.query.filter_by(origin_id=self.id)
+
+        if failed != "all":
+            query = query.filter_by(failed=failed)
+
+        return _page(query, Vector, after_id, since, limit,
+                     changed=[Vector.creation_time, Vector.time_of_death])
+
+    def neighbors(self, type=None, direction="to", failed=None,
+                  after_id=None, since=None, limit=None):
         """Get a node's neighbors - nodes that are directly connected to it.
 
         Type specifies the class of neighbour and must be a subclass of
         Node (default is Node).
         Connection is the direction of the connections and can be "to"
         (default), "from", "either", or "both".
+        limit caps how many neighbors are returned, in order of id.
+        after_id and since cannot be passed, as a node can become a
+        neighbor long after it was created; page through
+        :func:`~dallinger.models.Node.vectors` to follow new neighbors.
         """
         # get type
         if type is None:
@@ -776,36 +1443,100 @@ class Node(Base, SharedMixin):
                 "example, getting not-failed nodes connected to you via failed"
                 " vectors, you should do so via sql queries.")
 
-        neighbors = []
-        # get the neighbours
-        if direction == "to":
-            outgoing_vectors = Vector.query\
-                .with_entities(Vector.destination_id)\
-                .filter_by(origin_id=self.id, failed=False).all()
+        if after_id is not None or since is not None:
+            raise ValueError(
+                "You cannot pass after_id or since to neighbors(), as "
+                "neighbors are not connected in order of id or creation "
+                "time. Page through vectors() to follow new neighbors.")
+
+        # get the neighbours in a single query, leaving the database to
+        # filter on the polymorphic type of the neighbors
+        outgoing = Vector.query\
+            .with_entities(Vector.destination_id)\
+            .filter_by(origin_id=self.id, failed=False)\
+            .subquery()
+        incoming = Vector.query\
+            .with_entities(Vector.origin_id)\
+            .filter_by(destination_id=self.id, failed=False)\
+            .subquery()
 
-            neighbor_ids = [v.destination_id for v in outgoing_vectors]
-            if neighbor_ids:
-                neighbors = Node.query.filter(Node.id.in_(neighbor_ids)).all()
-                neighbors = [n for n in neighbors if isinstance(n, type)]
+        if direction == "to":
+            condition = type.id.in_(outgoing)
+        elif direction == "from":
+            condition = type.id.in_(incoming)
+        elif direction == "either":
+            condition = or_(type.id.in_(outgoing), type.id.in_(incoming))
+        elif direction == "both":
+            condition = and_(type.id.in_(outgoing), type.id.in_(incoming))
+
+        return _page(type.query.filter(condition), type, limit=limit)
+
+    @classmethod
+    def neighbors_many(cls, nodes, type=None, direction="to"):
+        """Get the neighbors of many nodes at once.
+
+        Return a dictionary mapping each node in ``nodes`` to the list of its
+        neighbors, as :func:`~dallinger.models.Node.neighbors` would return
+        them. ``type`` and ``direction`` behave as they do for ``neighbors``.
+        All the neighbors are fetched with a single query.
+        """
+        if type is None:
+            type = Node
+        if not issubclass(type, Node):
+            raise ValueError("{} is not a valid neighbor type,"
+                             "needs to be a subclass of Node.".format(type))
 
-        if direction == "from":
-            incoming_vectors = Vector.query.with_entities(Vector.origin_id)\
-                .filter_by(destination_id=self.id, failed=False).all()
+        if direction not in ["both", "either", "from", "to"]:
+            raise ValueError("{} not a valid neighbor connection."
+                             "Should be both, either, to or from."
+                             .format(direction))
 
-            neighbor_ids = [v.origin_id for v in incoming_vectors]
-            if neighbor_ids:
-                neighbors = Node.query.filter(Node.id.in_(neighbor_ids)).all()
-                neighbors = [n for n in neighbors if isinstance(n, type)]
+        nodes = list(nodes)
+        ids = [n.id for n in nodes]
+        if not ids:
+            return {}
 
-        if direction == "either":
-            neighbors = list(set(self.neighbors(type=type, direction="to") +
-                                 self.neighbors(type=type, direction="from")))
+        to_condition = and_(Vector.origin_id.in_(ids),
+                            Vector.destination_id == type.id)
+        from_condition = and_(Vector.destination_id.in_(ids),
+                              Vector.origin_id == type.id)
+        if direction == "to":
+            condition = to_condition
+        elif direction == "from":
+            condition = from_condition
+        else:
+            condition = or_(to_condition, from_condition)
 
-        if direction == "both":
-            neighbors = list(set(self.neighbors(type=type, direction="to")) &
-                             set(self.neighbors(type=type, direction="from")))
+        rows = type.query\
+            .join(Vector, condition)\
+            .filter(Vector.failed == false())\
+            .add_columns(Vector.origin_id, Vector.destination_id)\
+            .all()
 
-        return neighbors
+        to = dict((i, {}) for i in ids)
+        from_ = dict((i, {}) for i in ids)
+        for neighbor, origin_id, destination_id in rows:
+            if origin_id in to and destination_id == neighbor.id:
+                to[origin_id][neighbor.id] = neighbor
+            if destination_id in from_ and origin_id == neighbor.id:
+                from_[destination_id][neighbor.id] = neighbor
+
+        adjacency = {}
+        for node in nodes:
+            outgoing = to[node.id]
+            incoming = from_[node.id]
+            if direction == "to":
+                neighbors = list(outgoing.values())
+            elif direction == "from":
+                neighbors = list(incoming.values())
+            elif direction == "either":
+                either = dict(outgoing)
+                either.update(incoming)
+                neighbors = list(either.values())
+            elif direction == "both":
+                neighbors = [n for i, n in outgoing.items() if i in incoming]
+            adjacency[node] = neighbors
+        return adjacency
 
     def is_connected(self, whom, direction="to", failed=None):
         """Check whether this node is connected [to/from] whom.
@@ -847,53 +1578,55 @@ class Node(Base, SharedMixin):
             raise ValueError("{} is not a valid direction for is_connected"
                              .format(direction))
 
-        # get is_connected
-        connected = []
-        if direction == "to":
-            vectors = Vector.query.with_entities(Vector.destination_id)\
-                .filter_by(origin_id=self.id, failed=False).all()
-            destinations = set([v.destination_id for v in vectors])
-            for w in whom_ids:
-                connected.append(w in destinations)
-
-        elif direction == "from":
-            vectors = Vector.query.with_entities(Vector.origin_id)\
-                .filter_by(destination_id=self.id, failed=False).all()
-            origins = set([v.origin_id for v in vectors])
-            for w in whom_ids:
-                connected.append(w in origins)
+        # get is_connected, fetching only the vectors between self and whom
+        if not whom_ids:
+            return [] if is_list else False
 
-        elif direction in ["either", "both"]:
+        vectors = Vector.query\
+            .with_entities(Vector.origin_id, Vector.destination_id)\
+            .filter(and_(Vector.failed == false(),
+                         or_(and_(Vector.origin_id == self.id,
+                                  Vector.destination_id.in_(whom_ids)),
+                             and_(Vector.destination_id == self.id,
+                                  Vector.origin_id.in_(whom_ids))))).all()
 
-            vectors = Vector.query\
-                .with_entities(Vector.origin_id, Vector.destination_id)\
-                .filter(and_(Vector.failed == false(),
-                             or_(Vector.destination_id == self.id,
-                                 Vector.origin_id == self.id))).all()
+        destinations = set([v.destination_id for v in vectors
+                            if v.origin_id == self.id])
+        origins = set([v.origin_id for v in vectors
+                       if v.destination_id == self.id])
 
-            destinations = set([v.destination_id for v in vectors])
-            origins = set([v.origin_id for v in vectors])
-
-            if direction == "either":
-                origins_destinations = destinations.union(origins)
-
-            elif direction == "both":
-                origins_destinations = destinations.intersection(origins)
+        if direction == "to":
+            origins_destinations = destinations
+        elif direction == "from":
+            origins_destinations = origins
+        elif direction == "either":
+            origins_destinations = destinations.union(origins)
+        elif direction == "both":
+            origins_destinations = destinations.intersection(origins)
 
-            for w in whom_ids:
-                connected.append(w in origins_destinations)
+        connected = [w in origins_destinations for w in whom_ids]
 
         if is_list:
             return connected
         else:
             return connected[0]
 
-    def infos(self, type=None, failed=False):
+    def infos(self, type=None, failed=False, after_id=None, since=None,
+              limit=None):
         """Get infos that originate from this node.
 
         Type must be a subclass of :class:`~dallinger.models.Info`, the default is
         ``Info``. Failed can be True, False or "all".
 
+        To fetch only some of the infos, pass ``after_id`` to skip those with
+        an id up to and including it, ``since`` (a datetime) to skip those
+        created before then, and ``limit`` to cap how many are returned. The
+        infos are then ordered by id and returned as a
+        :class:`~dallinger.models.Page`, whose ``next_after_id`` can be
+        passed as the next ``after_id``. ``since`` is compared with times
+        taken from the clocks of the servers that wrote the rows, so it is
+        only a best-effort filter; page with ``after_id`` to be sure of
+        seeing every new info.
         """
         if type is None:
             type = Info
@@ -907,21 +1640,45 @@ class Node(Base, SharedMixin):
         if failed not in ["all", False, True]:
             raise ValueError("{} is not a valid vector failed".format(failed))
 
-        if failed == "all":
-            return type\
-                .query\
-                .filter_by(origin_id=self.id)\
-                .all()
-        else:
-            return type\
-                .query\
-                .filter_by(origin_id=self.id, failed=failed)\
-                .all()
+        query = type.query.filter_by(origin_id=self.id)
+        if failed != "all":
+            query = query.filter_by(failed=failed)
+
+        return _page(query, type, after_id, since, limit)
 
-    def received_infos(self, type=None, failed=None):
+    def latest_info(self, type=None):
+        """Get the most recently created not-failed info from this node.
+
+        Type must be a subclass of :class:`~dallinger.models.Info`, the default
+        is ``Info``. Returns None if the node has no such infos.
+        """
+        if type is None:
+            type = Info
+
+        if not issubclass(type, Info):
+            raise TypeError(
+                "Cannot get infos of type {} "
+                "as it is not a valid type.".format(type)
+            )
+
+        return type.query\
+            .filter_by(origin_id=self.id, failed=False)\
+            .order_by(type.creation_time.desc(), type.id.desc())\
+            .first()
+
+    def received_infos(self, type=None, failed=None, after_id=None,
+                       since=None, limit=None):
         """Get infos that have been sent to this node.
 
         Type must be a subclass of info, the default is Info.
+        after_id, since and limit fetch a page of the infos, see
+        :func:`~dallinger.models.Node.infos`, except that the page is of
+        the transmissions that delivered them: ``after_id`` is a
+        transmission id, the page's ``next_after_id`` is the id of its last
+        transmission and ``since`` skips infos received before then. So an
+        info received after a page was fetched is in the next page even if
+        it is older than the infos already received, and an info received
+        again is returned again.
         """
         if failed is not None:
             raise ValueError(
@@ -943,24 +1700,33 @@ class Node(Base, SharedMixin):
                 "as it is not a valid type.".format(type)
             )
 
+        if after_id is not None or since is not None or limit is not None:
+            query = type.query\
+                .join(Transmission, Transmission.info_id == type.id)\
+                .filter(Transmission.destination_id == self.id,
+                        Transmission.status == "received",
+                        Transmission.failed == false())
+            return _page(query, type, after_id, since, limit,
+                         changed=[Transmission.receive_time],
+                         cursor=Transmission.id)
+
         transmissions = Transmission\
             .query.with_entities(Transmission.info_id)\
             .filter_by(destination_id=self.id,
                        status="received",
-                       failed=False).all()
-
-        info_ids = [t.info_id for t in transmissions]
-        if info_ids:
-            return type.query.filter(type.id.in_(info_ids)).all()
-        else:
-            return []
+                       failed=False)
+        return type.query.filter(type.id.in_(transmissions.subquery())).all()
 
-    def transmissions(self, direction="outgoing", status="all", failed=False):
+    def transmissions(self, direction="outgoing", status="all", failed=False,
+                      after_id=None, since=None, limit=None):
         """Get transmissions sent to or from this node.
 
         Direction can be "all", "incoming" or "outgoing" (default).
         Status can be "all" (default), "pending", or "received".
         failed can be True, False or "all"
+        after_id, since and limit fetch a page of the transmissions, see
+        :func:`~dallinger.models.Node.infos`, except that ``since`` keeps
+        transmissions that were either sent or received after then.
         """
         # check parameters
         if direction not in ["incoming", "outgoing", "all"]:
@@ -981,47 +1747,22 @@ class Node(Base, SharedMixin):
 
         # get transmissions
         if direction == "all":
-            if status == "all":
-                return Transmission.query\
-                    .filter(and_(Transmission.failed == false(),
-                                 or_(Transmission.destination_id == self.id,
-                                     Transmission.origin_id == self.id)))\
-                    .order_by('creation_time')\
-                    .all()
-            else:
-                return Transmission.query\
-                    .filter(and_(Transmission.failed == false(),
-                                 Transmission.status == status,
-                                 or_(Transmission.destination_id == self.id,
-                                     Transmission.origin_id == self.id)))\
-                    .order_by('creation_time')\
-                    .all()
-        if direction == "incoming":
-            if status == "all":
-                return Transmission.query\
-                    .filter_by(failed=False, destination_id=self.id)\
-                    .order_by('creation_time')\
-                    .all()
-            else:
-                return Transmission.query\
-                    .filter(and_(Transmission.failed == false(),
-                                 Transmission.destination_id == self.id,
-                                 Transmission.status == status))\
-                    .order_by('creation_time')\
-                    .all()
-        if direction == "outgoing":
-            if status == "all":
-                return Transmission.query\
-                    .filter_by(failed=False, origin_id=self.id)\
-                    .order_by('creation_time')\
-                    .all()
-            else:
-                return Transmission.query\
-                    .filter(and_(Transmission.failed == false(),
-                                 Transmission.origin_id == self.id,
-                                 Transmission.status == status))\
-                    .order_by('creation_time')\
-                    .all()
+            query = Transmission.query\
+                .filter(or_(Transmission.destination_id == self.id,
+                            Transmission.origin_id == self.id))
+        elif direction == "incoming":
+            query = Transmission.query.filter_by(destination_id=self.id)
+        elif direction == "outgoing":
+            query = Transmission.query.filter_by(origin_id=self.id)
+
+        query = query.filter_by(failed=False)
+        if status != "all":
+            query = query.filter_by(status=status)
+
+        return _page(query.order_by('creation_time'), Transmission,
+                     after_id, since, limit,
+                     changed=[Transmission.creation_time,
+                              Transmission.receive_time])
 
     def transformations(self, type=None, failed=False):
         """
@@ -1074,14 +1815,25 @@ class Node(Base, SharedMixin):
             self.time_of_death = timenow()
             self.network.calculate_full()
 
-            for v in self.vectors():
-                v.fail()
-            for i in self.infos():
-                i.fail()
-            for t in self.transmissions(direction="all"):
-                t.fail()
-            for t in self.transformations():
-                t.fail()
+            cache = _loaded_cache(self, self.network_id)
+            if cache is not None:
+                cache.remove_node(self)
+
+            session = object_session(self)
+            if session is None:
+                # Without a session the contents can only be failed one by one
+                for v in self.vectors():
+                    v.fail()
+                for i in self.infos():
+                    i.fail()
+                for t in self.transmissions(direction="all"):
+                    t.fail()
+                for t in self.transformations():
+                    t.fail()
+                return
+
+            session.flush()
+            _fail_node_contents(session, [self.id], self.time_of_death)
 
     def connect(self, whom, direction="to"):
         """Create a vector from self to/from whom.
@@ -1142,11 +1894,17 @@ class Node(Base, SharedMixin):
 
     def flatten(self, lst):
         """Turn a list of lists into a list."""
-        if lst == []:
-            return lst
-        if isinstance(lst[0], list):
-            return self.flatten(lst[0]) + self.flatten(lst[1:])
-        return lst[:1] + self.flatten(lst[1:])
+        flat = []
+        stack = [iter(lst)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, list):
+                    stack.append(iter(item))
+                    break
+                flat.append(item)
+            else:
+                stack.pop()
+        return flat
 
     def transmit(self, what=None, to_whom=None):
         """Transmit one or more infos from one node to another.
@@ -1170,6 +1928,93 @@ class Node(Base, SharedMixin):
             (3) to_whom is/contains a node that the transmitting node does not
                 have a not-failed connection with.
         """
+        whats, to_whoms = self._transmit_targets(what, to_whom)
+        vectors = self._vectors_to(to_whoms)
+
+        transmissions = []
+        for what in whats:
+            for to_whom in to_whoms:
+                t = Transmission(info=what, vector=vectors[to_whom.id])
+                transmissions.append(t)
+
+        return transmissions
+
+    def transmit_many(self, what=None, to_whom=None, properties=None):
+        """Transmit infos to nodes with a single INSERT.
+
+        "what" and "to_whom" accept the same values as for
+        :func:`~dallinger.models.Node.transmit`, and the same errors are
+        raised. Rather than building a Transmission object for every pair of
+        info and recipient, all the transmissions are written to the
+        database in one statement and then loaded back, so this is much
+        faster when sending many infos or sending to many nodes.
+
+        properties can be a dict of values for the property1 - property5
+        columns of the new transmissions.
+
+        Returns the new transmissions, ordered by id.
+        """
+        whats, to_whoms = self._transmit_targets(what, to_whom)
+        vectors = self._vectors_to(to_whoms)
+
+        for info in whats:
+            if info.failed:
+                raise ValueError("Cannot transmit {} as it has failed."
+                                 .format(info))
+            if info.origin_id != self.id:
+                raise ValueError("{} cannot transmit {} as it does not "
+                                 "originate from them".format(self, info))
+
+        if not whats or not to_whoms:
+            return []
+
+        properties = properties or {}
+        for key in properties:
+            if key not in ("property1", "property2", "property3",
+                           "property4", "property5"):
+                raise ValueError("{} is not a property of a transmission"
+                                 .format(key))
+
+        session = object_session(self)
+        if any(info.id is None for info in whats):
+            session.flush()
+
+        now = timenow()
+        rows = []
+        for info in whats:
+            for to_whom in to_whoms:
+                vector = vectors[to_whom.id]
+                row = {
+                    "creation_time": now,
+                    "failed": False,
+                    "status": "pending",
+                    "vector_id": vector.id,
+                    "info_id": info.id,
+                    "origin_id": self.id,
+                    "destination_id": vector.destination_id,
+                    "network_id": vector.network_id,
+                }
+                row.update(properties)
+                rows.append(row)
+
+        table = Transmission.__table__
+        ids = session.execute(
+            table.insert().values(rows).returning(table.c.id)).fetchall()
+        mark_changed(session)
+
+        transmissions = Transmission.query\
+            .filter(Transmission.id.in_([id for id, in ids]))\
+            .order_by(Transmission.id)\
+            .all()
+        if Transmission.push:
+            _push_transmissions(transmissions)
+        return transmissions
+
+    def _transmit_targets(self, what, to_whom):
+        """Resolve the what and to_whom arguments of transmit.
+
+        Returns the set of infos to send and the set of nodes to send to.
+        """
         whats = set()
         for what in self.flatten([what]):
             if what is None:
@@ -1188,21 +2033,21 @@ class Node(Base, SharedMixin):
             else:
                 to_whoms.add(to_whom)
 
-        transmissions = []
-        vectors = self.vectors(direction="outgoing")
-        for what in whats:
-            for to_whom in to_whoms:
-                try:
-                    vector = [v for v in vectors
-                              if v.destination_id == to_whom.id][0]
-                except IndexError:
-                    raise ValueError(
-                        "{} cannot transmit to {} as it does not have "
-                        "a connection to them".format(self, to_whom))
-                t = Transmission(info=what, vector=vector)
-                transmissions.append(t)
+        return whats, to_whoms
 
-        return transmissions
+    def _vectors_to(self, to_whoms):
+        """The outgoing vectors to to_whoms, keyed by destination id.
+
+        Raises a ValueError if any of to_whoms is not connected to.
+        """
+        vectors = {v.destination_id: v
+                   for v in self.vectors(direction="outgoing")}
+        for to_whom in to_whoms:
+            if to_whom.id not in vectors:
+                raise ValueError(
+                    "{} cannot transmit to {} as it does not have "
+                    "a connection to them".format(self, to_whom))
+        return vectors
 
     def _what(self):
         """What to transmit if what is not specified.
@@ -1245,21 +2090,15 @@ class Node(Base, SharedMixin):
             raise ValueError("{} cannot receive as it has failed."
                              .format(self))
 
-        received_transmissions = []
         if what is None:
-            pending_transmissions = self.transmissions(direction="incoming",
-                                                       status="pending")
-            for transmission in pending_transmissions:
-                transmission.status = "received"
-                transmission.receive_time = timenow()
-                received_transmissions.append(transmission)
+            infos = self._receive_pending()
 
         elif isinstance(what, Transmission):
             if what in self.transmissions(direction="incoming",
                                           status="pending"):
-                transmission.status = "received"
+                what.status = "received"
                 what.receive_time = timenow()
-                received_transmissions.append(what)
+                infos = [what.info]
             else:
                 raise ValueError(
                     "{} cannot receive {} as it is not "
@@ -1268,7 +2107,42 @@ class Node(Base, SharedMixin):
         else:
             raise ValueError("Nodes cannot receive {}".format(what))
 
-        self.update([t.info for t in received_transmissions])
+        self.update(infos)
+
+    def _receive_pending(self):
+        """Mark all pending transmissions to this node as received.
+
+        This is done with a single UPDATE ... RETURNING, and the transmitted
+        infos are then loaded in a single query. Returns the infos in the
+        order in which they were transmitted.
+        """
+        session = object_session(self)
+        session.flush()
+
+        table = Transmission.__table__
+        received = session.execute(
+            table.update()
+            .where(and_(table.c.destination_id == self.id,
+                        table.c.status == "pending",
+                        table.c.failed == false()))
+            .values(status="received", receive_time=timenow())
+            .returning(table.c.id, table.c.info_id, table.c.creation_time)
+        ).fetchall()
+        received.sort(key=lambda row: (row.creation_time, row.id))
+        if received:
+            mark_changed(session)
+
+        # Transmissions already in the session no longer match the database.
+        _expire_in_session(session, Transmission,
+                           [row.id for row in received],
+                           ["status", "receive_time"])
+
+        info_ids = [row.info_id for row in received]
+        if not info_ids:
+            return []
+        infos = {info.id: info for info in
+                 Info.query.filter(Info.id.in_(set(info_ids))).all()}
+        return [infos[info_id] for info_id in info_ids]
 
     def update(self, infos):
         """Process received infos.
@@ -1370,6 +2244,13 @@ class Vector(Base, SharedMixin):
         self.network = origin.network
         self.network_id = origin.network_id
 
+        cache = _loaded_cache(origin, origin.network_id)
+        if cache is not None:
+            if origin.id is None or destination.id is None:
+                _drop_cache(origin, origin.network_id)
+            else:
+                cache.add_vector(self)
+
     def __repr__(self):
         """The string representation of a vector."""
         return "Vector-{}-{}".format(
@@ -1434,6 +2315,10 @@ class Vector(Base, SharedMixin):
             self.failed = True
             self.time_of_death = timenow()
 
+            cache = _loaded_cache(self, self.network_id)
+            if cache is not None:
+                cache.remove_vector(self)
+
             for t in self.transmissions():
                 t.fail()
 
@@ -1451,8 +2336,19 @@ class Info(Base, SharedMixin):
         'polymorphic_identity': 'info'
     }
 
+    __table_args__ = (
+        # Used to find the latest info made by a node, of any type or of
+        # one type. id breaks ties between infos created at the same time,
+        # so the order is read from the index without sorting. The first
+        # also serves every other lookup by origin_id.
+        Index('ix_info_origin_id_creation_time_id',
+              'origin_id', 'creation_time', 'id'),
+        Index('ix_info_origin_id_type_creation_time_id',
+              'origin_id', 'type', 'creation_time', 'id'),
+    )
+
     #: the id of the Node that created the info
-    origin_id = Column(Integer, ForeignKey('node.id'), index=True)
+    origin_id = Column(Integer, ForeignKey('node.id'))
 
     #: the Node that created the info.
     origin = relationship(Node, backref='all_infos')
@@ -1594,6 +2490,38 @@ class Info(Base, SharedMixin):
                            failed=False)\
                 .all()
 
+    def ancestors(self, depth=None, failed=False):
+        """Get the infos this info was transformed from, at any remove.
+
+        Return a list of (id, depth) rows, where depth is the number of
+        transformations between the ancestor and this info, ordered by depth
+        and then id. Infos reached along more than one chain of
+        transformations are given the shortest. ``depth`` limits how far back
+        to look and ``failed`` can be False (the default), True or "all",
+        and applies to the transformations and infos along the way. The
+        whole lineage is fetched with a single recursive query.
+        """
+        return self._lineage(descending=False, depth=depth, failed=failed)
+
+    def descendants(self, depth=None, failed=False):
+        """Get the infos transformed from this info, at any remove.
+
+        As :func:`~dallinger.models.Info.ancestors`, but following
+        transformations from their ``info_in`` to their ``info_out``.
+        """
+        return self._lineage(descending=True, depth=depth, failed=failed)
+
+    def _lineage(self, descending, depth, failed):
+        lineage = _lineage(select(_lineage_start(literal(self.id, Integer))),
+                           descending, depth, failed)
+        depth = func.min(lineage.c.depth).label("depth")
+        return Info.query.session\
+            .query(lineage.c.id, depth)\
+            .filter(lineage.c.depth > 0)\
+            .group_by(lineage.c.id)\
+            .order_by(depth, lineage.c.id)\
+            .all()
+
     def _mutated_contents(self):
         """The mutated contents of an info.
 
@@ -1654,6 +2582,17 @@ class Transmission(Base, SharedMixin):
     status = Column(Enum("pending", "received", name="transmission_status"),
                     nullable=False, default="pending", index=True)
 
+    __table_args__ = (
+        # Used to find the latest transmission received in a network.
+        Index('ix_transmission_network_id_status_failed_receive_time',
+              'network_id', 'status', 'failed', 'receive_time'),
+    )
+
+    #: whether new transmissions are pushed to their destination over
+    #: redis, on the channel ``node_<destination_id>``. Set from the
+    #: experiment's ``push_transmissions`` by the experiment server.
+    push = False
+
     def __init__(self, vector, info):
         """Create a transmission."""
         # check vector is not failed
@@ -1722,6 +2661,30 @@ class Transmission(Base, SharedMixin):
             self.time_of_death = timenow()
 
 
+def _push_transmissions(transmissions):
+    """Queue a message for the destination of each transmission.
+
+    The message is the json of the transmission and of its info, and is
+    published to the destination's channel once the session commits.
+    """
+    for transmission in sorted(transmissions, key=attrgetter("id")):
+        message = {
+            "transmission": transmission.__json__(),
+            "info": transmission.info.__json__(),
+        }
+        queue_message(
+            "node_{}".format(transmission.destination_id),
+            dumps(message, default=lambda value: value.isoformat()))
+
+
+@event.listens_for(Session, 'after_flush')
+def _push_new_transmissions(session, flush_context):
+    """Push the transmissions created by a flush, if pushing is on."""
+    if Transmission.push:
+        _push_transmissions(
+            [t for t in session.new if isinstance(t, Transmission)])
+
+
 class Transformation(Base, SharedMixin):
     """An instance of one info being transformed into another."""
 
@@ -1,6 +1,5 @@
 """Network structures commonly used in simulations of evolution."""
 
-from operator import attrgetter
 import random
 
 from .models import Network
@@ -21,9 +20,10 @@ class DelayedChain(Network):
 
     def add_node(self, node):
         """Add an agent, connecting it to the previous node."""
-        other_nodes = [n for n in self.nodes() if n.id != node.id]
-        if len(self.nodes()) > 11:
-            parents = [max(other_nodes, key=attrgetter('creation_time'))]
+        nodes = self.cache().nodes()
+        other_nodes = [n for n in nodes if n is not node]
+        if len(nodes) > 11:
+            parents = [other_nodes[-1]]
         else:
             parents = [n for n in other_nodes if isinstance(n, Source)]
 
@@ -41,7 +41,7 @@ class Chain(Network):
 
     def add_node(self, node):
         """Add an agent, connecting it to the previous node."""
-        other_nodes = [n for n in self.nodes() if n.id != node.id]
+        other_nodes = [n for n in self.cache().nodes() if n is not node]
 
         if isinstance(node, Source) and other_nodes:
             raise Exception(
@@ -50,7 +50,7 @@ class Chain(Network):
             )
 
         if other_nodes:
-            parent = max(other_nodes, key=attrgetter('creation_time'))
+            parent = other_nodes[-1]
             parent.connect(whom=node)
 
 
@@ -61,7 +61,7 @@ class FullyConnected(Network):
 
     def add_node(self, node):
         """Add a node, connecting it to everyone and back."""
-        other_nodes = [n for n in self.nodes() if n.id != node.id]
+        other_nodes = [n for n in self.cache().nodes() if n is not node]
 
         for n in other_nodes:
             if isinstance(n, Source):
@@ -81,7 +81,7 @@ class Empty(Network):
 
     def add_source(self, source):
         """Connect the source to all existing other nodes."""
-        nodes = [n for n in self.nodes() if not isinstance(n, Source)]
+        nodes = [n for n in self.cache().nodes() if not isinstance(n, Source)]
         source.connect(whom=nodes)
 
 
@@ -96,10 +96,10 @@ class Star(Network):
 
     def add_node(self, node):
         """Add a node and connect it to the center."""
-        nodes = self.nodes()
+        nodes = self.cache().nodes()
 
         if len(nodes) > 1:
-            first_node = min(nodes, key=attrgetter('creation_time'))
+            first_node = nodes[0]
             first_node.connect(direction="both", whom=node)
 
 
@@ -114,10 +114,10 @@ class Burst(Network):
 
     def add_node(self, node):
         """Add a node and connect it to the center."""
-        nodes = self.nodes()
+        nodes = self.cache().nodes()
 
         if len(nodes) > 1:
-            first_node = min(nodes, key=attrgetter('creation_time'))
+            first_node = nodes[0]
             first_node.connect(whom=node)
 
 
@@ -169,8 +169,8 @@ class DiscreteGenerational(Network):
 
     def add_node(self, node):
         """Link to the agent from a parent based on the parent's fitness"""
-        nodes = [n for n in self.nodes() if not isinstance(n, Source)]
-        num_agents = len(nodes)
+        cache = self.cache()
+        num_agents = cache.size() - cache.size(type=Source)
         curr_generation = int((num_agents - 1) / float(self.generation_size))
         node.generation = curr_generation
 
@@ -187,7 +187,7 @@ class DiscreteGenerational(Network):
             parent.transmit(to_whom=node)
 
     def _select_oldest_source(self):
-        return min(self.nodes(type=Source), key=attrgetter('creation_time'))
+        return self.cache().nodes(type=Source)[0]
 
     def _select_fit_node_from_generation(self, node_type, generation):
         prev_agents = node_type.query\
@@ -235,36 +235,21 @@ class ScaleFree(Network):
 
     def add_node(self, node):
         """Add newcomers one by one, using linear preferential attachment."""
-        nodes = self.nodes()
-
         # Start with a core of m0 fully-connected agents...
-        if len(nodes) <= self.m0:
-            other_nodes = [n for n in nodes if n.id != node.id]
+        if self.size() <= self.m0:
+            other_nodes = [n for n in self.nodes() if n is not node]
             for n in other_nodes:
                 node.connect(direction="both", whom=n)
 
         # ...then add newcomers one by one with preferential attachment.
         else:
-            for idx_newvector in range(self.m):
-
-                these_nodes = [
-                    n for n in nodes if (
-                        n.id != node.id and
-                        not n.is_connected(direction="either", whom=node))]
-
-                outdegrees = [
-                    len(n.vectors(direction="outgoing")) for n in these_nodes]
-
-                # Select a member using preferential attachment
-                ps = [(d / (1.0 * sum(outdegrees))) for d in outdegrees]
-                rnd = random.random() * sum(ps)
-                cur = 0.0
-                for i, p in enumerate(ps):
-                    cur += p
-                    if rnd < cur:
-                        vector_to = these_nodes[i]
-
-                # Create vector from newcomer to selected member and back
+            # Members are drawn in proportion to their out-degree, skipping
+            # the newcomer and anyone it is already connected to, without
+            # loading the rest of the network.
+            targets = self.sample_by_outdegree(self.m, exclude=[node])
+
+            # Create vectors from newcomer to selected members and back
+            for vector_to in targets:
                 node.connect(direction="both", whom=vector_to)
 
 
@@ -288,11 +273,9 @@ class SequentialMicrosociety(Network):
             predecessor.connect(whom=node)
 
     def _most_recent_predecessors_to(self, node):
-        other_nodes = [n for n in self.nodes() if n.id != node.id]
+        other_nodes = [n for n in self.cache().nodes() if n is not node]
 
-        other_nodes_newest_first = sorted(
-            other_nodes, key=attrgetter('creation_time'), reverse=True
-        )
+        other_nodes_newest_first = list(reversed(other_nodes))
 
         return other_nodes_newest_first[:(self.n - 1)]
 
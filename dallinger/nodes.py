@@ -1,15 +1,16 @@
 """Define kinds of nodes: agents, sources, and environments."""
 
-from operator import attrgetter
 import random
 
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import reconstructor
 from sqlalchemy import Float
 from sqlalchemy.sql.expression import cast
 
 from dallinger.information import State
 from dallinger.models import Info
 from dallinger.models import Node
+from dallinger.models import timenow
 
 
 class Agent(Node):
@@ -96,17 +97,69 @@ class Environment(Node):
 
     __mapper_args__ = {"polymorphic_identity": "environment"}
 
+    #: How many past state lookups each environment remembers.
+    state_cache_size = 32
+
+    def __init__(self, *args, **kwargs):
+        super(Environment, self).__init__(*args, **kwargs)
+        self._init_state_cache()
+
+    @reconstructor
+    def _init_state_cache(self):
+        """Start with no remembered lookups, when created or loaded.
+
+        The cache is a plain attribute, not a mapped column, and is kept as
+        (created, until, state) tuples, oldest first.
+        """
+        self._state_cache = []
+
     def state(self, time=None):
         """The most recently-created info of type State at the specfied time.
 
         If time is None then it returns the most recent state as of now.
+        Otherwise it returns the most recent state created before time.
+        Raises a ValueError if there is no such state.
+
+        Lookups of past times are remembered. If the state created before
+        time was created at c, then it is also the state at every time
+        between c and time, so later lookups in that range don't touch the
+        database.
         """
-        if time is None:
-            return max(self.infos(type=State), key=attrgetter('creation_time'))
-        else:
-            states = [
-                s for s in self.infos(type=State) if s.creation_time < time]
-            return max(states, key=attrgetter('creation_time'))
+        if time is not None:
+            for index, (created, until, state) in enumerate(self._state_cache):
+                if created < time <= until:
+                    if not state.failed:
+                        return state
+                    del self._state_cache[index]
+                    break
+
+        query = State.query.filter_by(origin_id=self.id, failed=False)
+        if time is not None:
+            query = query.filter(State.creation_time < time)
+        state = query\
+            .order_by(State.creation_time.desc(), State.id.desc())\
+            .first()
+
+        if state is None:
+            raise ValueError("{} has no state{}".format(
+                self, "" if time is None else " before {}".format(time)))
+
+        # States are created with the current time, so the state at a past
+        # time can only change if that state fails.
+        if time is not None and time <= timenow():
+            self._remember_state(state, time)
+        return state
+
+    def _remember_state(self, state, time):
+        """Remember that state is the state from its creation up to time."""
+        cache = self._state_cache
+        for index, (created, until, cached) in enumerate(cache):
+            if cached is state:
+                cache[index] = (created, max(until, time), state)
+                return
+        cache.append((state.creation_time, time, state))
+        if len(cache) > self.state_cache_size:
+            del cache[0]
 
     def update(self, contents):
         state = State(origin=self, contents=contents)
@@ -2,6 +2,7 @@
 
 import random
 
+from .models import Info
 from .nodes import Agent
 from .nodes import Source
 
@@ -14,7 +15,7 @@ def random_walk(network):
     """
     latest = network.latest_transmission_recipient()
 
-    if (not network.transmissions() or latest is None):
+    if latest is None:  # nothing received yet, start from a source
         sender = random.choice(network.nodes(type=Source))
     else:
         sender = latest
@@ -30,7 +31,7 @@ def moran_cultural(network):
     At eachtime step, an individual is chosen to receive information from
     another individual. Nobody dies, but perhaps their ideas do.
     """
-    if not network.transmissions():  # first step, replacer is a source
+    if not network.has_transmissions():  # first step, replacer is a source
         replacer = random.choice(network.nodes(type=Source))
         replacer.transmit()
     else:
@@ -38,11 +39,12 @@ def moran_cultural(network):
         replaced = random.choice(
             replacer.neighbors(direction="to", type=Agent))
 
-        from operator import attrgetter
+        latest_info = Info.query\
+            .filter_by(origin_id=replacer.id, failed=False)\
+            .order_by(Info.creation_time.desc(), Info.id.desc())\
+            .first()
 
-        replacer.transmit(
-            what=max(replacer.infos(), key=attrgetter('creation_time')),
-            to_whom=replaced)
+        replacer.transmit(what=latest_info, to_whom=replaced)
 
 
 def moran_sexual(network):
@@ -52,7 +54,7 @@ def moran_sexual(network):
     individual is chosen to die. The replication replaces the one who dies.
     For this process to work you need to add a new agent before calling step.
     """
-    if not network.transmissions():
+    if not network.has_transmissions():
         replacer = random.choice(network.nodes(type=Source))
         replacer.transmit()
     else:
@@ -0,0 +1,1057 @@
+"""Run networks and processes in memory, without a database.
+
+A :class:`Simulation` holds networks, nodes, vectors, infos, transmissions
+and transformations as plain Python objects. Each is an instance of a
+subclass of the class being simulated, such as
+:class:`~dallinger.nodes.ReplicatorAgent`, whose columns are plain
+attributes and whose database methods are replaced by in-memory versions.
+Network topologies, node classes and the functions in
+:mod:`dallinger.processes` can therefore be run against them unmodified,
+which is far faster than going through the database for every step. When
+the simulation is over its state can be written to the database in bulk
+with :func:`Simulation.flush`.
+
+The methods and properties that a node, network or info class defines on
+top of the base model, such as ``Agent.fitness``, ``ReplicatorAgent.update``
+or ``ScaleFree.add_node``, are used by the simulated objects, and ``super()``
+works in them as usual. While a simulation is entered, in a ``with``
+statement, ``Model.query`` queries its objects rather than the database, so
+processes such as :func:`~dallinger.processes.moran_cultural` that query
+the models work too. Only simple queries are supported: see
+:class:`SimulatedQuery`. Methods that create model objects directly, such
+as ``Environment.state``, cannot be simulated.
+"""
+
+from collections import OrderedDict
+import datetime
+import itertools
+from operator import attrgetter
+import random
+
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import elements
+from sqlalchemy.sql import operators
+
+from . import db
+from .models import Info
+from .models import Network
+from .models import Node
+from .models import Transformation
+from .models import Transmission
+from .models import Vector
+from .models import _insert_rows
+from .models import _reserve_ids
+from .models import timenow
+from .nodes import Source
+from .transformations import Mutation
+from .transformations import Replication
+
+
+#: Methods of model subclasses that create models directly. The simulated
+#: objects use their own versions of these, unless a further subclass
+#: overrides them.
+_REPLACED = {
+    Source: ("create_information",),
+}
+
+#: The operators that SimulatedQuery.filter() can evaluate.
+_COMPARISONS = (operators.eq, operators.ne, operators.lt, operators.le,
+                operators.gt, operators.ge, operators.is_, operators.isnot)
+
+_sim_classes = {}
+
+
+def _original_init(cls):
+    """The __init__ defined by cls, if any, without SQLAlchemy's wrapper."""
+    init = vars(cls).get("__init__")
+    while hasattr(init, "_sa_original_init"):
+        init = init._sa_original_init
+    return init
+
+
+def _sim_class(kind, model, base):
+    """The class of the simulated objects of kind, which subclasses model.
+
+    The class subclasses kind and base, which subclasses model, so the
+    methods of kind and its parents come first, then the in-memory versions
+    in base, then the rest of model. SQLAlchemy copies the columns and
+    relationships of a mapped class onto its subclasses, so these are
+    replaced here by plain attributes, or by the properties base defines.
+    """
+    key = (kind, base)
+    if key not in _sim_classes:
+        if not issubclass(kind, model):
+            raise TypeError("{} is not a subclass of {}".format(kind, model))
+
+        namespace = {"__abstract__": True, "_kind": kind}
+        for cls in kind.__mro__:
+            if cls in model.__mro__:
+                break
+            init = _original_init(cls)
+            if init is not None and init is not _original_init(model):
+                namespace["_kind_init"] = init
+                break
+
+        for cls, names in _REPLACED.items():
+            if not issubclass(kind, cls):
+                continue
+            for name in names:
+                owner = next(c for c in kind.__mro__ if name in vars(c))
+                if owner is cls:
+                    namespace[name] = vars(base)[name]
+
+        own = [c for c in base.__mro__ if c not in model.__mro__]
+        for name in class_mapper(kind).attrs.keys():
+            namespace[name] = next(
+                (vars(c)[name] for c in own if name in vars(c)), None)
+
+        bases = (base,) if kind is model else (kind, base)
+        _sim_classes[key] = type(str(kind.__name__), bases, namespace)
+    return _sim_classes[key]
+
+
+def _check_failed(failed):
+    if failed not in ["all", False, True]:
+        raise ValueError("{} is not a valid failed".format(failed))
+
+
+def _matches(obj, failed):
+    return failed == "all" or obj.failed == failed
+
+
+def _literal(clause):
+    """The Python value of a literal in a SQL expression."""
+    if isinstance(clause, elements.BindParameter):
+        return clause.value
+    if isinstance(clause, elements.Null):
+        return None
+    if isinstance(clause, (elements.True_, elements.False_)):
+        return isinstance(clause, elements.True_)
+    raise NotImplementedError(
+        "{} cannot be evaluated in a simulation.".format(clause))
+
+
+def _comparison(criterion):
+    """The column, operator and value of a criterion like ``Info.id > 3``."""
+    if (not isinstance(criterion, elements.BinaryExpression) or
+            criterion.operator not in _COMPARISONS or
+            not isinstance(criterion.left, elements.ColumnElement)):
+        raise NotImplementedError(
+            "{} cannot be evaluated in a simulation.".format(criterion))
+    return criterion.left.key, criterion.operator, _literal(criterion.right)
+
+
+def _ordering(clause):
+    """The column of an order_by clause and whether it is descending."""
+    modifier = getattr(clause, "modifier", None)
+    if modifier in (operators.asc_op, operators.desc_op):
+        return clause.element.key, modifier is operators.desc_op
+    if isinstance(clause, (QueryableAttribute, elements.ColumnElement)):
+        return clause.key, False
+    raise NotImplementedError(
+        "Cannot order by {} in a simulation.".format(clause))
+
+
+class Simulation(object):
+    """An in-memory store of networks and their contents.
+
+    Ids are given out in order of creation, as the database would, and every
+    object created gets a creation time one microsecond after the previous
+    one, so ordering by creation time is always well defined.
+
+    Inside ``with simulation:``, ``Model.query`` returns a
+    :class:`SimulatedQuery` of the simulated objects of that model.
+    """
+
+    def __init__(self):
+        """Create an empty simulation."""
+        self._start = timenow()
+        self._ticks = itertools.count()
+        self._ids = dict((model, itertools.count(1)) for model in
+                         (Network, Node, Vector, Info, Transmission,
+                          Transformation))
+        self._objects = OrderedDict((model, []) for model in
+                                    (Network, Node, Vector, Info,
+                                     Transmission, Transformation))
+        self.flushed = False
+
+    def __enter__(self):
+        """Make ``Model.query`` query this simulation until exit."""
+        db.query_property.sources.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        db.query_property.sources.remove(self)
+
+    def query(self, cls):
+        """Query the simulated objects of class cls."""
+        for model, objects in self._objects.items():
+            if issubclass(cls, model):
+                return SimulatedQuery(
+                    [obj for obj in objects if isinstance(obj, cls)])
+        raise NotImplementedError(
+            "{} cannot be queried in a simulation.".format(cls.__name__))
+
+    def now(self):
+        """The simulated time: one microsecond later at every call."""
+        return self._start + datetime.timedelta(microseconds=next(self._ticks))
+
+    def _create(self, kind, model, base):
+        cls = _sim_class(kind, model, base)
+        obj = cls.__new__(cls)
+        obj.simulation = self
+        obj.id = next(self._ids[model])
+        obj.creation_time = self.now()
+        obj.failed = False
+        obj.time_of_death = None
+        obj.details = {}
+        obj.property1 = obj.property2 = obj.property3 = None
+        obj.property4 = obj.property5 = None
+        self._objects[model].append(obj)
+        return obj
+
+    def network(self, kind=Network, *args, **kwargs):
+        """Create a network of class kind.
+
+        The arguments are passed to the ``__init__`` method of kind, if it
+        defines one, or else are set as attributes of the network.
+        """
+        network = self._create(kind, Network, SimulatedNetwork)
+        network.max_size = 1000000
+        network.full = False
+        network.role = "default"
+        network._nodes = []
+        network._vectors = []
+        network._infos = []
+        network._transmissions = []
+        network._transformations = []
+
+        if network._kind_init is not None:
+            network._kind_init(*args, **kwargs)
+        else:
+            SimulatedObject.__init__(network, *args, **kwargs)
+        return network
+
+    def node(self, kind, network):
+        """Create a node of class kind in network.
+
+        As with the models, the node is not passed to the network's
+        ``add_node`` method.
+        """
+        if network.failed:
+            raise ValueError("Cannot create node in {} as it has failed"
+                             .format(network))
+
+        node = self._create(kind, Node, SimulatedNode)
+        node.network = network
+        node.participant_id = None
+        node._outgoing = OrderedDict()
+        node._incoming = OrderedDict()
+        node._infos = []
+        node._transmissions = []
+        node._transformations = []
+        network._nodes.append(node)
+        network.calculate_full()
+        return node
+
+    def info(self, kind, origin, contents=None, details=None):
+        """Create an info of class kind at node origin."""
+        if origin.failed:
+            raise ValueError("{} cannot create an info as it has failed"
+                             .format(origin))
+
+        info = self._create(kind, Info, SimulatedInfo)
+        info.origin = origin
+        info.contents = contents
+        info._transmissions = []
+        info._transformations = []
+        if details:
+            info.details = details
+        origin._infos.append(info)
+        origin.network._infos.append(info)
+        return info
+
+    def _vector(self, origin, destination):
+        vector = self._create(Vector, Vector, SimulatedVector)
+        vector.origin = origin
+        vector.destination = destination
+        vector._transmissions = []
+        origin._outgoing[destination] = vector
+        destination._incoming[origin] = vector
+        origin.network._vectors.append(vector)
+        return vector
+
+    def _transmission(self, vector, info):
+        if vector.failed:
+            raise ValueError("Cannot transmit along {} as it has failed."
+                             .format(vector))
+        if info.failed:
+            raise ValueError("Cannot transmit {} as it has failed."
+                             .format(info))
+        if info.origin is not vector.origin:
+            raise ValueError("Cannot transmit {} along {} as they do not "
+                             "have the same origin".format(info, vector))
+
+        transmission = self._create(Transmission, Transmission,
+                                    SimulatedTransmission)
+        transmission.vector = vector
+        transmission.info = info
+        transmission.status = "pending"
+        transmission.receive_time = None
+        for owner in (vector, info, vector.origin, vector.destination,
+                      vector.network):
+            owner._transmissions.append(transmission)
+        return transmission
+
+    def _transformation(self, kind, info_in, info_out):
+        node = info_out.origin
+        if (info_in.origin is not node and info_in not in [
+                t.info for t in node.transmissions(direction="incoming",
+                                                   status="received")]):
+            raise ValueError(
+                "Cannot transform {} into {} as they are not at the same node."
+                .format(info_in, info_out))
+        for i in [info_in, info_out]:
+            if i.failed:
+                raise ValueError("Cannot transform {} as it has failed"
+                                 .format(i))
+
+        transformation = self._create(kind, Transformation,
+                                      SimulatedTransformation)
+        transformation.info_in = info_in
+        transformation.info_out = info_out
+        for owner in (info_in, info_out, node, node.network):
+            owner._transformations.append(transformation)
+        return transformation
+
+    def flush(self, session):
+        """Write the simulation to the database.
+
+        Ids are reserved from the table sequences in one query per table and
+        the rows are then inserted in batches, so this is much faster than
+        adding the equivalent models to the session. The ids of the simulated
+        objects are updated to match the rows. A simulation can only be
+        flushed once.
+        """
+        if self.flushed:
+            raise ValueError("This simulation has already been flushed.")
+
+        for model, objects in self._objects.items():
+            for obj, id in zip(objects,
+                               _reserve_ids(session, model, len(objects))):
+                obj.id = id
+            _insert_rows(session, model, [obj._row() for obj in objects])
+
+        self.flushed = True
+
+
+class SimulatedObject(object):
+    """Columns and behavior shared by all the simulated objects."""
+
+    _kind = None
+    _kind_init = None
+
+    def __init__(self, *args, **kwargs):
+        """Set the keyword arguments as attributes.
+
+        The constructors of the simulated classes are called by
+        :class:`Simulation`, and their calls to super() end here.
+        """
+        if args:
+            raise TypeError("{} takes no positional arguments"
+                            .format(type(self).__name__))
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    @property
+    def type(self):
+        """The polymorphic identity of the simulated class."""
+        return class_mapper(self._kind).polymorphic_identity
+
+    def _row(self):
+        return {
+            "id": self.id,
+            "creation_time": self.creation_time,
+            "failed": self.failed,
+            "time_of_death": self.time_of_death,
+            "details": self.details,
+            "property1": self.property1,
+            "property2": self.property2,
+            "property3": self.property3,
+            "property4": self.property4,
+            "property5": self.property5,
+        }
+
+    def _fail(self):
+        if self.failed is True:
+            raise AttributeError(
+                "Cannot fail {} - it has already failed.".format(self))
+        self.failed = True
+        self.time_of_death = self.simulation.now()
+
+
+class SimulatedNetwork(SimulatedObject, Network):
+    """A simulated :class:`~dallinger.models.Network`.
+
+    The network is also its own cache, as topologies get the nodes and
+    connections of a network from :func:`~dallinger.models.Network.cache`.
+    """
+
+    __abstract__ = True
+
+    def add_node(self, node):
+        """Add the node to the network."""
+        raise NotImplementedError
+
+    def _row(self):
+        row = SimulatedObject._row(self)
+        row.update(type=self.type, max_size=self.max_size, full=self.full,
+                   role=self.role)
+        return row
+
+    def nodes(self, type=None, failed=False, participant_id=None):
+        """Get nodes in the network, oldest first."""
+        if type is None:
+            type = Node
+        if not issubclass(type, Node):
+            raise TypeError("{} is not a valid node type.".format(type))
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid node failed".format(failed))
+
+        return [n for n in self._nodes
+                if isinstance(n, type) and _matches(n, failed) and
+                (participant_id is None or n.participant_id == participant_id)]
+
+    def size(self, type=None, failed=False):
+        """How many nodes in a network."""
+        return len(self.nodes(type=type, failed=failed))
+
+    def infos(self, type=None, failed=False):
+        """Get infos in the network."""
+        if type is None:
+            type = Info
+        _check_failed(failed)
+        return [i for i in self._infos
+                if isinstance(i, type) and _matches(i, failed)]
+
+    def transmissions(self, status="all", failed=False):
+        """Get transmissions in the network."""
+        if status not in ["all", "pending", "received"]:
+            raise ValueError(
+                "You cannot get transmission of status {}.".format(status) +
+                "Status can only be pending, received or all"
+            )
+        _check_failed(failed)
+        return [t for t in self._transmissions
+                if (status == "all" or t.status == status) and
+                _matches(t, failed)]
+
+    def transformations(self, type=None, failed=False):
+        """Get transformations in the network."""
+        if type is None:
+            type = Transformation
+        _check_failed(failed)
+        return [t for t in self._transformations
+                if isinstance(t, type) and _matches(t, failed)]
+
+    def has_transmissions(self, status="all", failed=False):
+        """Whether the network has any transmissions."""
+        return bool(self.transmissions(status=status, failed=failed))
+
+    def latest_transmission_recipient(self):
+        """Get the node that most recently received a transmission."""
+        received = self.transmissions(status="received")
+        if not received:
+            return None
+        latest = max(received, key=lambda t: (t.receive_time, t.id))
+        return latest.destination
+
+    def vectors(self, failed=False):
+        """Get vectors in the network."""
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid vector failed".format(failed))
+        return [v for v in self._vectors if _matches(v, failed)]
+
+    def cache(self):
+        """The network itself, which offers the NetworkCache methods."""
+        return self
+
+    def outdegree(self, node):
+        """The number of not-failed vectors leaving node."""
+        return len(node._outgoing)
+
+    def indegree(self, node):
+        """The number of not-failed vectors arriving at node."""
+        return len(node._incoming)
+
+    def is_connected(self, node, whom, direction="to"):
+        """Whether node is connected to whom, as Node.is_connected()."""
+        return node.is_connected(whom, direction=direction)
+
+    def sample_by_outdegree(self, k, exclude=()):
+        """Pick k distinct nodes with probability proportional to out-degree.
+
+        Nodes in exclude, and nodes connected in either direction to a node
+        in exclude, are never picked.
+        """
+        excluded = set(exclude)
+        for node in exclude:
+            excluded.update(node._outgoing)
+            excluded.update(node._incoming)
+
+        candidates = [n for n in self.nodes()
+                      if n not in excluded and n._outgoing]
+        chosen = []
+        for _ in range(k):
+            total = sum(len(n._outgoing) for n in candidates)
+            if total <= 0:
+                raise ValueError(
+                    "Cannot pick {} nodes from network {} by out-degree."
+                    .format(k, self.id))
+            target = random.random() * total
+            for i, node in enumerate(candidates):
+                target -= len(node._outgoing)
+                if target < 0:
+                    break
+            chosen.append(candidates.pop(i))
+        return chosen
+
+    def fail(self):
+        """Fail the network and everything in it."""
+        self._fail()
+        for node in self.nodes():
+            node.fail()
+
+
+class SimulatedNode(SimulatedObject, Node):
+    """A simulated :class:`~dallinger.models.Node`."""
+
+    __abstract__ = True
+
+    @property
+    def network_id(self):
+        return self.network.id
+
+    def _row(self):
+        row = SimulatedObject._row(self)
+        row.update(type=self.type, network_id=self.network_id,
+                   participant_id=self.participant_id)
+        return row
+
+    def vectors(self, direction="all", failed=False):
+        """Get vectors that connect at this node."""
+        if direction not in ["all", "incoming", "outgoing"]:
+            raise ValueError(
+                "{} is not a valid vector direction. "
+                "Must be all, incoming or outgoing.".format(direction))
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid vector failed".format(failed))
+
+        if failed is False:
+            # Not-failed vectors are indexed by the nodes they connect.
+            vectors = []
+            if direction in ["all", "outgoing"]:
+                vectors.extend(self._outgoing.values())
+            if direction in ["all", "incoming"]:
+                vectors.extend(self._incoming.values())
+            return sorted(vectors, key=lambda v: v.id)
+
+        return [v for v in self.network._vectors if _matches(v, failed) and (
+            direction in ["all", "outgoing"] and v.origin is self or
+            direction in ["all", "incoming"] and v.destination is self)]
+
+    def neighbors(self, type=None, direction="to", failed=None):
+        """Get the not-failed nodes connected to this node."""
+        if type is None:
+            type = Node
+        if not issubclass(type, Node):
+            raise ValueError("{} is not a valid neighbor type,"
+                             "needs to be a subclass of Node.".format(type))
+        if direction not in ["both", "either", "from", "to"]:
+            raise ValueError("{} not a valid neighbor connection."
+                             "Should be both, either, to or from."
+                             .format(direction))
+        if failed is not None:
+            raise ValueError(
+                "You should not pass a failed argument to neighbors().")
+
+        if direction == "to":
+            nodes = list(self._outgoing)
+        elif direction == "from":
+            nodes = list(self._incoming)
+        elif direction == "either":
+            nodes = list(self._outgoing) + [
+                n for n in self._incoming if n not in self._outgoing]
+        elif direction == "both":
+            nodes = [n for n in self._outgoing if n in self._incoming]
+        return [n for n in nodes if isinstance(n, type)]
+
+    def is_connected(self, whom, direction="to", failed=None):
+        """Check whether this node is connected [to/from] whom."""
+        if failed is not None:
+            raise ValueError(
+                "You should not pass a failed argument to is_connected.")
+
+        is_list = isinstance(whom, list)
+        if not is_list:
+            whom = [whom]
+
+        for node in whom:
+            if not isinstance(node, Node):
+                raise TypeError("is_connected cannot parse objects of type {}."
+                                .format(type(node)))
+
+        if direction == "to":
+            connected = [w in self._outgoing for w in whom]
+        elif direction == "from":
+            connected = [w in self._incoming for w in whom]
+        elif direction == "either":
+            connected = [w in self._outgoing or w in self._incoming
+                         for w in whom]
+        elif direction == "both":
+            connected = [w in self._outgoing and w in self._incoming
+                         for w in whom]
+        else:
+            raise ValueError("{} is not a valid direction for is_connected"
+                             .format(direction))
+
+        if is_list:
+            return connected
+        return connected[0] if connected else False
+
+    def infos(self, type=None, failed=False):
+        """Get infos that originate from this node, oldest first."""
+        if type is None:
+            type = Info
+        if not issubclass(type, Info):
+            raise TypeError(
+                "Cannot get infos of type {} "
+                "as it is not a valid type.".format(type)
+            )
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid vector failed".format(failed))
+        return [i for i in self._infos
+                if isinstance(i, type) and _matches(i, failed)]
+
+    def latest_info(self, type=None):
+        """Get the most recently created not-failed info from this node."""
+        infos = self.infos(type=type)
+        return infos[-1] if infos else None
+
+    def received_infos(self, type=None, failed=None):
+        """Get infos that have been sent to this node."""
+        if failed is not None:
+            raise ValueError(
+                "You should not pass a failed argument to received_infos.")
+        if type is None:
+            type = Info
+        if not issubclass(type, Info):
+            raise TypeError(
+                "Cannot get infos of type {} "
+                "as it is not a valid type.".format(type)
+            )
+        return [t.info for t in self.transmissions(direction="incoming",
+                                                   status="received")
+                if isinstance(t.info, type)]
+
+    def transmissions(self, direction="outgoing", status="all", failed=False):
+        """Get transmissions sent to or from this node, oldest first."""
+        if direction not in ["incoming", "outgoing", "all"]:
+            raise ValueError(
+                "You cannot get transmissions of direction {}.".format(direction) +
+                "Type can only be incoming, outgoing or all."
+            )
+        if status not in ["all", "pending", "received"]:
+            raise ValueError(
+                "You cannot get transmission of status {}.".format(status) +
+                "Status can only be pending, received or all"
+            )
+        if failed not in ["all", False, True]:
+            raise ValueError("{} is not a valid transmission failed"
+                             .format(failed))
+
+        return [t for t in self._transmissions
+                if (direction == "all" or
+                    direction == "outgoing" and t.origin is self or
+                    direction == "incoming" and t.destination is self) and
+                (status == "all" or t.status == status) and
+                _matches(t, failed)]
+
+    def transformations(self, type=None, failed=False):
+        """Get transformations done by this node."""
+        if type is None:
+            type = Transformation
+        _check_failed(failed)
+        return [t for t in self._transformations
+                if t.node is self and isinstance(t, type) and
+                _matches(t, failed)]
+
+    def fail(self):
+        """Fail the node and the vectors, infos, transmissions and
+        transformations that involve it."""
+        self._fail()
+        self.network.calculate_full()
+        for v in list(self._outgoing.values()) + list(self._incoming.values()):
+            v.fail()
+        for i in self._infos:
+            if not i.failed:
+                i.fail()
+        for t in self._transmissions + self._transformations:
+            if not t.failed:
+                t.fail()
+
+    def connect(self, whom, direction="to"):
+        """Create vectors from self to/from whom."""
+        if direction not in ["to", "from", "both"]:
+            raise ValueError("{} is not a valid direction for connect()"
+                             .format(direction))
+
+        whom = self.flatten([whom])
+        pairs = []
+        if direction in ["to", "both"]:
+            pairs.extend((self, node) for node in whom)
+        if direction in ["from", "both"]:
+            pairs.extend((node, self) for node in whom)
+
+        new_vectors = []
+        for origin, destination in pairs:
+            if origin.network is not destination.network:
+                raise ValueError("{}, in network {}, cannot connect with {} "
+                                 "as it is in network {}"
+                                 .format(origin, origin.network_id,
+                                         destination, destination.network_id))
+            for node in (origin, destination):
+                if node.failed:
+                    raise ValueError("{} cannot connect to {} as {} has failed"
+                                     .format(origin, destination, node))
+            if isinstance(destination, Source):
+                raise TypeError("Cannot connect to {} as it is a Source."
+                                .format(destination))
+            if origin is destination:
+                raise ValueError("{} cannot connect to itself.".format(origin))
+
+            if destination in origin._outgoing:
+                print("Warning! {} already connected to {}, "
+                      "instruction to connect will be ignored."
+                      .format(origin, destination))
+            else:
+                new_vectors.append(
+                    self.simulation._vector(origin, destination))
+        return new_vectors
+
+    def transmit(self, what=None, to_whom=None):
+        """Transmit one or more infos from one node to another."""
+        whats, to_whoms = self._transmit_targets(what, to_whom)
+        vectors = self._vectors_to(to_whoms)
+
+        transmissions = []
+        for what in sorted(whats, key=lambda i: i.id):
+            for to_whom in sorted(to_whoms, key=lambda n: n.id):
+                transmissions.append(self.simulation._transmission(
+                    vectors[to_whom.id], what))
+        return transmissions
+
+    def receive(self, what=None):
+        """Receive pending transmissions, or a specific one."""
+        if self.failed:
+            raise ValueError("{} cannot receive as it has failed."
+                             .format(self))
+
+        pending = self.transmissions(direction="incoming", status="pending")
+        if what is None:
+            received = pending
+        elif isinstance(what, Transmission):
+            if what not in pending:
+                raise ValueError(
+                    "{} cannot receive {} as it is not "
+                    "in its pending_transmissions".format(self, what)
+                )
+            received = [what]
+        else:
+            raise ValueError("Nodes cannot receive {}".format(what))
+
+        for t in received:
+            t.mark_received()
+        self.update([t.info for t in received])
+
+    def replicate(self, info_in):
+        """Replicate an info."""
+        if self.failed:
+            raise ValueError("{} cannot replicate as it has failed."
+                             .format(self))
+        info_out = self.simulation.info(info_in._kind, self,
+                                        contents=info_in.contents)
+        self.simulation._transformation(Replication, info_in, info_out)
+
+    def mutate(self, info_in):
+        """Replicate an info + mutation."""
+        if self.failed:
+            raise ValueError("{} cannot mutate as it has failed."
+                             .format(self))
+        info_out = self.simulation.info(
+            info_in._kind, self, contents=info_in._mutated_contents())
+        self.simulation._transformation(Mutation, info_in, info_out)
+
+    def create_information(self):
+        """Create a new info, as :func:`~dallinger.nodes.Source` does."""
+        return self.simulation.info(self._info_type(), self,
+                                    contents=self._contents())
+
+
+class SimulatedVector(SimulatedObject, Vector):
+    """A simulated :class:`~dallinger.models.Vector`."""
+
+    __abstract__ = True
+
+    @property
+    def network(self):
+        return self.origin.network
+
+    @property
+    def origin_id(self):
+        return self.origin.id
+
+    @property
+    def destination_id(self):
+        return self.destination.id
+
+    @property
+    def network_id(self):
+        return self.network.id
+
+    def _row(self):
+        row = SimulatedObject._row(self)
+        row.update(origin_id=self.origin_id,
+                   destination_id=self.destination_id,
+                   network_id=self.network_id)
+        return row
+
+    def transmissions(self, status="all"):
+        """Get transmissions sent along this vector."""
+        if status not in ["all", "pending", "received"]:
+            raise ValueError(("You cannot get {} transmissions."
+                              "Status can only be pending, received or all")
+                             .format(status))
+        return [t for t in self._transmissions if not t.failed and
+                (status == "all" or t.status == status)]
+
+    def fail(self):
+        """Fail the vector and its transmissions."""
+        self._fail()
+        if self.origin._outgoing.get(self.destination) is self:
+            del self.origin._outgoing[self.destination]
+            del self.destination._incoming[self.origin]
+        for t in self.transmissions():
+            t.fail()
+
+
+class SimulatedInfo(SimulatedObject, Info):
+    """A simulated :class:`~dallinger.models.Info`."""
+
+    __abstract__ = True
+
+    @property
+    def network(self):
+        return self.origin.network
+
+    @property
+    def origin_id(self):
+        return self.origin.id
+
+    @property
+    def network_id(self):
+        return self.network.id
+
+    def _row(self):
+        row = SimulatedObject._row(self)
+        row.update(type=self.type, origin_id=self.origin_id,
+                   network_id=self.network_id, contents=self.contents)
+        return row
+
+    def transmissions(self, status="all"):
+        """Get the not-failed transmissions of this info."""
+        if status not in ["all", "pending", "received"]:
+            raise ValueError(
+                "You cannot get transmission of status {}.".format(status) +
+                "Status can only be pending, received or all"
+            )
+        return [t for t in self._transmissions if not t.failed and
+                (status == "all" or t.status == status)]
+
+    def transformations(self, relationship="all"):
+        """Get the not-failed transformations of this info."""
+        if relationship not in ["all", "parent", "child"]:
+            raise ValueError(
+                "You cannot get transformations of relationship {}"
+                .format(relationship) +
+                "Relationship can only be parent, child or all.")
+        return [t for t in self._transformations if not t.failed and
+                (relationship != "parent" or t.info_in is self) and
+                (relationship != "child" or t.info_out is self)]
+
+    def fail(self):
+        """Fail the info and its transmissions and transformations."""
+        self._fail()
+        for t in self.transmissions() + self.transformations():
+            t.fail()
+
+
+class SimulatedTransmission(SimulatedObject, Transmission):
+    """A simulated :class:`~dallinger.models.Transmission`."""
+
+    __abstract__ = True
+
+    @property
+    def origin(self):
+        return self.vector.origin
+
+    @property
+    def destination(self):
+        return self.vector.destination
+
+    @property
+    def network(self):
+        return self.vector.network
+
+    @property
+    def vector_id(self):
+        return self.vector.id
+
+    @property
+    def info_id(self):
+        return self.info.id
+
+    @property
+    def origin_id(self):
+        return self.origin.id
+
+    @property
+    def destination_id(self):
+        return self.destination.id
+
+    @property
+    def network_id(self):
+        return self.network.id
+
+    def _row(self):
+        row = SimulatedObject._row(self)
+        row.update(vector_id=self.vector_id, info_id=self.info_id,
+                   origin_id=self.origin_id,
+                   destination_id=self.destination_id,
+                   network_id=self.network_id,
+                   receive_time=self.receive_time, status=self.status)
+        return row
+
+    def mark_received(self):
+        """Mark a transmission as having been received."""
+        self.receive_time = self.simulation.now()
+        self.status = "received"
+
+    def fail(self):
+        """Fail the transmission."""
+        self._fail()
+
+
+class SimulatedTransformation(SimulatedObject, Transformation):
+    """A simulated :class:`~dallinger.models.Transformation`."""
+
+    __abstract__ = True
+
+    @property
+    def node(self):
+        return self.info_out.origin
+
+    @property
+    def network(self):
+        return self.info_out.network
+
+    @property
+    def info_in_id(self):
+        return self.info_in.id
+
+    @property
+    def info_out_id(self):
+        return self.info_out.id
+
+    @property
+    def node_id(self):
+        return self.node.id
+
+    @property
+    def network_id(self):
+        return self.network.id
+
+    def _row(self):
+        row = SimulatedObject._row(self)
+        row.update(type=self.type, info_in_id=self.info_in_id,
+                   info_out_id=self.info_out_id, node_id=self.node_id,
+                   network_id=self.network_id)
+        return row
+
+    def fail(self):
+        """Fail the transformation."""
+        self._fail()
+
+
+class SimulatedQuery(object):
+    """A query of the objects of a simulation.
+
+    This supports the part of :class:`sqlalchemy.orm.query.Query` that
+    processes and topologies use: ``filter_by``, ``filter`` with comparisons
+    of a column with a value, such as ``Info.creation_time < time``, and
+    ``order_by`` with columns, ascending or descending.
+    """
+
+    def __init__(self, objects):
+        self._objects = objects
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def filter_by(self, **kwargs):
+        """Keep the objects whose attributes equal the keyword arguments."""
+        return SimulatedQuery([
+            obj for obj in self._objects
+            if all(getattr(obj, key) == value
+                   for key, value in kwargs.items())])
+
+    def filter(self, *criteria):
+        """Keep the objects that meet every criterion."""
+        objects = self._objects
+        for key, op, value in [_comparison(c) for c in criteria]:
+            objects = [obj for obj in objects if op(getattr(obj, key), value)]
+        return SimulatedQuery(objects)
+
+    def order_by(self, *clauses):
+        """Sort the objects by the columns given, the first one first."""
+        objects = list(self._objects)
+        for key, descending in reversed([_ordering(c) for c in clauses]):
+            objects.sort(key=attrgetter(key), reverse=descending)
+        return SimulatedQuery(objects)
+
+    def all(self):
+        """The objects, as a list."""
+        return list(self._objects)
+
+    def first(self):
+        """The first object, or None."""
+        return self._objects[0] if self._objects else None
+
+    def one(self):
+        """The only object, which must exist."""
+        if not self._objects:
+            raise NoResultFound("No row was found for one()")
+        if len(self._objects) > 1:
+            raise MultipleResultsFound("Multiple rows were found for one()")
+        return self._objects[0]
+
+    def count(self):
+        """The number of objects."""
+        return len(self._objects)
+
+    def get(self, id):
+        """The object with the given id, or None."""
+        return self.filter_by(id=id).first()
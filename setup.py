@@ -33,6 +33,7 @@ setup_args = dict(
     extras_require={
         'data': [
             "networkx==1.11",
+            "numpy==1.14.5",
             "odo==0.5.0",
             "openpyxl==2.4.11",  # 2.5 is incompatible with tablib
             "pandas==0.22.0",
@@ -42,6 +43,9 @@ setup_args = dict(
             "jupyter",
             "ipywidgets",
         ],
+        'msgpack': [
+            "msgpack==0.5.6",
+        ],
     }
 )
 
@@ -64,6 +64,14 @@ def bartlett_dir(root):
     cwd(root)
 
 
+def reset_experiment_instance():
+    """Discard the experiment instance cached by the experiment server."""
+    import sys
+    if 'dallinger.experiment_server.experiment_server' in sys.modules:
+        from dallinger.experiment_server.experiment_server import reset_experiment
+        reset_experiment()
+
+
 @pytest.fixture(scope='class', autouse=True)
 def reset_config():
     yield
@@ -77,6 +85,9 @@ def reset_config():
     for module in to_delete:
         del sys.modules[module]
 
+    # Make sure the experiment instance isn't kept between tests
+    reset_experiment_instance()
+
     # Make sure extra parameters aren't kept between tests
     import dallinger.config
     dallinger.config.config = None
@@ -378,6 +389,8 @@ def db_session():
     # https://stackoverflow.com/questions/13882407/sqlalchemy-blocked-on-dropping-tables
     dallinger.db.session.close()
     session = dallinger.db.init_db(drop_all=True)
+    # The experiment sets up its networks when first created
+    reset_experiment_instance()
     yield session
     session.rollback()
     session.close()
@@ -411,3 +424,5 @@ def pytest_addoption(parser):
                      help="Run tests requiring heroku login")
     parser.addoption("--griduniverse", action="store_true",
                      help="Run griduinverse tests and fail if not all pass")
+    parser.addoption("--benchmark", action="store_true",
+                     help="Run timing benchmarks and print their results")
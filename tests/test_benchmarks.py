@@ -0,0 +1,307 @@
+"""Timing benchmarks, run with ``pytest --benchmark -s tests/test_benchmarks.py``."""
+from operator import attrgetter
+import random
+import time
+
+import gevent
+import mock
+import pytest
+import redis
+
+from dallinger import nodes, processes
+
+
+@pytest.fixture
+def benchmark(request):
+    if not request.config.getvalue("benchmark"):
+        pytest.skip("need --benchmark option to run")
+
+    def timed(label, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        print("\n{}: {:.3f}s".format(label, time.time() - start))
+        return result
+
+    return timed
+
+
+class TestScaleFreeBenchmark(object):
+
+    def _grow(self, a, db_session, net, size):
+        # Each newcomer joins in a transaction of its own, as participants
+        # do, so nothing is kept between joins.
+        for _ in range(size):
+            net.add_node(a.agent(network=net))
+            db_session.commit()
+
+    def _add_node_by_scanning(self, net, node):
+        """Preferential attachment as done before the out-degree sampling."""
+        other_nodes = [n for n in net.nodes() if n is not node]
+        if len(other_nodes) < net.m0:
+            for n in other_nodes:
+                node.connect(direction="both", whom=n)
+            return
+
+        for _ in range(net.m):
+            these_nodes = [
+                n for n in net.nodes() if (
+                    n is not node and
+                    not n.is_connected(direction="either", whom=node))]
+            outdegrees = [len(n.vectors(direction="outgoing")) for n in these_nodes]
+            rnd = random.random() * sum(outdegrees)
+            for n, d in zip(these_nodes, outdegrees):
+                rnd -= d
+                if rnd < 0:
+                    break
+            node.connect(direction="both", whom=n)
+
+    def test_growth_against_scanning(self, a, db_session, benchmark):
+        size = 150
+        tree = a.scale_free(m0=3, m=2)
+        benchmark("tree, {} nodes".format(size),
+                  self._grow, a, db_session, tree, size)
+
+        scanning = a.scale_free(m0=3, m=2)
+
+        def grow_by_scanning():
+            for _ in range(size):
+                self._add_node_by_scanning(scanning, a.agent(network=scanning))
+                db_session.commit()
+
+        benchmark("scanning, {} nodes".format(size), grow_by_scanning)
+        assert len(tree.vectors()) == len(scanning.vectors())
+
+    def test_large_growth(self, a, db_session, benchmark):
+        size = 1000
+        net = a.scale_free(m0=3, m=2)
+        benchmark("tree, {} nodes".format(size),
+                  self._grow, a, db_session, net, size)
+        assert len(net.nodes(type=nodes.Agent)) == size
+
+
+class TestProcessBenchmark(object):
+
+    def _moran_network(self, a, size):
+        net = a.network()
+        agents = [nodes.ReplicatorAgent(network=net) for _ in range(size)]
+        for agent in agents:
+            agent.connect(whom=[other for other in agents if other is not agent])
+        source = nodes.RandomBinaryStringSource(network=net)
+        source.connect(whom=agents)
+        return net, agents
+
+    def _step(self, net, agents):
+        processes.moran_cultural(net)
+        for agent in agents:
+            agent.receive()
+
+    def test_moran_step_latency_by_history(self, a, benchmark):
+        net, agents = self._moran_network(a, 5)
+        steps = 20
+        for history in (0, 200, 800):
+            while len(net.transmissions()) < history:
+                self._step(net, agents)
+
+            def run_steps():
+                for _ in range(steps):
+                    self._step(net, agents)
+
+            benchmark("{} moran steps after {} transmissions".format(
+                steps, history), run_steps)
+
+            def check_the_old_way():
+                for _ in range(steps):
+                    assert net.transmissions()
+                    max(net.transmissions(status="received"),
+                        key=attrgetter("receive_time"))
+
+            benchmark("  scanning history instead, {} times".format(steps),
+                      check_the_old_way)
+
+
+class TestSimulationBenchmark(object):
+
+    def _run(self, net, agents, steps):
+        for _ in range(steps):
+            processes.moran_cultural(net)
+            for agent in agents:
+                agent.receive()
+
+    def test_moran_in_memory_against_database(self, a, db_session, benchmark):
+        from dallinger.simulation import Simulation
+        size = 10
+        steps = 200
+
+        net, agents = TestProcessBenchmark()._moran_network(a, size)
+        benchmark("database, {} moran steps".format(steps),
+                  self._run, net, agents, steps)
+
+        sim = Simulation()
+        net = sim.network()
+        agents = [sim.node(nodes.ReplicatorAgent, network=net)
+                  for _ in range(size)]
+        for agent in agents:
+            agent.connect(whom=[other for other in agents if other is not agent])
+        sim.node(nodes.RandomBinaryStringSource, network=net).connect(
+            whom=agents)
+        with sim:
+            benchmark("in memory, {} moran steps".format(steps),
+                      self._run, net, agents, steps)
+        benchmark("  flushing to the database", sim.flush, db_session)
+
+
+class TestProcessEngineBenchmark(object):
+
+    def test_moran_engine_against_models(self, a, db_session, benchmark):
+        pytest.importorskip("numpy")
+        from dallinger.engine import ProcessEngine
+        size = 10
+        steps = 200
+
+        net, agents = TestProcessBenchmark()._moran_network(a, size)
+        benchmark("models, {} moran steps".format(steps),
+                  TestSimulationBenchmark()._run, net, agents, steps)
+
+        for steps in (200, 20000):
+            net, agents = TestProcessBenchmark()._moran_network(a, size)
+            engine = ProcessEngine(net)
+            benchmark("engine, {} moran steps".format(steps),
+                      engine.moran_cultural, steps)
+
+
+class TestLineageBenchmark(object):
+
+    def _walk_back(self, info):
+        """Ancestors found by following one transformation at a time."""
+        ancestors = []
+        frontier = [info]
+        while frontier:
+            frontier = [t.info_in for i in frontier
+                        for t in i.transformations(relationship="child")]
+            ancestors.extend(frontier)
+        return ancestors
+
+    def test_ancestors_against_walking(self, a, db_session, benchmark):
+        net, agents = TestProcessBenchmark()._moran_network(a, 5)
+        TestSimulationBenchmark()._run(net, agents, 300)
+        infos = [agent.latest_info() for agent in agents]
+
+        def recursive():
+            return [info.ancestors() for info in infos]
+
+        def walking():
+            return [self._walk_back(info) for info in infos]
+
+        found = benchmark("recursive query, {} lineages".format(len(infos)),
+                          recursive)
+        walked = benchmark("walking transformations", walking)
+        assert [len(f) for f in found] == [len(w) for w in walked]
+
+
+@pytest.mark.usefixtures('experiment_dir', 'active_config')
+class TestExperimentBenchmark(object):
+
+    def test_experiment_per_request(self, db_session, benchmark):
+        from dallinger import experiment
+        from dallinger.experiment_server import experiment_server
+        requests = 200
+
+        def construct_per_request():
+            for _ in range(requests):
+                experiment.load()(db_session)
+
+        def cached_instance():
+            for _ in range(requests):
+                experiment_server.Experiment(db_session)
+
+        benchmark("new experiment, {} requests".format(requests),
+                  construct_per_request)
+        benchmark("cached experiment, {} requests".format(requests),
+                  cached_instance)
+
+
+class BenchmarkSocket(object):
+    """A websocket that sends timestamped messages and times their return.
+
+    Its messages are sent every ``interval`` seconds, whether or not the
+    server is reading them yet.
+    """
+
+    def __init__(self, messages=0, interval=0.02):
+        self.messages = messages
+        self.interval = interval
+        self.closed = False
+        self.latencies = []
+        self.sent = 0
+        self.start = None
+
+    def receive(self):
+        if self.sent == self.messages:
+            self.closed = True
+            return None
+        if self.start is None:
+            self.start = time.time()
+        due = self.start + self.sent * self.interval
+        if due > time.time():
+            gevent.sleep(due - time.time())
+        self.sent += 1
+        return 'benchmark:{}'.format(due)
+
+    def send(self, message):
+        if message.startswith('benchmark:'):
+            sent = float(message.split(':', 1)[1])
+            self.latencies.append(time.time() - sent)
+
+    def close(self):
+        self.closed = True
+
+
+class TestWebsocketBenchmark(object):
+
+    def _publish_with_sleep(self, sockets, client):
+        """The inbound loop as it was before the token bucket."""
+        while not client.ws.closed:
+            gevent.sleep(client.lag_tolerance_secs)
+            message = client.ws.receive()
+            if message is not None:
+                channel_name, data = message.split(':', 1)
+                sockets.conn.publish(channel_name, data)
+
+    def _round_trips(self, sockets, publish, count):
+        receiver = sockets.Client(BenchmarkSocket())
+        receiver.subscribe('benchmark')
+        gevent.sleep(0.1)
+        publish(sockets.Client(BenchmarkSocket(count)))
+        with gevent.Timeout(30, False):
+            while len(receiver.ws.latencies) < count:
+                gevent.sleep(0.01)
+        receiver.close()
+        latencies = receiver.ws.latencies
+        print("  mean {:.1f}ms, max {:.1f}ms over {} round trips".format(
+            1000 * sum(latencies) / len(latencies), 1000 * max(latencies),
+            len(latencies)))
+        return latencies
+
+    def test_round_trip_latency(self, benchmark):
+        # The server runs with gevent's patched sockets, which the redis
+        # pubsub needs to yield to the other greenlets.
+        import gevent.monkey
+        gevent.monkey.patch_socket()
+        from dallinger.experiment_server import sockets
+        from dallinger.heroku.worker import redis_url
+        count = 100
+
+        with mock.patch.object(sockets, 'conn', redis.from_url(redis_url)), \
+                mock.patch.object(sockets, 'chat_backend',
+                                  sockets.ChatBackend()):
+            fixed = benchmark(
+                "sleeping before each receive, {} messages".format(count),
+                self._round_trips, sockets,
+                lambda client: self._publish_with_sleep(sockets, client),
+                count)
+            limited = benchmark(
+                "token bucket, {} messages".format(count),
+                self._round_trips, sockets,
+                lambda client: client.publish(), count)
+            sockets.chat_backend.stop()
+        assert len(fixed) == len(limited) == count
@@ -1,4 +1,5 @@
 import mock
+import pytest
 
 
 def test_serialized(db_session):
@@ -56,6 +57,71 @@ def test_serialized(db_session):
     assert counts == [0, 0, 1]
 
 
+def test_serialized_gives_up_after_policy_attempts(db_session):
+    from psycopg2.extensions import TransactionRollbackError
+    from sqlalchemy.exc import OperationalError
+    from dallinger import db
+
+    calls = []
+
+    @db.serialized(retry_policy=db.RetryPolicy(attempts=3, base_delay=0))
+    def always_conflicts():
+        calls.append(True)
+        raise OperationalError('COMMIT', {}, TransactionRollbackError())
+
+    db.metrics.reset()
+    with pytest.raises(Exception) as excinfo:
+        always_conflicts()
+
+    assert len(calls) == 3
+    assert 'after 3 attempts' in str(excinfo.value)
+    stats = db.metrics.snapshot()['always_conflicts']
+    assert stats['failures'] == 1
+    assert stats['conflicts'] == 3
+    assert stats['retries'] == 2
+    db.metrics.reset()
+
+
+def test_serialized_records_metrics(db_session):
+    from dallinger import db
+
+    @db.serialized
+    def no_conflict():
+        return 'done'
+
+    db.metrics.reset()
+    assert no_conflict() == 'done'
+    assert db.metrics.snapshot()['no_conflict']['conflict_counts'] == {'0': 1}
+    db.metrics.reset()
+
+
+def test_single_transaction_defers_commits(db_session):
+    from dallinger import db
+    from dallinger.models import Participant
+
+    with db.single_transaction() as session:
+        session.add(Participant(
+            recruiter_id='hotair', worker_id='single', assignment_id='test',
+            hit_id='test', mode='test'))
+        session.commit()
+        assert 'commit' not in vars(session)
+        assert session.query(Participant).count() == 1
+    db_session.rollback()
+    assert db_session.query(Participant).count() == 0
+    assert not db_session.info.get('single_transaction')
+
+
+def test_retry_policy_backs_off_exponentially():
+    from dallinger.db import RetryPolicy
+    policy = RetryPolicy(base_delay=0.1, max_delay=0.5)
+    for _ in range(20):
+        assert 0 <= policy.delay(0) <= 0.1
+        assert 0 <= policy.delay(2) <= 0.4
+        assert 0 <= policy.delay(10) <= 0.5
+    with pytest.raises(ValueError):
+        RetryPolicy(attempts=0)
+
+
 def test_after_commit_hook(db_session):
     with mock.patch('dallinger.heroku.worker.conn') as redis:
         from dallinger.db import queue_message
@@ -63,3 +129,34 @@ def test_after_commit_hook(db_session):
         db_session.commit()
 
         assert redis.called_once_with('test', 'test')
+
+
+def test_after_commit_hook_logs_redis_errors(db_session):
+    from dallinger.db import queue_message
+    from dallinger.models import Network
+
+    with mock.patch('dallinger.heroku.worker.conn') as redis:
+        redis.pipeline.return_value.execute.side_effect = Exception('down')
+        with mock.patch('dallinger.db.logger') as logger:
+            db_session.add(Network())
+            queue_message('test', 'test')
+            db_session.commit()
+
+    logger.exception.assert_called_once()
+    assert db_session.query(Network).count() == 1
+
+
+def test_direct_writes_invalidate_cached_responses(db_session):
+    from dallinger.db import CACHE_GENERATION_KEY
+    from dallinger.models import Network, _insert_rows, timenow
+
+    db_session.commit()
+    with mock.patch('dallinger.heroku.worker.conn') as redis:
+        _insert_rows(db_session, Network, [{
+            "creation_time": timenow(), "failed": False, "role": "default",
+            "max_size": 2, "full": False}])
+        db_session.commit()
+
+    pipe = redis.pipeline.return_value
+    pipe.incr.assert_called_once_with(CACHE_GENERATION_KEY)
+    pipe.execute.assert_called_once_with()
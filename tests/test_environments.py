@@ -1,3 +1,6 @@
+import mock
+import pytest
+
 from dallinger import nodes, information, models
 
 
@@ -40,3 +43,62 @@ class TestEnvironments(object):
         state = environment.state()
 
         assert state.contents == u'some content'
+
+    def test_state_at_time(self, db_session):
+        net = models.Network()
+        db_session.add(net)
+        environment = nodes.Environment(network=net)
+        first = environment.update("first")
+        db_session.commit()
+        second = environment.update("second")
+        db_session.commit()
+
+        assert environment.state() == second
+        assert environment.state(time=second.creation_time) == first
+        with pytest.raises(ValueError):
+            environment.state(time=first.creation_time)
+
+    def test_state_at_time_is_remembered(self, db_session):
+        net = models.Network()
+        db_session.add(net)
+        environment = nodes.Environment(network=net)
+        first = environment.update("first")
+        db_session.commit()
+        second = environment.update("second")
+        db_session.commit()
+        time = second.creation_time
+
+        assert environment.state(time=time) == first
+        with mock.patch.object(information.State, 'query') as query:
+            assert environment.state(time=time) == first
+            query.filter_by.assert_not_called()
+
+    def test_state_cache_skips_failed_states(self, db_session):
+        net = models.Network()
+        db_session.add(net)
+        environment = nodes.Environment(network=net)
+        first = environment.update("first")
+        db_session.commit()
+        second = environment.update("second")
+        third = environment.update("third")
+        db_session.commit()
+
+        assert environment.state(time=third.creation_time) == second
+        second.fail()
+        assert environment.state(time=third.creation_time) == first
+
+    def test_loaded_environment_remembers_states(self, db_session):
+        net = models.Network()
+        db_session.add(net)
+        environment = nodes.Environment(network=net)
+        first = environment.update("first")
+        db_session.commit()
+        second = environment.update("second")
+        db_session.commit()
+        time = second.creation_time
+        first_id = first.id
+        db_session.expunge_all()
+
+        loaded = nodes.Environment.query.one()
+        assert loaded.state(time=time).id == first_id
+        assert [s.id for _, _, s in loaded._state_cache] == [first_id]
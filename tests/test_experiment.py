@@ -46,3 +46,54 @@ class TestExperimentBaseClass(object):
     def test_not_overrecruited_if_waiting_equal_to_quorum(self, exp):
         exp.quorum = 1
         assert not exp.is_overrecruited(waiting_count=1)
+
+    def test_network_for_participant_prefers_practice_networks(self, exp, a):
+        a.network(role="experiment")
+        practice = a.network(role="practice")
+        a.network(role="practice")
+        assert exp.get_network_for_participant(a.participant()) == practice
+
+    def test_network_for_participant_skips_full_and_joined_networks(self, exp, a):
+        participant = a.participant()
+        joined = a.network()
+        a.node(network=joined, participant=participant)
+        a.network(full=True)
+        available = a.network()
+        assert exp.get_network_for_participant(participant) == available
+
+    def test_network_for_participant_returns_none_if_no_networks(self, exp, a):
+        a.network(full=True)
+        assert exp.get_network_for_participant(a.participant()) is None
+
+    def test_least_filled_network_selection(self, exp, a):
+        exp.network_selection = "least_filled"
+        busy = a.network()
+        a.node(network=busy)
+        quiet = a.network()
+        assert exp.get_network_for_participant(a.participant()) == quiet
+
+    def test_round_robin_network_selection(self, exp, a):
+        exp.network_selection = "round_robin"
+        networks = [a.network(), a.network()]
+        participant = a.participant()
+        with mock.patch('dallinger.heroku.worker.conn') as conn:
+            conn.incr.side_effect = [1, 2, 3]
+            chosen = [exp.get_network_for_participant(participant)
+                      for _ in range(3)]
+        assert chosen == [networks[0], networks[1], networks[0]]
+
+    def test_publish_queues_json_or_packed_message(self, exp, db_session):
+        msgpack = pytest.importorskip('msgpack')
+        from dallinger.db import BINARY_MARKER
+        exp.publish('game', {'grid': [0, 1]})
+        exp.publish('game', {'grid': [0, 1]}, binary=True)
+        (_, text), (_, binary) = db_session.info['outbox']
+        assert text == '{"grid": [0, 1]}'
+        assert binary.startswith(BINARY_MARKER)
+        assert msgpack.unpackb(binary[1:], raw=False) == {'grid': [0, 1]}
+
+    def test_unknown_network_selection_raises(self, exp, a):
+        exp.network_selection = "nonsense"
+        a.network()
+        with pytest.raises(ValueError):
+            exp.get_network_for_participant(a.participant())
@@ -8,6 +8,17 @@ from dallinger import models
 @pytest.mark.usefixtures('experiment_dir')
 class TestAppConfiguration(object):
 
+    def test_sets_transmission_push_from_experiment(self, db_session):
+        from dallinger.experiment_server.experiment_server import (
+            Experiment, reset_experiment)
+        with mock.patch('dallinger.experiment.Experiment.push_transmissions',
+                        True):
+            Experiment(db_session)
+        assert models.Transmission.push is True
+
+        reset_experiment()
+        assert models.Transmission.push is False
+
     def test_config_gets_loaded_before_first_request(self, webapp):
         from dallinger.config import get_config
         conf = get_config()
@@ -470,6 +481,19 @@ class TestSimpleGETRoutes(object):
         resp = webapp.get('/experiment/missing')
         assert resp.status_code == 404
 
+    def test_metrics(self, webapp):
+        from dallinger import db
+        db.metrics.reset()
+        db.metrics.record('create_node', 2, 0.03)
+        resp = webapp.get('/metrics')
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['status'] == 'success'
+        stats = data['serialized']['create_node']
+        assert stats['transactions'] == 1
+        assert stats['retries'] == 2
+        assert stats['conflict_latency']['buckets']['0.05'] == 1
+        db.metrics.reset()
+
 
 @pytest.mark.usefixtures('experiment_dir')
 class TestAdRoute(object):
@@ -587,6 +611,32 @@ class TestParticipantRoute(object):
 @pytest.mark.usefixtures('experiment_dir')
 class TestSummaryRoute(object):
 
+    def test_summary_answers_conditional_get(self, webapp):
+        resp = webapp.get('/summary')
+        etag = resp.headers['ETag']
+        assert 'Last-Modified' not in resp.headers
+
+        resp = webapp.get('/summary', headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.data == b''
+
+    def test_summary_is_cached_until_a_commit_changes_the_database(
+            self, a, db_session, webapp):
+        from dallinger.experiment import Experiment
+        # The experiment commits its networks when first loaded
+        webapp.get('/experiment/nothing')
+        with mock.patch.object(Experiment, 'log_summary',
+                               return_value=[]) as log_summary:
+            webapp.get('/summary')
+            webapp.get('/summary')
+            assert log_summary.call_count == 1
+
+            a.participant()
+            db_session.commit()
+            resp = webapp.get('/summary')
+            assert log_summary.call_count == 2
+            assert json.loads(resp.data.decode('utf8'))['summary'] == []
+
     def test_summary_no_participants(self, a, webapp):
         resp = webapp.get('/summary')
         data = json.loads(resp.data.decode('utf8'))
@@ -613,6 +663,22 @@ class TestSummaryRoute(object):
             u'unfilled_networks': 1
         }
 
+    def test_summary_counts_live_nodes_across_unfilled_networks(
+            self, a, webapp):
+        network = a.star()
+        network.add_node(a.node(network=network, participant=a.participant()))
+        other = a.star(max_size=3)
+        other.add_node(a.node(network=other))
+        failed = a.node(network=other)
+        other.add_node(failed)
+        failed.fail()
+
+        resp = webapp.get('/summary')
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['unfilled_networks'] == 2
+        assert data['required_nodes'] == 5
+        assert data['nodes_remaining'] == 3
+
     def test_summary_two_participants_and_still_working(self, a, webapp):
         network = a.star()
         network.add_node(a.node(network=network, participant=a.participant()))
@@ -712,6 +778,41 @@ class TestNodeRouteGET(object):
         data = json.loads(resp.data.decode('utf8'))
         assert data.get('status') == 'success'
         assert data.get('infos') == []
+        assert 'next_after_id' not in data
+
+    def test_node_infos_pages(self, a, webapp):
+        node = a.node()
+        infos = [a.info(origin=node) for _ in range(3)]
+        ids = [i.id for i in infos]
+        route = '/node/{}/infos'.format(node.id)
+        created = infos[1].creation_time.isoformat()
+
+        resp = webapp.get(route + '?after_id={}&limit=1'.format(ids[0]))
+        data = json.loads(resp.data.decode('utf8'))
+        assert [i['id'] for i in data['infos']] == [ids[1]]
+        assert data['next_after_id'] == ids[1]
+        assert 'server_time' not in data
+
+        resp = webapp.get(route + '?after_id={}'.format(data['next_after_id']))
+        data = json.loads(resp.data.decode('utf8'))
+        assert [i['id'] for i in data['infos']] == [ids[2]]
+        assert data['next_after_id'] == ids[2]
+
+        resp = webapp.get(route + '?after_id={}'.format(data['next_after_id']))
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['infos'] == []
+        assert data['next_after_id'] == ids[2]
+
+        resp = webapp.get(route + '?since={}'.format(created))
+        data = json.loads(resp.data.decode('utf8'))
+        assert [i['id'] for i in data['infos']] == [ids[2]]
+
+    def test_node_infos_rejects_invalid_page(self, a, webapp):
+        node = a.node()
+        resp = webapp.get('/node/{}/infos?limit=0'.format(node.id))
+        assert b'non-positive limit: 0' in resp.data
+        resp = webapp.get('/node/{}/infos?since=yesterday'.format(node.id))
+        assert b'non-datetime since: yesterday' in resp.data
 
 
 @pytest.mark.usefixtures('experiment_dir', 'db_session')
@@ -804,6 +905,16 @@ class TestRequestParameter(object):
             result = rp('foo', parameter_type='bool')
             assert b'non-boolean foo: BadBool' in result.data
 
+    def test_marshalls_iso_format_datetimes(self, test_request, rp):
+        with test_request('/robots.txt?foo=2018-01-02T03:04:05.000006'):
+            result = rp('foo', parameter_type='datetime')
+            assert result == datetime(2018, 1, 2, 3, 4, 5, 6)
+
+    def test_returns_error_for_invalid_datetimes(self, test_request, rp):
+        with test_request('/robots.txt?foo=bar'):
+            result = rp('foo', parameter_type='datetime')
+            assert b'non-datetime foo: bar' in result.data
+
     def test_returns_error_for_unknown_parameter_type(self, test_request, rp):
         with test_request('/robots.txt?foo=True'):
             result = rp('foo', parameter_type='bad_type')
@@ -828,6 +939,24 @@ class TestNodeRoutePOST(object):
         assert data['transmissions'][0]['origin_id'] == db_session.merge(node1).id
         assert data['transmissions'][0]['destination_id'] == db_session.merge(node2).id
 
+    def test_node_transmit_lists_of_infos_and_recipients(self, a, webapp, db_session):
+        network = a.network()
+        sender = a.node(network=network)
+        recipients = [a.node(network=network) for _ in range(3)]
+        sender.connect(whom=recipients)
+        infos = [a.info(origin=sender) for _ in range(2)]
+        url = '/node/{}/transmit?{}&{}&property1=foo'.format(
+            sender.id,
+            '&'.join('what={}'.format(info.id) for info in infos),
+            '&'.join('to_whom[]={}'.format(node.id) for node in recipients[:2]))
+        resp = webapp.post(url)
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['status'] == 'success'
+        assert len(data['transmissions']) == 4
+        assert set(t['destination_id'] for t in data['transmissions']) == set(
+            db_session.merge(node).id for node in recipients[:2])
+        assert all(t['property1'] == 'foo' for t in data['transmissions'])
+
     def test_node_transmit_nonexistent_sender_returns_error(self, webapp):
         nonexistent_node_id = 999
         resp = webapp.post('/node/{}/transmit'.format(nonexistent_node_id))
@@ -938,6 +1067,78 @@ class TestInfoRoutePOST(object):
         assert b'/info POST server error' in resp.data
 
 
+@pytest.mark.usefixtures('experiment_dir', 'db_session')
+class TestBatchRoute(object):
+
+    def batch(self, webapp, operations):
+        resp = webapp.post('/batch', data={'operations': json.dumps(operations)})
+        return resp.status_code, json.loads(resp.data.decode('utf8'))
+
+    def test_runs_operations_in_order(self, a, webapp, db_session):
+        participant_id = a.participant().id
+        db_session.commit()
+
+        status, data = self.batch(webapp, [
+            {'method': 'POST', 'route': '/node/{}'.format(participant_id)},
+            {'method': 'POST', 'route': '/info/{0[node][id]}',
+             'data': {'contents': 'foo'}},
+            {'route': '/node/{0[node][id]}/infos'},
+            {'route': '/info/{0[node][id]}/{2[infos][0][id]}'},
+        ])
+
+        assert status == 200
+        assert [r['status_code'] for r in data['results']] == [200] * 4
+        assert data['results'][3]['response']['info']['contents'] == 'foo'
+        node_id = data['results'][0]['response']['node']['id']
+        infos = data['results'][2]['response']['infos']
+        assert [i['contents'] for i in infos] == ['foo']
+        assert models.Info.query.one().origin_id == node_id
+
+    def test_failed_operation_rolls_back_batch(self, a, webapp, db_session):
+        node_id = a.node().id
+        db_session.commit()
+
+        status, data = self.batch(webapp, [
+            {'method': 'POST', 'route': '/info/{}'.format(node_id),
+             'data': {'contents': 'foo'}},
+            {'route': '/node/999/infos'},
+            {'route': '/node/{}/infos'.format(node_id)},
+        ])
+
+        assert status == 400
+        assert [r['status_code'] for r in data['results']] == [200, 400]
+        assert models.Info.query.count() == 0
+
+    def test_rejects_routes_that_cannot_be_batched(self, webapp):
+        status, data = self.batch(webapp, [
+            {'method': 'POST', 'route': '/launch'},
+            {'route': '/no/such/route/here'},
+        ])
+        assert status == 400
+        assert data['results'][0]['status_code'] == 403
+
+        status, data = self.batch(webapp, [{'route': '/node/{0[node]}/infos'}])
+        assert data['results'][0]['status_code'] == 400
+
+    def test_rejects_routes_that_are_not_plain_fields(self, a, webapp,
+                                                      db_session):
+        node_id = a.node().id
+        db_session.commit()
+        first = {'route': '/node/{}/infos'.format(node_id)}
+        for route in ['/node/{0.__class__}/infos',
+                      '/node/{0[status]:>999999999}/infos',
+                      '/node/{0[infos][x]}/infos',
+                      '/node/{1[status]}/infos',
+                      '/node/{}/infos']:
+            status, data = self.batch(webapp, [first, {'route': route}])
+            assert status == 400
+            assert data['results'][1]['status_code'] == 400
+
+    def test_rejects_invalid_operations(self, webapp):
+        resp = webapp.post('/batch', data={'operations': '{"not": "a list"}'})
+        assert b'operations is not a list' in resp.data
+
+
 @pytest.mark.usefixtures('experiment_dir', 'db_session')
 class TestTrackingEventRoutePOST(object):
 
@@ -980,6 +1181,11 @@ class TestNodeNeighbors(object):
         resp = webapp.get('/node/{}/neighbors?failed=False'.format(node.id))
         assert b'You should not pass a failed argument to neighbors().' in resp.data
 
+    def test_rejects_after_id(self, a, webapp):
+        node = a.node()
+        resp = webapp.get('/node/{}/neighbors?after_id=0'.format(node.id))
+        assert b'You cannot pass after_id or since to neighbors()' in resp.data
+
     def test_finds_neighbor_nodes(self, a, webapp):
         network = a.network()
         node1 = a.node(network=network)
@@ -1038,6 +1244,34 @@ class TestNodeReceivedInfos(object):
         assert data['infos'][0]['id'] == info.id
         assert data['infos'][0]['contents'] == 'foo'
 
+    def test_pages_by_transmission(self, a, webapp):
+        net = a.network()
+        sender = a.node(network=net)
+        receiver = a.node(network=net)
+        sender.connect(direction="to", whom=receiver)
+        old_id = a.info(origin=sender).id
+        new_id = a.info(origin=sender).id
+        route = '/node/{}/received_infos'.format(receiver.id)
+
+        sender.transmit(what=models.Info.query.get(new_id), to_whom=receiver)
+        receiver.receive()
+        sender_id, receiver_id = sender.id, receiver.id
+        resp = webapp.get(route + '?after_id=0')
+        data = json.loads(resp.data.decode('utf8'))
+        assert [i['id'] for i in data['infos']] == [new_id]
+
+        # the request ended the session, so load the nodes again
+        sender = models.Node.query.get(sender_id)
+        receiver = models.Node.query.get(receiver_id)
+        transmission, = sender.transmit(what=models.Info.query.get(old_id),
+                                        to_whom=receiver)
+        receiver.receive()
+        transmission_id = transmission.id
+        resp = webapp.get(route + '?after_id={}'.format(data['next_after_id']))
+        data = json.loads(resp.data.decode('utf8'))
+        assert [i['id'] for i in data['infos']] == [old_id]
+        assert data['next_after_id'] == transmission_id
+
     def test_returns_empty_if_no_infos_received_by_node(self, a, webapp):
         net = a.network()
         node = a.node(network=net)
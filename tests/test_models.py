@@ -2,6 +2,8 @@
 
 from __future__ import print_function
 
+import json
+import mock
 import six
 import sys
 from datetime import datetime
@@ -545,6 +547,65 @@ class TestModels(object):
             agent1.transmit(what=None, to_whom=agent2)
             assert excinfo.match('cannot transmit to {}'.format(agent2))
 
+    def test_transmit_many_sends_every_info_to_every_node(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent3 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=[agent2, agent3])
+
+        info1 = models.Info(origin=agent1, contents="foo")
+        info2 = models.Info(origin=agent1, contents="bar")
+        self.add(db_session, info1, info2)
+        transmissions = agent1.transmit_many(
+            what=None, to_whom=nodes.ReplicatorAgent,
+            properties={"property1": "baz"})
+
+        assert len(transmissions) == 4
+        assert set((t.info, t.destination) for t in transmissions) == set(
+            [(info1, agent2), (info1, agent3), (info2, agent2), (info2, agent3)])
+        for t in transmissions:
+            assert t.origin == agent1
+            assert t.status == "pending"
+            assert t.property1 == "baz"
+            assert t.creation_time
+        assert len(agent2.transmissions(direction="incoming")) == 2
+
+    def test_transmit_many_raises_if_no_connection_to_destination(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        info = models.Info(origin=agent1, contents="foo")
+        self.add(db_session, info)
+
+        with raises(ValueError):
+            agent1.transmit_many(what=info, to_whom=agent2)
+
+    def test_transmit_many_raises_for_failed_or_foreign_info(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=agent2)
+        info1 = models.Info(origin=agent1, contents="foo")
+        info2 = models.Info(origin=agent2, contents="bar")
+        self.add(db_session, info1, info2)
+
+        with raises(ValueError):
+            agent1.transmit_many(what=info2, to_whom=agent2)
+
+        info1.fail()
+        with raises(ValueError):
+            agent1.transmit_many(what=info1, to_whom=agent2)
+
+    def test_transmit_many_with_nothing_to_send(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=agent2)
+        self.add(db_session, agent1, agent2)
+
+        assert agent1.transmit_many(what=None, to_whom=agent2) == []
+
     def test_transmission_repr(self, db_session):
         net = models.Network()
         db_session.add(net)
@@ -646,6 +707,260 @@ class TestModels(object):
         assert transmissions[1].receive_time < transmissions[2].receive_time
         assert transmissions[2].receive_time < transmissions[3].receive_time
 
+    def test_network_has_transmissions(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=agent2)
+        info = models.Info(origin=agent1, contents="foo")
+        self.add(db_session, info)
+        assert not net.has_transmissions()
+
+        transmission = agent1.transmit(what=info, to_whom=agent2)[0]
+        assert net.has_transmissions()
+        assert net.has_transmissions(status="pending")
+        assert not net.has_transmissions(status="received")
+
+        transmission.fail()
+        assert not net.has_transmissions()
+        assert net.has_transmissions(failed=True)
+        assert net.has_transmissions(failed="all")
+
+        with raises(ValueError):
+            net.has_transmissions(status="lost")
+        with raises(ValueError):
+            net.has_transmissions(failed="maybe")
+
+    def test_latest_transmission_recipient(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent3 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=[agent2, agent3])
+        info = models.Info(origin=agent1, contents="foo")
+        self.add(db_session, info)
+        assert net.latest_transmission_recipient() is None
+
+        agent1.transmit(what=info, to_whom=agent3)
+        agent3.receive()
+        agent1.transmit(what=info, to_whom=agent2)
+        assert net.latest_transmission_recipient() == agent3
+
+        agent2.receive()
+        assert net.latest_transmission_recipient() == agent2
+
+    def test_push_transmissions(self, db_session, monkeypatch):
+        net = models.Network()
+        agent1 = nodes.Agent(network=net)
+        agent2 = nodes.Agent(network=net)
+        agent1.connect(whom=agent2)
+        info = models.Info(origin=agent1, contents="foo")
+        self.add(db_session, info)
+
+        agent1.transmit(what=info, to_whom=agent2)
+        db_session.flush()
+        assert not db_session.info.get('outbox')
+
+        monkeypatch.setattr(models.Transmission, "push", True)
+        transmission = agent1.transmit(what=info, to_whom=agent2)[0]
+        db_session.flush()
+        many = agent1.transmit_many(what=info, to_whom=agent2)[0]
+
+        outbox = db_session.info['outbox']
+        assert [channel for channel, _ in outbox] == \
+            ["node_{}".format(agent2.id)] * 2
+        messages = [json.loads(message) for _, message in outbox]
+        assert [m["transmission"]["id"] for m in messages] == \
+            [transmission.id, many.id]
+        assert messages[0]["info"]["contents"] == "foo"
+
+    def test_node_infos_pages(self, db_session):
+        net = models.Network()
+        agent = nodes.Agent(network=net)
+        infos = [models.Info(origin=agent, contents=str(i)) for i in range(5)]
+        self.add(db_session, *infos)
+
+        assert agent.infos(limit=2) == infos[:2]
+        assert agent.infos(after_id=infos[1].id, limit=2) == infos[2:4]
+        assert agent.infos(after_id=infos[4].id) == []
+        assert agent.infos(since=infos[2].creation_time) == infos[3:]
+
+        with raises(ValueError):
+            agent.infos(limit=0)
+        with raises(TypeError):
+            agent.infos(since="yesterday")
+
+    def test_node_vectors_since_includes_failed_vectors(self, db_session):
+        net = models.Network()
+        agent1 = nodes.Agent(network=net)
+        agent2 = nodes.Agent(network=net)
+        vector, = agent1.connect(whom=agent2)
+        self.add(db_session, net, agent1, agent2, vector)
+        created = vector.creation_time
+
+        assert agent1.vectors(failed="all", since=created) == []
+        vector.fail()
+        db_session.flush()
+        assert agent1.vectors(failed="all", since=created) == [vector]
+
+    def test_node_paged_transmissions_and_received_infos(self, db_session):
+        net = models.Network()
+        agent1 = nodes.Agent(network=net)
+        agent2 = nodes.Agent(network=net)
+        agent1.connect(whom=agent2)
+        old = models.Info(origin=agent1, contents="old")
+        new = models.Info(origin=agent1, contents="new")
+        self.add(db_session, old, new)
+
+        first = agent1.transmit(what=new, to_whom=agent2)[0]
+        agent2.receive()
+        received = first.receive_time
+        transmission = agent1.transmit(what=old, to_whom=agent2)[0]
+
+        assert agent2.received_infos(since=received) == []
+        assert agent1.transmissions(since=received) == [transmission]
+        agent2.receive()
+        assert agent2.received_infos(since=received) == [old]
+        assert agent2.transmissions(direction="incoming", since=received) == \
+            [transmission]
+
+        assert agent1.vectors(limit=1) == agent1.vectors()
+        assert agent1.neighbors(limit=1) == [agent2]
+        with raises(ValueError):
+            agent1.neighbors(after_id=agent1.id)
+        with raises(ValueError):
+            agent1.neighbors(since=received)
+
+    def test_node_received_infos_pages_by_transmission(self, db_session):
+        net = models.Network()
+        agent1 = nodes.Agent(network=net)
+        agent2 = nodes.Agent(network=net)
+        agent1.connect(whom=agent2)
+        old = models.Info(origin=agent1, contents="old")
+        new = models.Info(origin=agent1, contents="new")
+        self.add(db_session, old, new)
+
+        agent1.transmit(what=new, to_whom=agent2)
+        agent2.receive()
+        page = agent2.received_infos(after_id=0)
+        assert page == [new]
+
+        # an older info received after the newer one is in the next page
+        transmission = agent1.transmit(what=old, to_whom=agent2)[0]
+        agent2.receive()
+        page = agent2.received_infos(after_id=page.next_after_id)
+        assert page == [old]
+        assert page.next_after_id == transmission.id
+
+        page = agent2.received_infos(after_id=page.next_after_id)
+        assert page == []
+        assert page.next_after_id == transmission.id
+        assert agent2.received_infos(limit=1) == [new]
+
+    def _lineage_network(self, db_session):
+        net = models.Network()
+        agent = nodes.Agent(network=net)
+        root = models.Info(origin=agent, contents="a")
+        self.add(db_session, root)
+        child = models.Info(origin=agent, contents="b")
+        other = models.Info(origin=agent, contents="c")
+        self.add(db_session, child, other)
+        grandchild = models.Info(origin=agent, contents="d")
+        self.add(db_session, grandchild)
+        Mutation(info_in=root, info_out=child)
+        Mutation(info_in=root, info_out=other)
+        Mutation(info_in=child, info_out=grandchild)
+        Mutation(info_in=other, info_out=grandchild)
+        db_session.commit()
+        return net, root, child, other, grandchild
+
+    def test_info_ancestors_and_descendants(self, db_session):
+        net, root, child, other, grandchild = self._lineage_network(db_session)
+
+        assert [tuple(r) for r in grandchild.ancestors()] == \
+            [(child.id, 1), (other.id, 1), (root.id, 2)]
+        assert [tuple(r) for r in grandchild.ancestors(depth=1)] == \
+            [(child.id, 1), (other.id, 1)]
+        assert [tuple(r) for r in root.descendants()] == \
+            [(child.id, 1), (other.id, 1), (grandchild.id, 2)]
+        assert root.ancestors() == []
+
+        other.fail()
+        assert [tuple(r) for r in root.descendants()] == \
+            [(child.id, 1), (grandchild.id, 2)]
+        assert [tuple(r) for r in root.descendants(failed="all")] == \
+            [(child.id, 1), (other.id, 1), (grandchild.id, 2)]
+
+        with raises(ValueError):
+            root.descendants(depth=0)
+        with raises(ValueError):
+            root.descendants(failed="maybe")
+
+    def test_network_lineage_forest(self, db_session):
+        net, root, child, other, grandchild = self._lineage_network(db_session)
+        loner = models.Info(origin=net.nodes()[0], contents="e")
+        self.add(db_session, loner)
+
+        assert [tuple(r) for r in net.lineage_forest()] == [
+            (root.id, None, root.id, 0),
+            (child.id, root.id, root.id, 1),
+            (other.id, root.id, root.id, 1),
+            (grandchild.id, child.id, root.id, 2),
+            (grandchild.id, other.id, root.id, 2),
+            (loner.id, None, loner.id, 0),
+        ]
+        assert len(net.lineage_forest(depth=1)) == 4
+
+        root.fail()
+        assert [tuple(r)[:3] for r in net.lineage_forest()] == [
+            (child.id, None, child.id),
+            (grandchild.id, child.id, child.id),
+            (other.id, None, other.id),
+            (grandchild.id, other.id, other.id),
+            (loner.id, None, loner.id),
+        ]
+
+    def test_receive_marks_all_pending_received(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=agent2)
+        infos = [models.Info(origin=agent1, contents=str(i)) for i in range(5)]
+        self.add(db_session, *infos)
+        transmissions = [agent1.transmit(what=info, to_whom=agent2)[0]
+                         for info in infos]
+        received = []
+        agent2.update = received.extend
+
+        agent2.receive()
+
+        assert received == infos
+        for transmission in transmissions:
+            assert transmission.status == "received"
+            assert transmission.receive_time
+        assert agent2.transmissions(direction="incoming", status="pending") == []
+
+        del received[:]
+        agent2.receive()
+        assert received == []
+
+    def test_receive_single_transmission(self, db_session):
+        net = models.Network()
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=agent2)
+        info1 = models.Info(origin=agent1, contents="foo")
+        info2 = models.Info(origin=agent1, contents="bar")
+        self.add(db_session, info1, info2)
+        transmission = agent1.transmit(what=info1, to_whom=agent2)[0]
+        agent1.transmit(what=info2, to_whom=agent2)
+        self.add(db_session, transmission)
+
+        agent2.receive(what=transmission)
+
+        assert transmission.status == "received"
+        assert len(agent2.transmissions(direction="incoming", status="pending")) == 1
+
     def test_property_node(self, db_session):
         net = models.Network()
         db_session.add(net)
@@ -702,6 +1017,61 @@ class TestModels(object):
         assert len(participant.questions()) == 1
         assert participant.questions()[0].failed is True
 
+    def test_fail_node_cascades(self, db_session):
+        net = models.Network(max_size=3)
+        db_session.add(net)
+        agent1 = nodes.ReplicatorAgent(network=net)
+        agent2 = nodes.ReplicatorAgent(network=net)
+        agent3 = nodes.ReplicatorAgent(network=net)
+        agent1.connect(whom=[agent2, agent3])
+        agent2.connect(whom=agent3)
+        info1 = models.Info(origin=agent1, contents="foo")
+        info2 = models.Info(origin=agent2, contents="bar")
+        self.add(db_session, info1, info2)
+        transmission = agent1.transmit(what=info1, to_whom=agent2)[0]
+        agent2.receive()
+        self.add(db_session, transmission)
+        transformation = agent2.infos()[-1].transformations()[0]
+        assert net.full
+
+        agent1.fail()
+
+        assert net.full is False
+        assert agent1.vectors() == []
+        assert len(agent1.vectors(failed=True)) == 2
+        assert info1.failed is True
+        assert info1.time_of_death == agent1.time_of_death
+        assert transmission.failed is True
+        assert transformation.failed is True
+        assert info2.failed is False
+        assert len(agent2.vectors()) == 1
+
+    def test_fail_network_calls_overridden_fail(self, db_session):
+        net = models.Network()
+        db_session.add(net)
+        node = models.Node(network=net)
+        agent = Agent(network=net)
+        node.connect(whom=agent)
+        self.add(db_session, node, agent)
+
+        with mock.patch.object(Agent, 'fail', autospec=True,
+                               side_effect=Agent.fail) as fail:
+            net.fail()
+
+        fail.assert_called_once_with(agent)
+        assert agent.failed is True
+        assert node.failed is True
+        assert net.vectors(failed=True)[0].failed is True
+        assert net.nodes() == []
+
+    def test_fail_node_without_session_fails_one_by_one(self, db_session):
+        node = models.Node(network=models.Network())
+        vector = mock.Mock()
+        with mock.patch.object(models.Node, 'vectors', return_value=[vector]):
+            node.fail()
+        assert node.failed is True
+        vector.fail.assert_called_once_with()
+
     def test_participant_json(self, db_session):
         participant = models.Participant(
             recruiter_id='hotair', worker_id=str(1), hit_id=str(1),
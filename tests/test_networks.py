@@ -27,6 +27,33 @@ class TestNetworks(object):
         nodes.Agent(network=net)
         assert net.full
 
+    def test_not_full_after_node_fails(self, a):
+        net = a.network(max_size=1)
+        agent = nodes.Agent(network=net)
+        assert net.full
+        agent.fail()
+        assert not net.full
+
+    def test_size_counts_nodes_by_type_and_failed(self, a):
+        net = a.network()
+        for _ in range(3):
+            nodes.Agent(network=net)
+        nodes.Source(network=net)
+        net.nodes(type=nodes.Agent)[0].fail()
+
+        assert net.size() == 3
+        assert net.size(type=nodes.Agent) == 2
+        assert net.size(type=nodes.Source) == 1
+        assert net.size(failed=True) == 1
+        assert net.size(failed="all") == 4
+
+    def test_size_rejects_invalid_arguments(self, a):
+        net = a.network()
+        with pytest.raises(TypeError):
+            net.size(type=models.Info)
+        with pytest.raises(ValueError):
+            net.size(failed="maybe")
+
     def test_node_failure(self, db_session):
         net = networks.Network()
         db_session.add(net)
@@ -190,6 +217,74 @@ class TestNetworks(object):
 
         assert pytest.raises(ValueError, node1.neighbors, direction="ghbhfgjd")
 
+    def test_neighbors_either_and_both(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        agent = a.agent(network=net)
+        node1.connect(whom=node2)
+        node1.connect(whom=agent, direction="both")
+
+        assert set(node1.neighbors(direction="either")) == set([node2, agent])
+        assert node1.neighbors(direction="both") == [agent]
+        assert node1.neighbors(direction="either", type=nodes.Agent) == [agent]
+        assert node2.neighbors(direction="both") == []
+
+    def test_neighbors_many(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        agent = a.agent(network=net)
+        node1.connect(whom=[node2, agent])
+        agent.connect(whom=node1)
+
+        adjacency = models.Node.neighbors_many([node1, node2, agent])
+        assert set(adjacency[node1]) == set([node2, agent])
+        assert adjacency[node2] == []
+        assert adjacency[agent] == [node1]
+
+        adjacency = models.Node.neighbors_many(
+            [node1, node2], type=nodes.Agent, direction="either")
+        assert adjacency == {node1: [agent], node2: []}
+
+        adjacency = models.Node.neighbors_many(
+            [node1, node2, agent], direction="both")
+        assert adjacency[node1] == [agent]
+        assert adjacency[node2] == []
+        assert adjacency[agent] == [node1]
+
+    def test_neighbors_many_matches_neighbors(self, a):
+        net = a.network()
+        all_nodes = [a.node(network=net) for _ in range(5)]
+        for node in all_nodes[1:]:
+            all_nodes[0].connect(whom=node, direction="both")
+        all_nodes[1].connect(whom=all_nodes[2])
+        all_nodes[3].fail()
+
+        for direction in ["to", "from", "either", "both"]:
+            adjacency = models.Node.neighbors_many(
+                all_nodes, direction=direction)
+            for node in all_nodes:
+                assert (set(adjacency[node]) ==
+                        set(node.neighbors(direction=direction)))
+
+    def test_neighbors_many_with_no_nodes(self, a):
+        assert models.Node.neighbors_many([]) == {}
+
+    def test_is_connected_to_many_nodes(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        node3 = a.node(network=net)
+        node1.connect(whom=node2)
+        node3.connect(whom=node1)
+
+        assert node1.is_connected([node2, node3]) == [True, False]
+        assert node1.is_connected([node2, node3], direction="from") == [False, True]
+        assert node1.is_connected([node2, node3], direction="either") == [True, True]
+        assert node1.is_connected([node2, node3], direction="both") == [False, False]
+        assert node1.is_connected([]) == []
+
     def test_network_repr(self, db_session):
         net = networks.Network()
         db_session.add(net)
@@ -206,6 +301,197 @@ class TestNetworks(object):
         )
 
 
+class TestNetworkCache(object):
+
+    def test_cache_is_loaded_once_per_transaction(self, a):
+        net = a.network()
+        assert net.cache() is net.cache()
+
+    def test_cache_lists_nodes_oldest_first(self, a):
+        net = a.network()
+        first = a.node(network=net)
+        agent = a.agent(network=net)
+        last = a.node(network=net)
+
+        assert net.cache().nodes() == [first, agent, last]
+        assert net.cache().nodes(type=nodes.Agent) == [agent]
+
+    def test_cache_tracks_node_creation_and_failure(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        cache = net.cache()
+
+        node2 = a.node(network=net)
+        assert cache.nodes() == [node1, node2]
+
+        node1.fail()
+        assert cache.nodes() == [node2]
+        assert cache.size() == net.size()
+
+    def test_cache_tracks_vectors(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        cache = net.cache()
+
+        node1.connect(whom=node2)
+        assert cache.outdegree(node1) == 1
+        assert cache.indegree(node2) == 1
+        assert cache.is_connected(node1, node2)
+        assert cache.is_connected(node2, node1, direction="from")
+        assert not cache.is_connected(node1, node2, direction="both")
+
+        node1.vectors()[0].fail()
+        assert cache.outdegree(node1) == 0
+        assert not cache.is_connected(node1, node2, direction="either")
+
+    def test_cache_forgets_vectors_of_failed_node(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        node1.connect(whom=node2, direction="both")
+        cache = net.cache()
+        assert cache.outdegree(node2) == 1
+
+        node1.fail()
+        assert cache.outdegree(node2) == 0
+        assert cache.indegree(node2) == 0
+
+    def test_cache_is_discarded_on_rollback(self, a, db_session):
+        net = a.network()
+        db_session.commit()
+        cache = net.cache()
+        db_session.rollback()
+
+        assert net.cache() is not cache
+
+    def test_cache_is_discarded_on_commit(self, a, db_session):
+        net = a.network()
+        cache = net.cache()
+        db_session.commit()
+
+        assert net.cache() is not cache
+
+    def test_uncached_for_network_outside_session(self, db_session):
+        net = models.Network()
+        assert net.cache().nodes() == []
+        assert net.cache() is not net.cache()
+
+    def test_sample_by_outdegree_follows_vectors(self, a):
+        net = a.network()
+        hub = a.node(network=net)
+        leaf = a.node(network=net)
+        loner = a.node(network=net)
+        hub.connect(whom=leaf)
+        cache = net.cache()
+
+        assert cache.sample_by_outdegree(1) == [hub]
+
+        leaf.connect(whom=loner)
+        assert sorted(cache.sample_by_outdegree(2), key=lambda n: n.id) == [hub, leaf]
+
+        hub.vectors()[0].fail()
+        assert cache.sample_by_outdegree(1) == [leaf]
+
+    def test_sample_by_outdegree_skips_excluded_and_neighbors(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        node3 = a.node(network=net)
+        node4 = a.node(network=net)
+        node1.connect(whom=node2, direction="both")
+        node3.connect(whom=node4, direction="both")
+        cache = net.cache()
+
+        for _ in range(10):
+            assert cache.sample_by_outdegree(1, exclude=[node3]) in ([node1], [node2])
+        assert len(cache.sample_by_outdegree(4)) == 4
+
+    def test_sample_by_outdegree_raises_when_too_few_nodes(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        node1.connect(whom=node2)
+        cache = net.cache()
+
+        with pytest.raises(ValueError):
+            cache.sample_by_outdegree(2)
+        # Nodes removed while sampling are put back afterwards.
+        assert cache.sample_by_outdegree(1) == [node1]
+
+    def test_sample_by_outdegree_ignores_failed_nodes(self, a):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        node3 = a.node(network=net)
+        node1.connect(whom=node2, direction="both")
+        node3.connect(whom=node2)
+        cache = net.cache()
+
+        node2.fail()
+        with pytest.raises(ValueError):
+            cache.sample_by_outdegree(1)
+
+    def test_network_samples_by_outdegree_without_cache(self, a, db_session):
+        net = a.network()
+        node1 = a.node(network=net)
+        node2 = a.node(network=net)
+        node3 = a.node(network=net)
+        node4 = a.node(network=net)
+        node1.connect(whom=node2, direction="both")
+        node3.connect(whom=node4, direction="both")
+        db_session.commit()
+
+        for _ in range(10):
+            assert net.sample_by_outdegree(1, exclude=[node3]) in ([node1], [node2])
+        with pytest.raises(ValueError):
+            net.sample_by_outdegree(3, exclude=[node3])
+        node1.vectors()[0].fail()
+        assert net.sample_by_outdegree(1, exclude=[node3]) == [node2]
+        assert net.id not in db_session.info['network_caches']
+
+
+class TestFenwickTree(object):
+
+    def test_totals_and_updates(self):
+        tree = models.FenwickTree([3, 0, 2, 5])
+        assert len(tree) == 4
+        assert tree.total() == 10
+
+        tree.add(1, 4)
+        tree[3] = 1
+        assert tree[1] == 4
+        assert tree.total() == 10
+
+        assert tree.append(7) == 4
+        assert tree.total() == 17
+
+    def test_find_matches_running_total(self):
+        weights = [random.randint(0, 5) for _ in range(50)]
+        tree = models.FenwickTree()
+        for weight in weights:
+            tree.append(weight)
+
+        running = 0
+        for index, weight in enumerate(weights):
+            if weight:
+                assert tree.find(running) == index
+                assert tree.find(running + weight - 0.5) == index
+            running += weight
+
+    def test_built_from_weights_matches_appended(self):
+        weights = [random.randint(0, 5) for _ in range(50)]
+        appended = models.FenwickTree()
+        for weight in weights:
+            appended.append(weight)
+
+        built = models.FenwickTree(weights)
+        assert built._tree == appended._tree
+        built.append(3)
+        appended.append(3)
+        assert built._tree == appended._tree
+
+
 class TestChain(object):
 
     def test_nodes_are_connected_to_their_successor_if_added_immediately(self, a):
@@ -476,6 +762,31 @@ class TestScaleFree(object):
         assert len(net.nodes(type=nodes.Agent)) == m0 + 2
         assert len(net.vectors()) == m0 * (m0 - 1) + 2 * 2 * m
 
+    def test_newcomers_connect_to_distinct_members(self, a):
+        net = a.scale_free(m0=3, m=2)
+        for _ in range(20):
+            net.add_node(a.agent(network=net))
+
+        for agent in net.nodes(type=nodes.Agent):
+            neighbors = agent.neighbors()
+            assert len(neighbors) == len(set(neighbors))
+            assert agent not in neighbors
+            assert len(neighbors) >= 2
+
+    def test_attachment_prefers_high_outdegree(self, a):
+        net = a.scale_free(m0=2, m=1)
+        for _ in range(2):
+            net.add_node(a.agent(network=net))
+        hub, other = net.nodes()
+        for _ in range(8):
+            hub.connect(whom=a.agent(network=net))
+
+        picks = defaultdict(int)
+        for _ in range(200):
+            picks[net.cache().sample_by_outdegree(1)[0]] += 1
+        assert set(picks) <= {hub, other}
+        assert picks[hub] > 150
+
     def test_repr(self, a):
         net = a.scale_free(m0=4, m=4)
 
@@ -1,3 +1,5 @@
+import pytest
+
 from dallinger import processes, networks, nodes, models
 from dallinger.nodes import Agent
 
@@ -124,3 +126,125 @@ class TestProcesses(object):
         for a in net.nodes(type=Agent):
             for a2 in net.nodes(type=Agent):
                 assert a.infos()[0].contents == a2.infos()[0].contents
+
+
+@pytest.fixture
+def engine():
+    pytest.importorskip("numpy")
+    from dallinger.engine import ProcessEngine
+    return ProcessEngine
+
+
+class TestProcessEngine(object):
+
+    def _fully_connected(self, net, size):
+        agents = [nodes.ReplicatorAgent(network=net) for _ in range(size)]
+        for agent in agents:
+            agent.connect(whom=[other for other in agents if other is not agent])
+        source = nodes.RandomBinaryStringSource(network=net)
+        source.connect(whom=agents)
+        return agents
+
+    def _assert_consistent(self, net):
+        for t in net.transmissions(failed="all"):
+            assert t.info.origin_id == t.origin_id
+            assert t.vector.origin_id == t.origin_id
+            assert t.vector.destination_id == t.destination_id
+            assert t.status == "received"
+        for t in net.transformations(failed="all"):
+            assert t.info_out.origin_id == t.node_id
+            assert t.info_in.contents == t.info_out.contents
+
+    def test_moran_cultural(self, a, db_session, engine):
+        net = a.network()
+        self._fully_connected(net, 4)
+
+        engine(net, seed=1).moran_cultural(200)
+        db_session.commit()
+
+        # The first step broadcasts from the source, then one per step.
+        assert len(net.transmissions()) == 4 + 199
+        assert len(net.infos()) == 1 + 4 + 199
+        assert len(net.transformations()) == 4 + 199
+        self._assert_consistent(net)
+        assert len(set(agent.latest_info().contents
+                       for agent in net.nodes(type=Agent))) == 1
+
+    def test_moran_cultural_after_the_models(self, a, db_session, engine):
+        net = a.network()
+        self._fully_connected(net, 3)
+        processes.moran_cultural(net)
+        for agent in net.nodes(type=Agent):
+            agent.receive()
+
+        process = engine(net, seed=2)
+        process.moran_cultural(10)
+        process.moran_cultural(10)
+        db_session.commit()
+
+        assert len(net.transmissions()) == 3 + 20
+        self._assert_consistent(net)
+        latest = net.latest_transmission_recipient()
+        assert latest.latest_info().creation_time == max(
+            i.creation_time for i in net.infos())
+
+    def test_moran_cultural_replacer_sent_its_first_info_in_batch(
+            self, a, db_session, engine):
+        import numpy
+        net = a.network()
+        agent1, agent2 = [nodes.ReplicatorAgent(network=net) for _ in range(2)]
+        agent1.connect(whom=agent2, direction="both")
+        nodes.RandomBinaryStringSource(network=net).connect(whom=agent1)
+
+        process = engine(net, seed=4)
+        process.moran_cultural(1)
+        assert agent2.infos() == []
+        # agent1 replaces agent2, which then replaces agent1 with that info.
+        process._random_agents = lambda steps: numpy.array([0, 1])
+        process.moran_cultural(2)
+        db_session.commit()
+
+        assert len(net.transmissions()) == 1 + 2
+        self._assert_consistent(net)
+        assert agent1.latest_info().contents == agent2.latest_info().contents
+
+    def test_moran_sexual(self, a, db_session, engine):
+        net = a.network()
+        self._fully_connected(net, 3)
+
+        engine(net, seed=3).moran_sexual(100)
+        db_session.commit()
+
+        agents = net.nodes(type=Agent)
+        assert len(agents) == 3
+        assert len(net.nodes(type=Agent, failed=True)) == 99
+        self._assert_consistent(net)
+        for agent in agents:
+            assert len(agent.infos()) == 1
+            assert len(agent.neighbors(direction="both", type=Agent)) == 2
+            assert len(agent.neighbors(direction="from",
+                                       type=nodes.Source)) == 1
+        assert len(set(agent.infos()[0].contents for agent in agents)) == 1
+
+    def test_random_walk(self, a, db_session, engine):
+        net = a.network()
+        source = nodes.RandomBinaryStringSource(network=net)
+        agents = [nodes.ReplicatorAgent(network=net) for _ in range(6)]
+        source.connect(whom=agents[0])
+        for agent, next_agent in zip(agents, agents[1:]):
+            agent.connect(whom=next_agent)
+
+        engine(net).random_walk(6)
+        db_session.commit()
+
+        self._assert_consistent(net)
+        contents = agents[0].infos()[0].contents
+        assert [len(agent.infos()) for agent in agents] == [1] * 6
+        assert all(agent.infos()[0].contents == contents for agent in agents)
+        assert net.latest_transmission_recipient() == agents[-1]
+
+    def test_agents_must_replicate(self, a, db_session, engine):
+        net = a.network()
+        a.agent(network=net)
+        with pytest.raises(TypeError):
+            engine(net).moran_cultural(10)
@@ -0,0 +1,287 @@
+from operator import attrgetter
+
+import pytest
+
+from dallinger import models, networks, nodes, processes
+from dallinger.nodes import Agent, Source
+from dallinger.simulation import Simulation
+from dallinger.transformations import Mutation, Replication
+
+
+class UpperCaseInfo(models.Info):
+    """An info that mutates by upper-casing its contents."""
+
+    __mapper_args__ = {"polymorphic_identity": "upper_case_info"}
+
+    def _mutated_contents(self):
+        return self.contents.upper()
+
+
+class CountingAgent(nodes.ReplicatorAgent):
+    """A replicator agent that counts its updates."""
+
+    __mapper_args__ = {"polymorphic_identity": "counting_agent"}
+
+    updates = 0
+
+    def update(self, infos):
+        self.updates += 1
+        super(CountingAgent, self).update(infos)
+
+
+class TestSimulation(object):
+
+    def _moran_network(self, sim, size=3):
+        net = sim.network(networks.FullyConnected)
+        source = sim.node(nodes.RandomBinaryStringSource, network=net)
+        net.add_node(source)
+        for _ in range(size):
+            net.add_node(sim.node(nodes.ReplicatorAgent, network=net))
+        return net, source
+
+    def test_objects_behave_as_their_models(self):
+        sim = Simulation()
+        net = sim.network(networks.ScaleFree, m0=2, m=1)
+        agent = sim.node(Agent, network=net)
+
+        assert isinstance(net, networks.ScaleFree)
+        assert isinstance(agent, Agent)
+        assert issubclass(type(agent), Agent)
+        assert not isinstance(agent, Source)
+        assert net.m0 == 2
+        assert net.type == "scale-free"
+        assert agent.type == "agent"
+        assert repr(agent) == "Node-1-agent"
+        assert agent.__json__()["network_id"] == net.id
+
+        agent.fitness = 1.5
+        assert agent.property1 == "1.5"
+        assert agent.fitness == 1.5
+
+    def test_subclass_methods_can_call_super(self):
+        sim = Simulation()
+        net = sim.network()
+        agent = sim.node(CountingAgent, network=net)
+        source = sim.node(nodes.RandomBinaryStringSource, network=net)
+        source.connect(whom=agent)
+        source.transmit()
+        agent.receive()
+        assert agent.updates == 1
+        assert len(agent.infos()) == 1
+
+    def test_queries_run_against_entered_simulation(self):
+        sim = Simulation()
+        net = sim.network()
+        agent = sim.node(Agent, network=net)
+        first = sim.info(models.Info, agent, contents="first")
+        second = sim.info(UpperCaseInfo, agent, contents="second")
+        first.fail()
+
+        with sim:
+            assert models.Info.query.filter_by(failed=False).all() == [second]
+            assert UpperCaseInfo.query.one() is second
+            assert models.Info.query.filter(
+                models.Info.id < second.id).all() == [first]
+            assert models.Info.query.order_by(
+                models.Info.creation_time.desc()).first() is second
+            assert models.Node.query.get(agent.id) is agent
+            with pytest.raises(NotImplementedError):
+                models.Participant.query.all()
+        assert models.Info.query is not None
+
+    def test_networks_without_init_take_attributes(self):
+        sim = Simulation()
+        net = sim.network(models.Network, max_size=2, role="practice")
+        assert net.role == "practice"
+
+        sim.node(Agent, network=net)
+        assert not net.full
+        sim.node(Agent, network=net)
+        assert net.full
+        assert net.size() == 2
+
+    def test_ids_and_creation_times_are_ordered(self):
+        sim = Simulation()
+        net = sim.network()
+        first = sim.node(Agent, network=net)
+        second = sim.node(Agent, network=net)
+        assert (first.id, second.id) == (1, 2)
+        assert first.creation_time < second.creation_time
+        assert net.nodes() == [first, second]
+
+    def test_topologies_run_unmodified(self):
+        sim = Simulation()
+        net, source = self._moran_network(sim, size=4)
+        agents = net.nodes(type=Agent)
+
+        assert len(agents) == 4
+        assert len(net.vectors()) == 4 + 4 * 3
+        assert source.neighbors(direction="to") == agents
+        assert agents[0].is_connected(whom=agents[1], direction="both")
+        assert agents[0].is_connected(whom=source, direction="from")
+
+        scale_free = sim.network(networks.ScaleFree, m0=3, m=2)
+        for _ in range(20):
+            scale_free.add_node(sim.node(Agent, network=scale_free))
+        assert len(scale_free.vectors()) == 3 * 2 + 17 * 2 * 2
+
+    def test_connect_rejects_sources_and_self(self):
+        sim = Simulation()
+        net = sim.network()
+        agent = sim.node(Agent, network=net)
+        source = sim.node(Source, network=net)
+
+        with pytest.raises(TypeError):
+            agent.connect(whom=source)
+        with pytest.raises(ValueError):
+            agent.connect(whom=agent)
+
+    def test_transmit_and_receive(self):
+        sim = Simulation()
+        net, source = self._moran_network(sim, size=2)
+        agent = net.nodes(type=Agent)[0]
+
+        transmissions = source.transmit(to_whom=agent)
+        assert len(transmissions) == 1
+        assert transmissions[0].status == "pending"
+        info = transmissions[0].info
+        assert info.origin is source
+        assert len(info.contents) == 2
+
+        agent.receive()
+        assert transmissions[0].status == "received"
+        assert agent.received_infos() == [info]
+        assert agent.latest_info().contents == info.contents
+        assert isinstance(agent.transformations()[0], Replication)
+        assert net.latest_transmission_recipient() is agent
+
+    def test_transmit_to_unconnected_node_raises(self):
+        sim = Simulation()
+        net = sim.network()
+        agent1 = sim.node(Agent, network=net)
+        agent2 = sim.node(Agent, network=net)
+        info = sim.info(models.Info, agent1, contents="x")
+
+        with pytest.raises(ValueError):
+            agent1.transmit(what=info, to_whom=agent2)
+
+    def test_fail_node_fails_contents(self):
+        sim = Simulation()
+        net, source = self._moran_network(sim, size=2)
+        agent1, agent2 = net.nodes(type=Agent)
+        source.transmit(to_whom=agent1)
+        agent1.receive()
+        agent1.transmit(to_whom=agent2)
+
+        agent1.fail()
+
+        assert agent1.failed
+        assert agent1.vectors() == []
+        assert all(i.failed for i in agent1.infos(failed="all"))
+        assert not net.transmissions(status="pending")
+        assert agent2.neighbors(direction="either") == [source]
+        assert net.nodes(type=Agent) == [agent2]
+
+    def test_mutate(self):
+        sim = Simulation()
+        net = sim.network()
+        agent = sim.node(Agent, network=net)
+        info = sim.info(UpperCaseInfo, agent, contents="aaa")
+        agent.mutate(info_in=info)
+        assert agent.latest_info().contents == "AAA"
+        assert isinstance(agent.latest_info(), UpperCaseInfo)
+        assert isinstance(agent.transformations()[0], Mutation)
+
+    def test_moran_cultural(self):
+        sim = Simulation()
+        net, source = self._moran_network(sim, size=3)
+
+        with sim:
+            for i in range(100):
+                processes.moran_cultural(net)
+                for agent in net.nodes(type=Agent):
+                    agent.receive()
+
+        contents = set(
+            a.latest_info().contents for a in net.nodes(type=Agent))
+        assert len(contents) == 1
+
+    def test_moran_sexual(self):
+        sim = Simulation()
+        net = sim.network()
+        agent1, agent2, agent3 = [
+            sim.node(nodes.ReplicatorAgent, network=net) for _ in range(3)]
+        agent1.connect(direction="both", whom=[agent2, agent3])
+        agent2.connect(direction="both", whom=agent3)
+        source = sim.node(nodes.RandomBinaryStringSource, network=net)
+        source.connect(whom=net.nodes(type=Agent))
+        processes.moran_sexual(net)
+        for agent in net.nodes(type=Agent):
+            agent.receive()
+
+        for i in range(100):
+            sim.node(nodes.ReplicatorAgent, network=net)
+            processes.moran_sexual(net)
+            for agent in net.nodes(type=Agent):
+                agent.receive()
+
+        assert agent1.failed and agent2.failed and agent3.failed
+        assert net.size(type=Agent) == 3
+        assert len(set(a.infos()[0].contents
+                       for a in net.nodes(type=Agent))) == 1
+
+    def test_random_walk(self):
+        sim = Simulation()
+        net = sim.network(networks.Chain)
+        source = sim.node(nodes.RandomBinaryStringSource, network=net)
+        net.add_node(source)
+        for _ in range(3):
+            net.add_node(sim.node(nodes.ReplicatorAgent, network=net))
+
+        agents = net.nodes(type=Agent)
+        for agent in agents:
+            processes.random_walk(net)
+            agent.receive()
+
+        assert agents[-1].infos()[0].contents == agents[0].infos()[0].contents
+
+    def test_flush(self, db_session):
+        sim = Simulation()
+        net, source = self._moran_network(sim, size=3)
+        with sim:
+            for i in range(10):
+                processes.moran_cultural(net)
+                for agent in net.nodes(type=Agent):
+                    agent.receive()
+        net.nodes(type=Agent)[0].fail()
+
+        sim.flush(db_session)
+        db_session.commit()
+
+        network = models.Network.query.one()
+        assert network.id == net.id
+        assert isinstance(network, networks.FullyConnected)
+        assert network.size() == 3
+        assert network.size(failed="all") == 4
+        assert len(network.vectors(failed="all")) == len(net.vectors(failed="all"))
+        assert len(network.infos(failed="all")) == len(net.infos(failed="all"))
+        assert len(network.transmissions(status="received")) == \
+            len(net.transmissions(status="received"))
+        assert len(network.transformations(type=Replication)) == \
+            len(net.transformations())
+
+        for node in net.nodes(failed="all"):
+            stored = models.Node.query.get(node.id)
+            assert stored.type == node.type
+            assert isinstance(node, type(stored))
+            assert stored.failed == node.failed
+            assert [i.contents for i in sorted(
+                stored.infos(failed="all"), key=attrgetter('id'))] == \
+                [i.contents for i in node.infos(failed="all")]
+
+    def test_flush_twice_raises(self, db_session):
+        sim = Simulation()
+        sim.network()
+        sim.flush(db_session)
+        with pytest.raises(ValueError):
+            sim.flush(db_session)
@@ -1,8 +1,17 @@
 from mock import Mock
+import mock
 import gevent
 import pytest
 import socket
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+needs_msgpack = pytest.mark.skipif(
+    msgpack is None, reason="needs msgpack to be installed")
+
 
 @pytest.fixture
 def pubsub():
@@ -22,11 +31,13 @@ def redis(pubsub):
 def sockets(redis):
     from dallinger.experiment_server import sockets
     sockets.conn = redis
-    # use a separate ChatBackend for each test
+    # use a separate ChatBackend and Heartbeat for each test
     sockets.chat_backend = sockets.ChatBackend()
+    sockets.heartbeat = sockets.Heartbeat()
 
     yield sockets
 
+    sockets.heartbeat.stop()
     # make sure all greenlets complete
     gevent.wait()
 
@@ -40,8 +51,7 @@ def chat(sockets):
 def channel(sockets):
     sockets.chat_backend.channels['test'] = channel = sockets.Channel('test')
     yield channel
-    channel.stop()
-    del sockets.chat_backend.channels['test']
+    sockets.chat_backend.channels.pop('test', None)
 
 
 @pytest.fixture
@@ -70,34 +80,132 @@ def mocksocket():
 
 class TestChannel:
 
-    def test_subscribes_to_redis(self, sockets, pubsub):
-        sockets.Channel('custom').start()
+    def test_relay_queues_message_for_clients(self, channel):
+        client = Mock(binary=False)
+        channel.subscribe(client)
+        channel.relay(b'message')
+        client.enqueue.assert_called_once_with('test:message')
+
+    def test_relay_spawns_send_for_clients_without_queue(self, channel):
+        class Experiment(object):
+            send = Mock()
+
+        client = Experiment()
+        channel.subscribe(client)
+        channel.relay(b'message')
+        gevent.wait()
+        client.send.assert_called_once_with('test:message')
+
+    @needs_msgpack
+    def test_relay_frames_messages_for_each_client(self, sockets, channel):
+        text = Mock(binary=False)
+        binary = Mock(binary=True)
+        channel.subscribe(text)
+        channel.subscribe(binary)
+        channel.relay(b'{"x": 1}')
+        channel.relay(sockets.BINARY_MARKER + msgpack.packb({'x': 2}))
+
+        assert text.enqueue.call_args_list == [
+            (('test:{"x": 1}', ), ),
+            (('test:{"x": 2}', ), ),
+        ]
+        frames = [c[0][0] for c in binary.enqueue.call_args_list]
+        assert [msgpack.unpackb(f, raw=False) for f in frames] == [
+            ['test', '{"x": 1}'],
+            ['test', {'x': 2}],
+        ]
+
+    @needs_msgpack
+    def test_relay_skips_malformed_binary_message(self, sockets, channel):
+        text = Mock(binary=False)
+        channel.subscribe(text)
+        with mock.patch.object(sockets.app, 'logger') as logger:
+            channel.relay(sockets.BINARY_MARKER + b'\x93\x01')
+        logger.exception.assert_called_once()
+        text.enqueue.assert_not_called()
+        channel.relay(b'next')
+        text.enqueue.assert_called_once_with('test:next')
+
+    def test_relay_continues_after_a_client_fails(self, sockets, channel):
+        broken = Mock(binary=False)
+        broken.enqueue.side_effect = RuntimeError('closed')
+        other = Mock(binary=False)
+        channel.subscribe(broken)
+        channel.subscribe(other)
+        with mock.patch.object(sockets.app, 'logger') as logger:
+            channel.relay(b'message')
+        logger.exception.assert_called_once()
+        other.enqueue.assert_called_once_with('test:message')
+
+
+class TestChatBackend:
+
+    def test_subscribes_to_redis(self, chat, pubsub):
+        chat.subscribe(Mock(), 'custom')
         gevent.wait()
         pubsub.subscribe.assert_called_once_with([b'custom'])
 
-    def test_listen(self, sockets):
-        sockets.conn.pubsub.return_value = pubsub = Mock()
+    def test_channels_share_one_pubsub(self, sockets, chat, pubsub):
+        chat.subscribe(Mock(), 'custom')
+        chat.subscribe(Mock(), 'quorum')
+        gevent.wait()
+        sockets.conn.pubsub.assert_called_once_with()
+        assert pubsub.subscribe.call_count == 2
+
+    def test_listen(self, chat, pubsub):
         pubsub.listen.return_value = [{
             'type': 'message',
             'channel': b'quorum',
             'data': b'Calloo! Callay!',
+        }, {
+            'type': 'message',
+            'channel': b'other',
+            'data': b'Not for us',
         }]
-
-        channel = sockets.Channel('custom')
-        client = Mock()
-        channel.subscribe(client)
-        channel.start()
+        client = Mock(binary=False)
+        chat.subscribe(client, 'quorum')
         gevent.wait()  # wait for event loop
 
-        client.send.assert_called_once_with('quorum:Calloo! Callay!')
+        client.enqueue.assert_called_once_with('quorum:Calloo! Callay!')
+
+    def test_listen_relays_messages_after_one_fails(self, chat, pubsub):
+        pubsub.listen.return_value = [{
+            'type': 'message', 'channel': b'quorum', 'data': b'first',
+        }, {
+            'type': 'message', 'channel': b'quorum', 'data': b'second',
+        }]
+        client = Mock(binary=False)
+        client.enqueue.side_effect = [ValueError('bad client'), None]
+        chat.subscribe(client, 'quorum')
+        gevent.wait()
+
+        assert client.enqueue.call_count == 2
+        assert chat.greenlet.dead
 
-    def test_stop(self, channel):
-        channel.start()
-        channel.stop()
-        assert channel.greenlet is None
+    def test_listen_resubscribes_when_connection_is_lost(
+            self, sockets, chat, pubsub):
+        from redis import ConnectionError
+        replacement = Mock()
+        replacement.listen.return_value = [{
+            'type': 'message', 'channel': b'quorum', 'data': b'back',
+        }]
+        sockets.conn.pubsub.side_effect = [pubsub, replacement]
+        pubsub.listen.side_effect = ConnectionError('lost')
+        client = Mock(binary=False)
 
+        with mock.patch.object(sockets, 'REDIS_RETRY_DELAY', 0):
+            chat.subscribe(client, 'quorum')
+            gevent.wait()
 
-class TestChatBackend:
+        pubsub.close.assert_called_once_with()
+        replacement.subscribe.assert_called_once_with([b'quorum'])
+        assert chat.pubsub is replacement
+        client.enqueue.assert_called_once_with('quorum:back')
+
+    def test_stop(self, chat):
+        chat.subscribe(Mock(), 'custom')
+        chat.stop()
+        assert chat.greenlet is None
 
     def test_subscribe_to_new_channel_registers_client_for_channel(self, chat):
         client = Mock()
@@ -111,10 +219,19 @@ class TestChatBackend:
 
     def test_unsubscribe(self, chat):
         client = Mock()
+        other = Mock()
         chat.subscribe(client, 'quorum')
+        chat.subscribe(other, 'quorum')
         chat.unsubscribe(client)
         assert client not in chat.channels['quorum'].clients
 
+    def test_unsubscribing_last_client_closes_channel(self, chat, pubsub):
+        client = Mock()
+        chat.subscribe(client, 'quorum')
+        chat.unsubscribe(client)
+        assert 'quorum' not in chat.channels
+        pubsub.unsubscribe.assert_called_once_with([b'quorum'])
+
 
 class TestClient:
 
@@ -128,16 +245,113 @@ class TestClient:
         client.send('message')
         assert client not in channel.clients
 
-    def test_heartbeat(self, sockets, client):
+    def test_enqueue_sends_from_writer(self, client):
+        client.enqueue('one')
+        client.enqueue('two')
+        gevent.sleep(0)
+        client.close()
+        assert client.ws.send.call_args_list == [(('one', ), ), (('two', ), )]
+
+    def test_full_queue_drops_oldest_message(self, sockets):
+        client = sockets.Client(Mock(), queue_size=2)
+        for message in ('one', 'two', 'three'):
+            client.enqueue(message)
+        gevent.sleep(0)
+        client.close()
+        assert client.ws.send.call_args_list == [(('two', ), ), (('three', ), )]
+
+    def test_full_queue_disconnects_slow_client(self, sockets, chat):
+        ws = Mock()
+        ws.closed = False
+        client = sockets.Client(ws, queue_size=1, slow_policy='disconnect')
+        chat.subscribe(client, 'quorum')
+        client.enqueue('one')
+        client.enqueue('two')
+        assert client.closed
+        assert 'quorum' not in chat.channels
+        ws.close.assert_called_once_with()
+        ws.send.assert_not_called()
+
+    def test_coalesces_messages_within_tolerance(self, sockets):
+        client = sockets.Client(
+            Mock(), lag_tolerance_secs=0.01, coalesce=True)
+        client.enqueue('quorum:one')
+        client.enqueue('quorum:two')
+        gevent.sleep(0.05)
+        client.enqueue('quorum:three')
+        gevent.sleep(0.05)
+        client.close()
+        assert client.ws.send.call_args_list == [
+            (('["quorum:one", "quorum:two"]', ), ),
+            (('["quorum:three"]', ), ),
+        ]
+
+    def test_caps_lag_tolerance(self, sockets):
+        assert sockets.Client(
+            Mock(), lag_tolerance_secs=1e9).lag_tolerance_secs == \
+            sockets.MAX_LAG_TOLERANCE_SECS
+        assert sockets.Client(Mock(), lag_tolerance_secs=-1).lag_tolerance_secs == 0
+        assert sockets.Client(
+            Mock(), lag_tolerance_secs=float('nan')).lag_tolerance_secs == 0
+
+    @needs_msgpack
+    def test_coalesces_binary_messages_into_an_array(self, sockets):
+        client = sockets.Client(
+            Mock(), lag_tolerance_secs=0.01, coalesce=True, binary=True)
+        client.enqueue(sockets.binary_frame('quorum', b'one'))
+        client.enqueue('ping')
+        client.enqueue(sockets.binary_frame('quorum', b'two'))
+        gevent.sleep(0.05)
+        client.close()
+        frame, = client.ws.send.call_args[0]
+        assert msgpack.unpackb(frame, raw=False) == [
+            ['quorum', 'one'], ['quorum', 'two']]
+
+    def test_rejects_unknown_slow_policy(self, sockets):
+        with pytest.raises(ValueError):
+            sockets.Client(Mock(), slow_policy='wait')
+
+
+class TestHeartbeat:
+
+    @pytest.fixture
+    def heartbeat(self, sockets):
+        return sockets.heartbeat
+
+    def test_pings_idle_clients(self, sockets, heartbeat, client):
         client.ws.closed = False
-        sockets.HEARTBEAT_DELAY = 1
+        client.enqueue = Mock()
+        client.last_active -= sockets.HEARTBEAT_DELAY
+        heartbeat.add(client)
+        heartbeat.tick()
+        client.enqueue.assert_called_once_with('ping')
 
-        gevent.spawn(client.heartbeat)
-        gevent.sleep(2)
+    def test_skips_recently_active_clients(self, heartbeat, client):
+        client.ws.closed = False
+        client.enqueue = Mock()
+        heartbeat.add(client)
+        heartbeat.tick()
+        client.enqueue.assert_not_called()
+
+    def test_closes_dead_clients(self, heartbeat, chat, client):
         client.ws.closed = True
-        gevent.wait()
+        chat.subscribe(client, 'quorum')
+        heartbeat.add(client)
+        heartbeat.tick()
+        assert client.closed
+        assert 'quorum' not in chat.channels
+        assert client not in heartbeat.clients
 
-        client.ws.send.assert_called_with('ping')
+    def test_runs_while_there_are_clients(self, sockets, heartbeat, client):
+        client.ws.closed = False
+        client.last_active -= sockets.HEARTBEAT_DELAY
+        with mock.patch.object(sockets, 'HEARTBEAT_TICK', 0.01):
+            heartbeat.add(client)
+            gevent.sleep(0.05)
+            client.ws.closed = True
+            gevent.sleep(0.05)
+        assert heartbeat.greenlet.dead
+        client.ws.send.assert_called_once_with('ping')
 
 
 class TestChatEndpoint:
@@ -149,27 +363,157 @@ class TestChatEndpoint:
         sockets.request.args = {'channel': 'special'}
         sockets.chat(ws)
 
-        clients = [
-            c for c in sockets.chat_backend.channels['special'].clients
-            if c.ws is ws
-        ]
-        assert len(clients) == 1
+        sockets.conn.pubsub().subscribe.assert_called_once_with([b'special'])
 
-    def test_chat_publishes_message_to_requested_channel(self, sockets, mocksocket):
-        ws = mocksocket
-        ws.receive.return_value = 'special:incoming message!'
+    def test_chat_closes_channel_when_socket_closes(self, sockets):
+        ws = Mock()
+        ws.closed = True
         sockets.request = Mock()
-        sockets.request.args = {'tolerance': '.5'}
+        sockets.request.args = {'channel': 'special'}
         sockets.chat(ws)
-        sockets.conn.publish.assert_called_once_with(
-            'special', 'incoming message!'
-        )
 
-    def test_sleeps_for_requested_time(self, sockets, mocksocket):
+        assert 'special' not in sockets.chat_backend.channels
+
+    def test_chat_closes_client_when_receiving_fails(self, sockets):
+        ws = Mock()
+        ws.closed = False
+        ws.receive.side_effect = RuntimeError('broken socket')
+        sockets.request = Mock()
+        sockets.request.args = {'channel': 'special'}
+        with pytest.raises(RuntimeError):
+            sockets.chat(ws)
+
+        # The publisher was told to stop, and ran its last, empty, batch
+        sockets.conn.pipeline.return_value.execute.assert_called_once_with()
+        assert 'special' not in sockets.chat_backend.channels
+        assert not sockets.heartbeat.clients
+
+    def test_chat_publishes_message_to_requested_channel(self, sockets, mocksocket):
         ws = mocksocket
-        ws.receive.return_value = 'somechannel:incoming message!'
+        ws.receive.return_value = 'special:incoming message!'
         sockets.request = Mock()
-        sockets.request.args.get.return_value = '.5'
-        sockets.gevent = Mock()
+        sockets.request.args = {'tolerance': 'soon'}
         sockets.chat(ws)
-        sockets.gevent.sleep.assert_called_once_with(0.5)
+        pipe = sockets.conn.pipeline.return_value
+        pipe.publish.assert_called_once_with('special', 'incoming message!')
+        pipe.execute.assert_called_with()
+
+    def test_pipelines_messages_received_together(self, sockets, client):
+        client.ws.closed = False
+        messages = ['special:one', 'special:two', 'special:three']
+        client.ws.receive.side_effect = lambda: messages.pop(0)
+
+        def take():
+            client.ws.closed = not messages
+            return 0
+
+        client.bucket.take = take
+        client.publish()
+        pipe = sockets.conn.pipeline.return_value
+        assert pipe.publish.call_args_list == [
+            (('special', 'one'), ),
+            (('special', 'two'), ),
+            (('special', 'three'), ),
+        ]
+        assert pipe.execute.call_count == 1
+
+    def test_publish_inbound_survives_a_failed_batch(self, sockets, client):
+        pipe = sockets.conn.pipeline.return_value
+        pipe.execute.side_effect = [RuntimeError('boom'), []]
+        client.inbound.put('special:one')
+        gevent.spawn(client.publish_inbound)
+        gevent.sleep(0)
+        client.inbound.put('special:two')
+        client.inbound.put(None)
+        gevent.wait()
+
+        assert pipe.execute.call_count == 2
+        assert pipe.publish.call_args_list[-1] == (('special', 'two'), )
+
+    def test_inbound_queue_is_bounded(self, sockets, client):
+        assert client.inbound.maxsize == sockets.INBOUND_QUEUE_SIZE
+
+    def test_waits_when_over_rate_limit(self, sockets, client):
+        client.ws.closed = False
+        client.ws.receive.return_value = 'special:message'
+        client.bucket.take = Mock(return_value=0.5)
+        with mock.patch.object(sockets, 'gevent') as gevent_mock:
+            gevent_mock.sleep.side_effect = lambda delay: setattr(
+                client.ws, 'closed', True)
+            client.publish()
+        gevent_mock.sleep.assert_called_once_with(0.5)
+
+
+class TestFrames:
+
+    def test_split_text_frame(self, sockets):
+        assert sockets.split_frame('quorum:{"n": 1}') == ('quorum', '{"n": 1}')
+
+    def test_split_rejects_frame_without_channel(self, sockets):
+        with pytest.raises(ValueError):
+            sockets.split_frame('no channel')
+
+    @needs_msgpack
+    def test_split_binary_frame_keeps_packed_data(self, sockets):
+        frame = msgpack.packb(['game', {'grid': [[0, 1], [1, 0]]}])
+        channel_name, data = sockets.split_frame(frame)
+        assert channel_name == 'game'
+        assert data.startswith(sockets.BINARY_MARKER)
+        assert msgpack.unpackb(data[1:], raw=False) == {
+            'grid': [[0, 1], [1, 0]]}
+
+    @needs_msgpack
+    def test_split_rejects_binary_frame_without_data(self, sockets):
+        with pytest.raises(ValueError):
+            sockets.split_frame(b'\x92\xa4game')
+        with pytest.raises(ValueError):
+            sockets.split_frame(b'\x92\xa4ga')
+
+    @needs_msgpack
+    def test_binary_round_trip_through_relay(self, sockets):
+        channel_name, data = sockets.split_frame(
+            msgpack.packb(['game', [1, 2, 3]]))
+        frame = sockets.binary_frame(channel_name, data)
+        assert frame == msgpack.packb(['game', [1, 2, 3]])
+        assert sockets.text_frame(channel_name, data) == 'game:[1, 2, 3]'
+
+    @needs_msgpack
+    def test_text_frame_encodes_binary_values_as_base64(self, sockets):
+        data = sockets.BINARY_MARKER + msgpack.packb(
+            {'pixels': b'\x00\xff'}, use_bin_type=True)
+        assert sockets.text_frame('game', data) == 'game:{"pixels": "AP8="}'
+
+    @needs_msgpack
+    def test_text_frame_rejects_malformed_binary_message(self, sockets):
+        with pytest.raises(ValueError):
+            sockets.text_frame('game', sockets.BINARY_MARKER + b'\xc1')
+
+    @needs_msgpack
+    def test_split_rejects_binary_frame_with_malformed_data(self, sockets):
+        with pytest.raises(ValueError):
+            sockets.split_frame(b'\x92\xa4game\x93\x01')
+        with pytest.raises(ValueError):
+            sockets.split_frame(b'\x92\xa4game\xc1')
+        with pytest.raises(ValueError):
+            sockets.split_frame(b'\x92\xa4game\x01\x02')
+
+
+class TestTokenBucket:
+
+    def test_allows_burst_then_waits_for_rate(self, sockets):
+        bucket = sockets.TokenBucket(rate=10, burst=2)
+        with mock.patch.object(sockets.time, 'time', return_value=bucket.updated):
+            assert bucket.take() == 0
+            assert bucket.take() == 0
+            assert bucket.take() == pytest.approx(0.1)
+            assert bucket.take() == pytest.approx(0.2)
+
+    def test_refills_over_time(self, sockets):
+        bucket = sockets.TokenBucket(rate=10, burst=2)
+        start = bucket.updated
+        with mock.patch.object(sockets.time, 'time', return_value=start):
+            bucket.take()
+            bucket.take()
+        with mock.patch.object(sockets.time, 'time', return_value=start + 1):
+            assert bucket.take() == 0
+            assert bucket.tokens == 1